@@ -12,10 +12,20 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import metrics
+import backends
+import genefetch
+from record import VariantRecord
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
 def collapseGeneNames(row, indices, region, cnt):
+    return geneNamesPrefix(row, indices) + region
+
+
+"""What collapseGeneNames() puts before the region of a transcript
+"""
+def geneNamesPrefix(row, indices=indicesKnownGenes):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
         'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
@@ -25,9 +35,58 @@ def collapseGeneNames(row, indices, region, cnt):
         r = str(row[i])
         if(len(r) > 0 ):
             collapsed.append(mn + '=' + r.strip())
-    collapsed.append(region)
 
-    return  ';'.join(collapsed)
+    return ''.join([c + ';' for c in collapsed])
+
+
+# Flags of a transcript location: the kind of transcript, and the parts
+# of it the position falls in, bounds included
+NON_CODING = 1      # cdsStart == cdsEnd
+CODING = 2          # cdsStart < cdsEnd
+IN_CDS = 4          # cdsStart <= pos <= cdsEnd
+BEFORE_CDS = 8      # txStart <= pos <= cdsStart
+AFTER_CDS = 16      # cdsEnd <= pos <= txEnd
+IN_PROMOTER = 32    # within promoter_offset upstream of the transcript
+
+"""Where pos falls in the transcript of a refGene row, as the tuple
+   (gene names prefix, strand, exonCount, flags, exons) the gene location
+   stages annotate from; exons holds the numbers, counted along the
+   strand, of the exons containing pos
+"""
+def locateTranscript(row, pos, promoter_offset):
+    txtStart = int(row[4])
+    txtEnd = int(row[5])
+    cdsStart = int(row[6])
+    cdsEnd = int(row[7])
+    exonCount = int(row[8])
+    exonsSt = str(row[9].decode("utf-8")).split(',')
+    exonsEn = str(row[10].decode("utf-8")).split(',')
+    strand = str(row[3])
+
+    flags = 0
+    if (cdsStart == cdsEnd):
+        flags = flags | NON_CODING
+    if (cdsStart < cdsEnd):
+        flags = flags | CODING
+    if u.isBetween(pos, cdsStart, cdsEnd):
+        flags = flags | IN_CDS
+    if u.isBetween(pos, txtStart, cdsStart):
+        flags = flags | BEFORE_CDS
+    if u.isBetween(pos, cdsEnd, txtEnd):
+        flags = flags | AFTER_CDS
+    if ((u.isBetween(pos, txtStart - int(promoter_offset), txtStart) and (strand == "+")) or \
+        (u.isBetween(pos, txtEnd, txtEnd + int(promoter_offset)) and (strand == "-"))):
+        flags = flags | IN_PROMOTER
+
+    exons = []
+    for e in range(0, exonCount):
+        if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
+            exnum = e + 1
+            if (strand == '-'):
+                exnum = exonCount - e
+            exons.append(exnum)
+
+    return (geneNamesPrefix(row), strand, exonCount, flags, tuple(exons))
 
 
 """"Collapces bigRefSegTable
@@ -52,6 +111,12 @@ def collapseRefSeq(line):
     return  ';'.join(collapsed)
 
 
+"""collapseRefSeq of a row of the BigRefGene tables, leaving out its bin
+"""
+def collapseRefSeqRow(row):
+    return collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]]))
+
+
 def binarySearchUniqueAndSorted(arg0, key):
     low = 0;
     high = len(arg0) - 1
@@ -107,1023 +172,1317 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
+"""Base class for an annotation stage
+   A stage sees every data record exactly once, as a record.VariantRecord,
+   and annotates it in place. Header lines never reach a stage. Counts are kept on the stage and written to the count log
+   once the whole file has been processed.
+"""
+class Stage(object):
+    label = ''
+    # Attributes holding the stage's counts; counts from stages that ran
+    # over different parts of a file can be summed with addCounts()
+    counters = []
+
+    def __init__(self, format='vcf'):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.backend = None
+        self.cursor = None
+        self.snapshot = None
+        self.fetch = None
+        self.metrics = metrics.StageMetrics()
+
+    """Gets the stage ready to look records up on conn, and in the
+       snapshot.Snapshot of the reference tables if there is one
+       fetch is the genefetch.GeneFetch the stages of the job share.
+    """
+    def open(self, backend, conn, snapshot=None, fetch=None):
+        self.backend = backend
+        self.snapshot = snapshot
+        self.fetch = fetch
+        self.cursor = metrics.CountingCursor(backend.cursor(conn),
+            self.metrics)
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    """Returns what the stage finds in the reference tables for a record;
+       apply() then annotates the record with it
+    """
+    def lookup(self, record):
+        raise NotImplementedError
+
+    """lookup() for a chunk of records; stages that can batch their
+       lookups override this, everyone else goes record by record
+    """
+    def lookupChunk(self, records):
+        return [self.lookup(record) for record in records]
+
+    def apply(self, record, data):
+        self.addRows(record, data)
+
+    def addRows(self, record, rows):
+        raise NotImplementedError
+
+    def annotate(self, record):
+        self.apply(record, self.lookup(record))
+
+    """Annotates a chunk of records
+       found, when given, holds for every record a dict of the lookups
+       already known for it, by stage label (see cache.VariantCache).
+       Only the records this stage has no entry for are looked up, and
+       their results are added to the dicts.
+    """
+    def annotateChunk(self, records, found=None):
+        if found is None:
+            results = self.lookupChunk(records)
+        else:
+            missing = [i for i in range(0, len(records)) \
+                if self.label not in found[i]]
+            looked = self.lookupChunk([records[i] for i in missing])
+            for i, data in zip(missing, looked):
+                found[i][self.label] = data
+            results = [entry[self.label] for entry in found]
+
+        for record, data in zip(records, results):
+            self.apply(record, data)
+
+    """annotateChunk, adding its time and output to the stage metrics
+    """
+    def runChunk(self, records, found=None):
+        before = sum([record.annotatedLength() for record in records])
+        with metrics.Stopwatch() as watch:
+            self.annotateChunk(records, found=found)
+        after = sum([record.annotatedLength() for record in records])
+
+        self.metrics.wall_time = self.metrics.wall_time + watch.wall
+        self.metrics.cpu_time = self.metrics.cpu_time + watch.cpu
+        self.metrics.variants = self.metrics.variants + len(records)
+        self.metrics.bytes_written = self.metrics.bytes_written + \
+            after - before
+
+    def getCounts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
+
+    def addCounts(self, counts):
+        for name in self.counters:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+    def writeLog(self, fh_log):
+        pass
+
+
+"""Base class for the stages that report "In <table>: x in y variants"
+   coverage, the bitmaps.CoverageBitmaps of the region tables, lets the
+   records whose bin has no region of the table skip the lookup.
+"""
+class OverlapStage(Stage):
+    counters = ['var_count', 'line_count']
+
+    def __init__(self, format='vcf', table='', coverage=None):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.label = table
+        self.coverage = coverage
+        if coverage is not None:
+            self.metrics = metrics.PrefilterMetrics()
+        self.var_count = 0
+        self.line_count = 0
+
+    """Returns the (table, chrom, pos) whose bin must be covered for the
+       record to have a match, or None if it can have none
+    """
+    def getBin(self, record):
+        return self.table, record.chr, record.pos
+
+    """Whether each record may have a match, according to the coverage
+       bitmaps
+    """
+    def inCoverage(self, records):
+        passed = [True] * len(records)
+        groups = {}
+        for i, record in enumerate(records):
+            where = self.getBin(record)
+            if where is None:
+                passed[i] = False
+            elif self.coverage.has(where[0]):
+                groups.setdefault(where[:2], []).append(i)
+        for (table, chrom), indices in groups.items():
+            covered = self.coverage.covers(table, chrom,
+                [self.getBin(records[i])[2] for i in indices])
+            for i, c in zip(indices, covered.tolist()):
+                passed[i] = c
+        hits = sum(passed)
+        self.metrics.prefilter_hits = self.metrics.prefilter_hits + hits
+        self.metrics.prefilter_skips = self.metrics.prefilter_skips + \
+            len(records) - hits
+        return passed
+
+    """Looks up only the records in a covered bin; the others have no
+       match
+    """
+    def lookupChunk(self, records):
+        if self.coverage is None:
+            return self.lookupCovered(records)
+        passed = self.inCoverage(records)
+        found = iter(self.lookupCovered([record for record, p in \
+            zip(records, passed) if p]))
+        return [next(found) if p else [] for p in passed]
+
+    def lookupCovered(self, records):
+        return Stage.lookupChunk(self, records)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+"""Base class for the stages that look for table rows whose region
+   contains the variant position
+   Each record is looked up in the database on its own unless use_index
+   is set; then every chromosome of the table is loaded once into an
+   intervals.IntervalIndex and whole chunks are answered from memory.
+   Tables in the reference snapshot are always answered from its index,
+   without querying the database. Otherwise, with a batch_size above 1,
+   the regions around each block of batch_size positions are read with
+   one query and matched to the positions here. fetchOne stages only
+   ever use the first matching row; every path reads the rows in the
+   order of backend.orderBy(), so they all pick the same one.
+"""
+class IntervalStage(OverlapStage):
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    columns = '*'
+    fetchOne = False
+
+    def __init__(self, format='vcf', table='', use_index=False, coverage=None,
+        batch_size=1):
+        OverlapStage.__init__(self, format=format, table=table,
+            coverage=coverage)
+        self.use_index = use_index
+        self.batch_size = batch_size
+        self.indexes = {}
+
+    """Returns the (chr, pos) to look up, or None to leave the record as is
+    """
+    def getRegion(self, record):
+        return record.chr, record.pos
+
+    def getTable(self, chr):
+        return self.table
+
+    """Value of the chromosome column to filter on, None for none
+    """
+    def getChrom(self, chr):
+        return chr
+
+    def getBin(self, record):
+        region = self.getRegion(record)
+        if region is None:
+            return None
+        chr, pos = region
+        return self.getTable(chr), self.getChrom(chr), pos
+
+    def lookup(self, record):
+        region = self.getRegion(record)
+        if region is None:
+            return []
+        chr, pos = region
+
+        return self.backend.overlap(self.cursor, self.getTable(chr),
+            self.getChrom(chr), pos, chromName=self.chromName,
+            startName=self.startName, endName=self.endName,
+            columns=self.columns, first=self.fetchOne)
+
+    def lookupCovered(self, records):
+        if not (self.use_index or self.inSnapshot()):
+            if (self.batch_size > 1):
+                return self.lookupBatched(records)
+            return OverlapStage.lookupCovered(self, records)
+
+        results = [[] for record in records]
+        byChrom = {}
+        for i, record in enumerate(records):
+            region = self.getRegion(record)
+            if region is not None:
+                byChrom.setdefault(region[0], []).append(i)
+
+        for chr, variants in byChrom.items():
+            index = self.getIndex(chr)
+            hits = index.query([records[i].pos for i in variants])
+            for i, rows in zip(variants, hits):
+                if self.fetchOne:
+                    rows = rows[:1]
+                results[i] = rows
+        return results
+
+    """Looks up a whole chunk with one query per table, chromosome and
+       block of up to batch_size positions within intervals.MAX_SPAN of
+       each other, reading the regions between the first and last
+       position of the block; a position with no other near it is looked
+       up on its own. Rows keep the order the database returns them in.
+    """
+    def lookupBatched(self, records):
+        import intervals
+
+        results = [[] for record in records]
+        byChrom = {}
+        for i, record in enumerate(records):
+            region = self.getRegion(record)
+            if region is not None:
+                byChrom.setdefault(region[0], []).append((i, region[1]))
+
+        for chr, variants in byChrom.items():
+            positions = sorted(set([pos for i, pos in variants]))
+            found = {}
+            for block in intervals.spanBlocks(positions, self.batch_size):
+                if (len(block) == 1):
+                    found[block[0]] = self.backend.overlap(self.cursor,
+                        self.getTable(chr), self.getChrom(chr), block[0],
+                        chromName=self.chromName, startName=self.startName,
+                        endName=self.endName, columns=self.columns,
+                        first=self.fetchOne)
+                    continue
+                rows = self.backend.regions(self.cursor, self.getTable(chr),
+                    self.getChrom(chr), chromName=self.chromName,
+                    startName=self.startName, endName=self.endName,
+                    columns=self.columns, span=(block[0], block[-1]))
+                index = intervals.fromRows([row for row in rows \
+                    if (row[0] is not None) and (row[1] is not None)])
+                found.update(zip(block, index.query(block)))
+            for i, pos in variants:
+                results[i] = found[pos][:1] if self.fetchOne else found[pos]
+        return results
+
+    """Whether every table of the stage is in the snapshot
+    """
+    def inSnapshot(self):
+        return (self.snapshot is not None) and self.snapshot.has(self.table)
+
+    """Loads one chromosome of the table into memory, the first time
+       it is needed
+    """
+    def getIndex(self, chr):
+        table = self.getTable(chr)
+        if (self.snapshot is not None) and self.snapshot.has(table):
+            return self.snapshot.index(table, self.getChrom(chr),
+                columns=self.columns)
+
+        if chr not in self.indexes:
+            import intervals
+
+            rows = self.backend.regions(self.cursor, self.getTable(chr),
+                self.getChrom(chr), chromName=self.chromName,
+                startName=self.startName, endName=self.endName,
+                columns=self.columns)
+            self.indexes[chr] = intervals.fromRows(rows)
+
+        return self.indexes[chr]
+
+
+"""Runs a list of stages over a VCF in a single pass
+   Every line is read and split once, and records are handed to each
+   stage in order, chunk_size records at a time, then written once. All
+   stages share one pooled database connection; when the file is done
+   each stage appends its counts to the log, in stage order.
+   With a cache.VariantCache, variants it has seen skip their lookups and
+   the lookups made for the others are added to it. With a
+   snapshot.Snapshot, region tables are read from it instead of the
+   database.
+"""
+def annotateFile(infile, outfile, stages, logcountfile=None, logmode='a',
+    format='vcf', sep='\t', chunk_size=1000, backend=None, cache=None,
+    snapshot=None):
+
+    fh = open(infile)
     fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+    try:
+        annotateStream(fh, fh_out, stages, format=format, sep=sep,
+            chunk_size=chunk_size, backend=backend, cache=cache,
+            snapshot=snapshot)
+    finally:
+        fh.close()
+        fh_out.close()
+
+    if logcountfile is not None:
+        fh_log = open(logcountfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        fh_log.close()
+
+
+"""Runs a list of stages over the lines of fh, writing each chunk of
+   annotated lines to fh_out as soon as it is done
+   fh can be any iterable of lines and fh_out anything with a write(),
+   so records can come from and go to S3 without touching local disk.
+   Neither is closed here.
+"""
+def annotateStream(fh, fh_out, stages, format='vcf', sep='\t',
+    chunk_size=1000, backend=None, cache=None, snapshot=None):
 
     inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
+    # Header lines are kept in the chunk as strings so they are written
+    # back in their original position
+    def flush(chunk, records):
+        found = None
+        if cache is not None:
+            found = cache.getMany(records)
+        for stage in stages:
+            stage.runChunk(records, found=found)
+        if cache is not None:
+            cache.putMany(records, found)
+        for entry in chunk:
+            if isinstance(entry, str):
+                fh_out.write(entry + '\n')
+            else:
+                fh_out.write(entry.toLine() + '\n')
+
+    if backend is None:
+        backend = backends.MySQLBackend()
+
+    # The connection is held for the whole file; with MySQL it is borrowed
+    # from the process-wide pool and given back once the file is done
+    # refGene and cpgIslandExt are read once for all the stages of the
+    # job, around the widest promoter window any of them uses
+    fetch = genefetch.GeneFetch(margin=max([getattr(stage,
+        'promoter_offset', 0) for stage in stages] + [0]))
+
+    with backend.connection() as conn:
+        for stage in stages:
+            stage.open(backend, conn, snapshot=snapshot, fetch=fetch)
+
+        try:
+            chunk = []
+            records = []
+            for line in fh:
+                line = line.strip()
+                if line.startswith("#"):
+                    chunk.append(line)
                 else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+                    record = VariantRecord(line, inds, sep=sep)
+                    chunk.append(record)
+                    records.append(record)
+                    if (len(records) >= chunk_size):
+                        flush(chunk, records)
+                        chunk = []
+                        records = []
+            flush(chunk, records)
+        finally:
+            for stage in stages:
+                stage.close()
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+class DbSnpStage(Stage):
+    label = 'dbSNP'
+    counters = ['var_count', 'record_count']
+
+    """batch_size is the number of positions looked up per query; with a
+       batch_size of 1 every record gets its own query
+       prefilter, a bloom.BloomFilter of the dbSNP positions, lets the
+       records it rules out skip the lookup.
+    """
+    def __init__(self, format='vcf', varclass='SNV', batch_size=1,
+        prefilter=None):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+        self.metrics = metrics.PrefilterMetrics()
+        self.var_count = 0
+        self.record_count = 0
+
+    """Whether each record may be in dbSNP, according to the prefilter
+    """
+    def mayBeInDbSnp(self, records):
+        passed = [True] * len(records)
+        if self.prefilter is not None:
+            byChrom = {}
+            for i, record in enumerate(records):
+                byChrom.setdefault(str(record.chrom).lower(), []).append(i)
+            for chrom, indices in byChrom.items():
+                found = self.prefilter.mightContain(chrom,
+                    [records[i].pos for i in indices])
+                for i, f in zip(indices, found.tolist()):
+                    passed[i] = f
+        hits = sum(passed)
+        self.metrics.prefilter_hits = self.metrics.prefilter_hits + hits
+        self.metrics.prefilter_skips = self.metrics.prefilter_skips + \
+            len(records) - hits
+        return passed
+
+    def lookup(self, record):
+        if not self.mayBeInDbSnp([record])[0]:
+            return []
+        return self.lookupRecord(record)
+
+    def lookupRecord(self, record):
+        compRef = getComplementary(record.ref)
+
+        return self.backend.pointLookup(self.cursor, 'dbSNP',
+            [('CHR', record.chrom), ('POS', record.pos),
+            ('REF', [record.ref, compRef]), ('INFO', self.varclass)])
+
+    """Looks up a whole chunk with one query per chromosome and block of
+       batch_size positions; REF and its complement are matched here
+       rather than in MySQL
+    """
+    def lookupChunk(self, records):
+        passed = self.mayBeInDbSnp(records)
+        if not all(passed):
+            found = iter(self.lookupCandidates([record for record, p in \
+                zip(records, passed) if p]))
+            return [next(found) if p else [] for p in passed]
+        return self.lookupCandidates(records)
+
+    def lookupCandidates(self, records):
+        if (len(records) == 0):
+            return []
+        if self.inSnapshot():
+            return self.lookupSnapshot(records)
+        if (self.batch_size <= 1):
+            return [self.lookupRecord(record) for record in records]
+
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chrom, []).append(record)
+
+        for chr, variants in byChrom.items():
+            for i in range(0, len(variants), self.batch_size):
+                block = variants[i:i + self.batch_size]
+                positions = sorted(set([record.pos for record in block]))
+
+                rows = self.backend.pointLookup(self.cursor, 'dbSNP',
+                    [('CHR', chr), ('POS', positions),
+                    ('INFO', self.varclass)], columns='POS, REF, dbSNP.*')
+
+                byPos = {}
+                for row in rows:
+                    byPos.setdefault(int(row[0]), []).append(row)
+
+                for record in block:
+                    # Same comparison MySQL does with its default collation
+                    refs = [record.ref.upper(),
+                        getComplementary(record.ref).upper()]
+                    results[id(record)] = [row[2:] \
+                        for row in byPos.get(record.pos, []) \
+                        if str(row[1]).upper() in refs]
+
+        return [results[id(record)] for record in records]
+
+    def inSnapshot(self):
+        return (self.snapshot is not None) and self.snapshot.has('dbSNP')
+
+    """Looks up a whole chunk in the packed dbSNP index of the snapshot,
+       one vectorized search per chromosome
+    """
+    def lookupSnapshot(self, records):
+        index = self.snapshot.dbSnp()
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chrom, []).append(record)
+
+        for chr, variants in byChrom.items():
+            rows = index.lookup(chr, [record.pos for record in variants],
+                [(record.ref, getComplementary(record.ref)) for record in variants],
+                self.varclass)
+            for record, found in zip(variants, rows):
+                results[id(record)] = found
+
+        return [results[id(record)] for record in records]
+
+    def addRows(self, record, rows):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        record.id = '.'
+        if (len(rows) > 0):
+            rsids = []
+            mafs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str = ''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if (record.info == ['.']):
+                record.setInfo('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                record.appendInfo('DB;VC=' + self.varclass + maf_str)
 
-            linenum = linenum + 1
+            record.id = str(';'.join(rsids))
 
-        else:
-            fh_out.write(line + '\n')
+        self.record_count = self.record_count + 1
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def writeLog(self, fh_log):
+        # The total has always been reported as one more than the
+        # number of records
+        linenum = self.record_count + 1
+        ratioInDbSnp = (self.var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [DbSnpStage(format=format, varclass=varclass)],
+        logcountfile=vcf + '.count.log', logmode='w', format=format, sep=sep)
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+    batch_size is the number of records looked up per query in each
+    table; with a batch_size of 1 every record gets its own queries
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+class BigRefGeneStage(Stage):
+    label = 'BigRefGene'
+
+    def __init__(self, format='vcf', batch_size=1):
+        Stage.__init__(self, format=format)
+        self.batch_size = batch_size
+
+    """Collapsed RefSeq annotations of the rows found for the record
+    """
+    def lookup(self, record):
+        return [collapseRefSeqRow(row) for row in self.lookupRows(record)]
+
+    def lookupRows(self, record):
+        chr = record.chrom
+        pos = record.pos
+
+        # Fall through to the next table only on a miss
+        rows = self.getBaseMatches(chr, pos, record.ref, record.alt)
+        if (len(rows) == 0):
+            rows = self.backend.pointLookup(self.cursor,
+                'chrom_pos_equal_nobase', [('CHR', chr), ('start', pos)])
+        if (len(rows) == 0):
+            rows = self.backend.overlap(self.cursor, 'chrom_pos_unequal',
+                chr, pos, chromName='CHR', startName='start', endName='end')
+        return rows
+
+    """Looks a whole chunk up in the BigRefGene index of the snapshot,
+       where the annotations are already collapsed
+    """
+    def lookupChunk(self, records):
+        if not self.inSnapshot():
+            if (self.batch_size > 1):
+                return self.lookupBatched(records)
+            return Stage.lookupChunk(self, records)
+
+        index = self.snapshot.bigRefGene()
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chrom, []).append(record)
+
+        for chr, variants in byChrom.items():
+            rows = index.lookup(chr, [record.pos for record in variants],
+                [record.ref for record in variants],
+                [record.alt for record in variants])
+            for record, found in zip(variants, rows):
+                results[id(record)] = found
+
+        return [results[id(record)] for record in records]
+
+    """Looks up a whole chunk with one query per table, chromosome and
+       block of batch_size records
+    """
+    def lookupBatched(self, records):
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chrom, []).append(record)
+
+        for chr, variants in byChrom.items():
+            for b in range(0, len(variants), self.batch_size):
+                block = variants[b:b + self.batch_size]
+                for record, rows in zip(block, self.lookupBlock(chr, block)):
+                    results[id(record)] = [collapseRefSeqRow(row) for row in rows]
+
+        return [results[id(record)] for record in records]
+
+    """Rows found for each record of a block, falling through to the
+       next table only for the records without a match, as lookupRows()
+    """
+    def lookupBlock(self, chr, block):
+        found = self.getBaseBlock(chr, block)
+
+        missing = [i for i in range(len(block)) if len(found[i]) == 0]
+        if (len(missing) > 0):
+            rows = self.backend.pointLookup(self.cursor, 'chrom_pos_equal_nobase',
+                [('CHR', chr), ('start', sorted(set([block[i].pos for i in missing])))],
+                columns='start, chrom_pos_equal_nobase.*')
+            byPos = {}
+            for row in rows:
+                byPos.setdefault(int(row[0]), []).append(row[1:])
+            for i in missing:
+                found[i] = byPos.get(block[i].pos, [])
+
+        missing = [i for i in missing if len(found[i]) == 0]
+        if (len(missing) > 0):
+            import intervals
+
+            unequal = {}
+            for positions in intervals.spanBlocks(sorted(set(
+                [block[i].pos for i in missing])), len(missing)):
+                if (len(positions) == 1):
+                    unequal[positions[0]] = self.backend.overlap(self.cursor,
+                        'chrom_pos_unequal', chr, positions[0],
+                        chromName='CHR', startName='start', endName='end')
+                    continue
+                rows = self.backend.regions(self.cursor, 'chrom_pos_unequal',
+                    chr, chromName='CHR', startName='start', endName='end',
+                    span=(positions[0], positions[-1]))
+                index = intervals.fromRows([row for row in rows \
+                    if (row[0] is not None) and (row[1] is not None)])
+                unequal.update(zip(positions, index.query(positions)))
+            for i in missing:
+                found[i] = unequal[block[i].pos]
+
+        return found
+
+    """getBaseMatches() for every record of a block, with one query
+    """
+    def getBaseBlock(self, chr, block):
+        refs = set([])
+        for record in block:
+            refs.update([record.ref, getComplementary(record.ref)])
+        rows = self.backend.pointLookup(self.cursor, 'chrom_pos_equal_base',
+            [('CHR', chr), ('start', sorted(set([r.pos for r in block]))),
+            ('haplotypeReference', sorted(refs))],
+            columns='start, haplotypeReference, haplotypeAlternate, ' + \
+                'chrom_pos_equal_base.*')
+        byPos = {}
+        for row in rows:
+            byPos.setdefault(int(row[0]), []).append(row)
+
+        found = []
+        for record in block:
+            compRef = getComplementary(record.ref)
+            compAlt = getComplementary(record.alt)
+            pairs = [(record.ref.upper(), record.alt.upper()),
+                (compRef.upper(), compAlt.upper())]
+            found.append([row[3:] for row in byPos.get(record.pos, []) \
+                if (str(row[1]).upper(), str(row[2]).upper()) in pairs])
+        return found
+
+    def inSnapshot(self):
+        return (self.snapshot is not None) and self.snapshot.has('BigRefGene')
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            m = set(rows)
+
+            record.appendInfo(';'.join(m))
+            # Drop a leading '.' placeholder INFO
+            if (record.info[0] == '.'):
+                del record.info[0]
+
+    """Rows of chrom_pos_equal_base for the alleles or their complements
+       The lookup is narrowed on haplotypeReference; the (reference,
+       alternate) pair is then matched here, without case as MySQL does.
+    """
+    def getBaseMatches(self, chr, pos, ref, alt):
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+        pairs = [(ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper())]
+
+        rows = self.backend.pointLookup(self.cursor, 'chrom_pos_equal_base',
+            [('CHR', chr), ('start', pos), ('haplotypeReference', [ref, compRef])],
+            columns='haplotypeReference, haplotypeAlternate, ' + \
+                'chrom_pos_equal_base.*')
+        return [row[2:] for row in rows \
+            if (str(row[0]).upper(), str(row[1]).upper()) in pairs]
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [BigRefGeneStage(format=format)], format=format, sep=sep)
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Base class for the refGene location stages
+   Keeps the per-region counters reported under "Variants located:"
+"""
+class GeneLocationStage(Stage):
+    counters = ['interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count']
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500,
+        use_index=False):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.use_index = use_index
+        self.models = {}
+        self.islands = {}
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    """Returns the name of the CpG island overlapping the position, if any
+    """
+    def getCpgIsland(self, chr, pos):
+        rows = self.backend.overlap(self.cursor, 'cpgIslandExt', chr,
+            pos, columns='chrom, chromStart, chromEnd, name', first=True)
+        if (len(rows) > 0):
+            return "".join(str(rows[0][3]).split())
+        return None
+
+    """Lookup data of a record: where it falls in each transcript, see
+       locateTranscript(), and the CpG island at its position
+       The CpG island is only looked up when a transcript puts the
+       position in a promoter region.
+    """
+    def lookup(self, record):
+        transcripts = [locateTranscript(row, record.pos, self.promoter_offset) \
+            for row in self.getTranscripts(record.chr, record.pos)]
+        cpg = None
+        if any([self.reachesPromoter(t) for t in transcripts]):
+            cpg = self.getCpgIsland(record.chr, record.pos)
+        return {'transcripts': transcripts, 'cpg': cpg}
+
+    def getTranscripts(self, chr, pos):
+        return self.backend.geneModels(self.cursor, self.table, chr, pos,
+            offset=self.promoter_offset)
+
+    """Looks a whole chunk up, one chromosome at a time, in the gene
+       segmentation map of the snapshot or, when use_index is set, in the
+       gene models of the chromosome loaded into memory; otherwise in the
+       transcripts the job's genefetch.GeneFetch reads around the chunk,
+       or each record on its own when the stage has none
+    """
+    def lookupChunk(self, records):
+        inSnapshot = self.inSnapshot()
+        if not (inSnapshot or self.use_index or (self.fetch is not None)):
+            return Stage.lookupChunk(self, records)
+
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chr, []).append(record)
+
+        for chr, variants in byChrom.items():
+            positions = [record.pos for record in variants]
+            if inSnapshot:
+                located = self.snapshot.geneMap().lookup(chr, positions)
+            elif self.use_index:
+                located = [(transcripts, None) for transcripts in \
+                    self.getModels(chr).locate(positions)]
+            else:
+                located = [([locateTranscript(row, pos, self.promoter_offset) \
+                    for row in rows], None) for pos, rows in zip(positions,
+                    self.fetch.transcripts(self.backend, self.cursor,
+                        self.table, chr, positions, self.promoter_offset))]
+
+            promoters = []
+            for record, (transcripts, cpg) in zip(variants, located):
+                results[id(record)] = {'transcripts': transcripts, 'cpg': cpg}
+                if any([self.reachesPromoter(t) for t in transcripts]):
+                    promoters.append(record)
+                else:
+                    results[id(record)]['cpg'] = None
+
+            if (not inSnapshot) and (len(promoters) > 0):
+                hits = self.findIslands(chr, [r.pos for r in promoters])
+                for record, rows in zip(promoters, hits):
+                    if (len(rows) > 0):
+                        results[id(record)]['cpg'] = "".join(str(rows[0][3]).split())
+
+        return [results[id(record)] for record in records]
+
+    """Loads the transcripts of one chromosome into a
+       genemodels.GeneModels, the first time they are needed
+    """
+    def getModels(self, chr):
+        if chr not in self.models:
+            import genemodels
+
+            if self.fetch is not None:
+                rows = self.fetch.chromRows(self.backend, self.cursor,
+                    self.table, chr)
+            else:
+                rows = self.backend.pointLookup(self.cursor, self.table,
+                    [('chrom', chr)])
+            self.models[chr] = genemodels.GeneModels(rows, self.promoter_offset)
+        return self.models[chr]
+
+    """Loads the CpG islands of one chromosome into memory, the first
+       time they are needed
+    """
+    def getIslands(self, chr):
+        if chr not in self.islands:
+            import intervals
+
+            if self.fetch is not None:
+                self.islands[chr] = self.fetch.chromIslands(self.backend,
+                    self.cursor, chr)
+            else:
+                rows = self.backend.regions(self.cursor, 'cpgIslandExt', chr,
+                    columns='chrom, chromStart, chromEnd, name')
+                self.islands[chr] = intervals.fromRows(rows)
+        return self.islands[chr]
+
+    """CpG island rows overlapping each position of chr, from the whole
+       chromosome when use_index is set, or else from the job's fetch
+    """
+    def findIslands(self, chr, positions):
+        if self.use_index:
+            return self.getIslands(chr).query(positions)
+        return self.fetch.cpgIslands(self.backend, self.cursor, chr, positions)
+
+    """Whether the snapshot has a gene map of the table built with the
+       stage's promoter offset
+    """
+    def inSnapshot(self):
+        return (self.snapshot is not None) and self.snapshot.has('geneMap') and \
+            self.snapshot.geneMap().matches(self.table, self.promoter_offset)
+
+    """Whether a transcript location gets as far as the promoter test
+    """
+    def reachesPromoter(self, transcript):
+        raise NotImplementedError
+
+    def writeLog(self, fh_log):
+        lines = ["Variants located:",
+            f"In interGenic {str(self.interGenic_count)}",
+            f"In CDS {str(self.cds_count)}",
+            f"In \'3 UTR {str(self.utr3_count)}",
+            f"In \'5 UTR {str(self.utr5_count)}",
+            f"In Intronic {str(self.intronic_count)}",
+            f"In Non_coding_intronic {str(self.non_coding_intronic_count)}",
+            f"In Exonic {str(self.exonic_count)}",
+            f"In Non_coding_exonic {str(self.non_coding_exonic_count)}",
+            f"In Putative Promoter Region {str(self.promoter_count)}"]
+
+        for l in lines:
+            print(l)
+            fh_log.write(l + '\n')
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+class GenesStage(GeneLocationStage):
+    label = 'refGene'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    def reachesPromoter(self, transcript):
+        flags = transcript[3]
+        return not (flags & (NON_CODING | IN_CDS)) and bool(flags & IN_PROMOTER)
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+    def apply(self, record, data):
+        rows = data['transcripts']
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+        if (len(rows) > 0):
+            positionType = str(record.findInfo('positionType'))
             info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+            for names, strand, exonCount, flags, exnums in rows:
+                #count location
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                region = ""
+                exons = []
+
+                if (flags & NON_CODING):
+                    for exnum in exnums:
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (flags & IN_CDS):
+                    for exnum in exnums:
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (flags & IN_PROMOTER):
+                    cpg = data['cpg']
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + cpg
+                        self.promoter_count = self.promoter_count + 1
+
+                if (region != ''):
+                    info.append(names + region)
+
+            record.appendInfo(";".join(info))
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+            record.appendInfo("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [GenesStage(format=format, table=table,
+            promoter_offset=promoter_offset)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+class ExonsEtAlStage(GeneLocationStage):
+    label = 'ExonsEtAl'
+
+    def reachesPromoter(self, transcript):
+        strand = transcript[1]
+        flags = transcript[3]
+        if (flags & NON_CODING):
+            return False
+        if (flags & CODING) and (flags & IN_CDS):
+            return False
+        if (flags & CODING) and (flags & (BEFORE_CDS | AFTER_CDS)) and \
+            (strand in ["+", "-"]):
+            return False
+        return bool(flags & IN_PROMOTER)
+
+    def apply(self, record, data):
+        rows = data['transcripts']
+
+        if (len(rows) > 0):
             info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
+            for names, strand, exonCount, flags, exnums in rows:
+                coding = bool(flags & CODING)
+                region = ""
+                exons = []
+
+                if (flags & NON_CODING):
+                    for exnum in exnums:
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                    if (len(exons) > 0):
+                        region='positionType=non_coding_exon;' + ";".join(exons)
                     else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
+                        self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                        region = 'positionType=non_coding_intron'
+
+                elif ((flags & IN_CDS) and coding):
+                    self.cds_count = self.cds_count + 1
+                    for exnum in exnums:
+                        exons.append("exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = 'positionType=CDS;' + ";".join(exons)
+                    else:
+                        self.intronic_count = self.intronic_count + 1
+                        region = 'positionType=CDS;' + 'intron'
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+                elif ((flags & BEFORE_CDS) and coding and (strand == "+")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+                elif ((flags & AFTER_CDS) and coding and (strand == "+")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+                elif ((flags & AFTER_CDS) and coding and (strand == "-")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+                elif ((flags & BEFORE_CDS) and coding and (strand == "-")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+                elif (flags & IN_PROMOTER):
+                    cpg = data['cpg']
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + cpg
+                        self.promoter_count = self.promoter_count + 1
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+                if (region != ''):
+                    info.append(names + region)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+            record.appendInfo(";".join(info))
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        else:
+            record.appendInfo("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [ExonsEtAlStage(format=format, table=table,
+            promoter_offset=promoter_offset)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+class TfbsConsSitesStage(IntervalStage):
+    allowed_chrom = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
+    columns = 'chrom, chromStart, chromEnd, name'
+
+    def __init__(self, format='vcf', table='tfbsConsSites', use_index=False,
+        coverage=None, batch_size=1):
+        IntervalStage.__init__(self, format=format, table=table,
+            use_index=use_index, coverage=coverage, batch_size=batch_size)
+        self.label = 'addOverlapWithTfbsConsSites'
+
+    """Chromosomes without a tfbsConsSites table are left untouched
+    """
+    def getRegion(self, record):
+        chr, pos = IntervalStage.getRegion(self, record)
+        if (chr.replace('chr', '') in self.allowed_chrom):
+            return chr, pos
+        return None
+
+    # There is one table per chromosome, with no chrom column to filter on
+    def getTable(self, chr):
+        return self.table + chr.replace('chr', '')
+
+    def getChrom(self, chr):
+        return None
+
+    def inSnapshot(self):
+        return (self.snapshot is not None) and all([self.snapshot.has(
+            self.table + chrom) for chrom in self.allowed_chrom])
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+
+            record.addInfo(';'.join(records))
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
 
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [TfbsConsSitesStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with GadAll table
 """
+class GadAllStage(IntervalStage):
+    chromName = 'chromosome'
+
+    # For some reason this table has no "chr" preceeding number
+    def getRegion(self, record):
+        return record.chrom, record.pos
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+            record.addInfo(';'.join(records))
+
+            # Annotated records have always been written out joined with
+            # '\t ', so every column after CHROM carries a leading space
+            record.sep = record.sep + ' '
+
+
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [GadAllStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""INFO fragment a gwasCatalog row adds: its pubMedID and trait
+"""
+def gwasCatalogFragment(table, row):
+    return str(table) + '=' + str('pubMedID') + '=' + str(row[5]) + \
+        ',trait=' + str(row[10])
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+""" Overlap with gwasCatalog table
+    Variants match on chromEnd = pos only, so when the snapshot has the
+    exact-position index of the table (see gwascatalog.py) they are
+    answered from it, with the fragments already rendered. Otherwise
+    batch_size positions are looked up per query.
+"""
+class GwasCatalogStage(OverlapStage):
+
+    def __init__(self, format='vcf', table='gwasCatalog', coverage=None,
+        batch_size=1):
+        OverlapStage.__init__(self, format=format, table=table,
+            coverage=coverage)
+        self.label = 'GwasCatalog'
+        self.batch_size = batch_size
+
+    """Fragments of the rows found for the record
+    """
+    def lookup(self, record):
+        return [gwasCatalogFragment(self.table, row) for row in \
+            self.backend.pointLookup(self.cursor, self.table,
+                [('chrom', record.chr), ('chromEnd', record.pos)])]
+
+    def lookupCovered(self, records):
+        if not (self.inSnapshot() or (self.batch_size > 1)):
+            return OverlapStage.lookupCovered(self, records)
+
+        results = {}
+        byChrom = {}
+        for record in records:
+            byChrom.setdefault(record.chr, []).append(record)
+
+        for chr, variants in byChrom.items():
+            positions = [record.pos for record in variants]
+            if self.inSnapshot():
+                found = self.snapshot.gwasCatalog().lookup(chr, positions)
+            else:
+                found = self.lookupPositions(chr, positions)
+            for record, fragments in zip(variants, found):
+                results[id(record)] = fragments
+
+        return [results[id(record)] for record in records]
+
+    """Fragments of each position of chr, with one query per block of
+       batch_size distinct positions
+    """
+    def lookupPositions(self, chr, positions):
+        byPos = {}
+        distinct = sorted(set(positions))
+        for b in range(0, len(distinct), self.batch_size):
+            rows = self.backend.pointLookup(self.cursor, self.table,
+                [('chrom', chr), ('chromEnd', distinct[b:b + self.batch_size])],
+                columns='chromEnd, ' + self.table + '.*')
+            for row in rows:
+                byPos.setdefault(int(row[0]), []).append(
+                    gwasCatalogFragment(self.table, row[1:]))
+        return [byPos.get(pos, []) for pos in positions]
+
+    def inSnapshot(self):
+        return (self.snapshot is not None) and \
+            self.snapshot.has('gwasIndex') and \
+            self.snapshot.gwasCatalog().matches(self.table)
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(rows)
+            record.addInfo(';'.join(rows))
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [GwasCatalogStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HugoStage(IntervalStage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='hugo', use_index=False,
+        coverage=None, batch_size=1):
+        IntervalStage.__init__(self, format=format, table=table,
+            use_index=use_index, coverage=coverage, batch_size=batch_size)
+        self.label = 'HUGO Gene Nomenclature Committee'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            records_str = ','.join(records).replace(';', ',')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            record.addInfo(records_str)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [HugoStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class GenomicSuperDupsStage(IntervalStage):
+    fetchOne = True
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[0][7]
+            otherStart = rows[0][8]
+            otherEnd = rows[0][9]
+            record.appendInfo(str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [GenomicSuperDupsStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneStage(IntervalStage):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1490,141 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+    """Without an in-memory index, the transcripts come from the job's
+       genefetch.GeneFetch, shared with the gene location stages
+    """
+    def lookupCovered(self, records):
+        if self.use_index or self.inSnapshot() or (self.fetch is None):
+            return IntervalStage.lookupCovered(self, records)
+
+        results = {}
+        byChrom = {}
+        for record in records:
+            region = self.getRegion(record)
+            byChrom.setdefault(region[0], []).append((record, region[1]))
+
+        for chr, variants in byChrom.items():
+            found = self.fetch.transcripts(self.backend, self.cursor,
+                self.getTable(chr), self.getChrom(chr),
+                [pos for record, pos in variants])
+            for (record, pos), rows in zip(variants, found):
+                results[id(record)] = rows[:1] if self.fetchOne else rows
+
+        return [results[id(record)] for record in records]
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            overlapsWith = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
+
+            genes = ';'.join([str(x) for x in overlapsWith])
+            record.addInfo(str(genes))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [RefGeneStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+class CytobandStage(IntervalStage):
+
+    def __init__(self, format='vcf', table='cytoBand', use_index=False,
+        coverage=None, batch_size=1):
+        IntervalStage.__init__(self, format=format, table=table,
+            use_index=use_index, coverage=coverage, batch_size=batch_size)
+        self.label = 'Cytoband'
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            overlapsWith = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            record.addInfo(str(self.table) + '=' + str(cytoband))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [CytobandStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class CnvDatabaseStage(IntervalStage):
+    fetchOne = True
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            record.addInfo(str(self.table) + '=' + str(isOverlap))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [CnvDatabaseStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(IntervalStage):
+    fetchOne = True
+
+    def __init__(self, format='vcf', table='targetScanS', use_index=False,
+        coverage=None, batch_size=1):
+        IntervalStage.__init__(self, format=format, table=table,
+            use_index=use_index, coverage=coverage, batch_size=batch_size)
+        self.label = 'miRNA'
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            row = rows[0]
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            t = 'miRNAsites=' + t.strip()
+            record.addInfo(t)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    annotateFile(vcf + tmpextin, vcf + tmpextout,
+        [MiRNAStage(format=format, table=table)],
+        logcountfile=vcf + '.count.log', format=format, sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -3,6 +3,13 @@ import os
 import boto3
 import json
 import configparser
+import time
+import threading
+import multiprocessing
+import shutil
+import s3_transfer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 # Path variables that are used in different services
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,13 +21,30 @@ REGION = "us-east-1"
 # Load the .ini file
 try:
     config = configparser.ConfigParser()
-    config.read('ann_config.ini')
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'ann_config.ini'))
 except Exception as e:
    print(f"Error when trying to load 'ann_config.ini' file. Message: {e}")
 
 # Get variables from .ini file
 try:
     sqs_url = config.get('aws', 'SQS_URL')
+    # Premium jobs have a queue of their own; without it every job goes
+    # through SQS_URL
+    sqs_premium_url = config.get('aws', 'SQS_PREMIUM_URL', fallback='')
+    premium_weight = config.getint('annotator', 'PREMIUM_WEIGHT', fallback=3)
+    free_weight = config.getint('annotator', 'FREE_WEIGHT', fallback=1)
+    # Small inputs have a queue and workers of their own
+    sqs_fast_url = config.get('aws', 'SQS_FAST_URL', fallback='')
+    fast_pool_size = config.getint('annotator', 'FAST_POOL_SIZE', fallback=2)
+    # "pool" runs jobs in pre-warmed worker processes, "subprocess" starts
+    # a new run.py for every job
+    worker_mode = config.get('annotator', 'WORKER_MODE', fallback='pool')
+    pool_size = config.getint('annotator', 'POOL_SIZE', fallback=0)
+    job_memory_mb = config.getint('annotator', 'JOB_MEMORY_MB', fallback=2048)
+    visibility_timeout = config.getint('annotator', 'VISIBILITY_TIMEOUT', fallback=300)
+    heartbeat_seconds = config.getint('annotator', 'HEARTBEAT_SECONDS', fallback=60)
+    streaming = config.getboolean('annotator', 'STREAMING', fallback=False)
 except Exception as e:
     print(f"Error when trying to get variables from 'ann_config.ini' file. Message: {e}")
 
@@ -40,107 +64,594 @@ def create_client(service_type="s3", region="us-east-1"):
 
 S3_CLIENT = create_client(service_type="s3", region=REGION)
 
-# Create a SQS Queue object
-# sqs_url = "https://sqs.us-east-1.amazonaws.com/659248683008/josemaria_job_requests"
-queue = boto3.resource("sqs", region_name = "us-east-1").Queue(sqs_url)
 
-while True:
-    messages = queue.receive_messages(WaitTimeSeconds=10)
+def warm_worker():
+    """
+    Initializer of the pool's worker processes. Importing run.py sets up
+    the pipeline modules and AWS clients once; warm() then opens the
+    reference database connection and the variant cache, all of which
+    are reused by every job the worker runs.
+    """
+
+    import run
+    run.warm()
+
+
+def annotate_job(file_path):
+    """
+    Runs the annotation of a downloaded input inside a pool worker.
+
+    Inputs:
+        file_path (`str`): path of the input file in its job directory.
+
+    Returns (`bool`): True once the job's results are uploaded.
+    """
+
+    import run
+    return run.run_job(file_path)
+
+
+def annotate_stream_job(bucket, key, user_id, job_id, file_name):
+    """
+    Runs the annotation of an input streamed from S3 inside a pool worker.
+
+    Inputs:
+        bucket (`str`): bucket of the input file.
+        key (`str`): key of the input file.
+        user_id (`str`): owner of the job.
+        job_id (`str`): id of the job.
+        file_name (`str`): name of the input file.
+
+    Returns (`bool`): True once the job's results are uploaded.
+    """
+
+    import run
+    return run.run_stream_job(bucket, key, user_id, job_id, file_name)
+
+
+def report_job(job_id):
+    """
+    Returns a callback printing how a pool job finished.
+    """
+
+    def done(future):
+        if future.exception() is not None:
+            print({"code": 500,
+                   "error": f"Error running annotation job '{job_id}'.",
+                   "message": str(future.exception())})
+        elif not future.result():
+            print(f"Results of annotation job '{job_id}' were not uploaded.")
+        else:
+            print(f"Finished annotation job '{job_id}'.")
+    return done
+
+
+def job_done(job):
+    """
+    Whether a job started by handle_message() has finished.
+    """
+
+    if isinstance(job, subprocess.Popen):
+        return job.poll() is not None
+    return job.done()
+
+
+def job_succeeded(job):
+    """
+    Whether a finished job uploaded its results: run.py exits with 0, and
+    run_job() returns True, only once they are.
+    """
+
+    if isinstance(job, subprocess.Popen):
+        return job.returncode == 0
+    return (job.exception() is None) and (job.result() is True)
+
+
+def default_pool_size():
+    """
+    Number of jobs the instance can run at the same time: one per core,
+    as long as each can have JOB_MEMORY_MB of memory.
+    """
+
+    cores = os.cpu_count() or 1
+    try:
+        memory_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+        return max(1, min(cores, memory_mb // job_memory_mb))
+    except (ValueError, OSError):
+        return cores
+
+
+def message_batches(messages):
+    """
+    Splits messages in batches of up to 10 from the same queue, the most
+    a batch request to SQS takes.
+
+    Returns (`list`): (queue url, messages) pairs.
+    """
 
+    queues = {}
     for message in messages:
-        body = json.loads(message.body)
-        message_str = body["Message"]
-        print("Message: ", message_str)
-
-        if message_str:
-            # Convert single quotes in message string to double quotes
-            # so we can transform to a dict
-            message_str = message_str.replace("'", "\"")
-            try:
-                message_dict = json.loads(message_str)
-                bucket = message_dict["s3_inputs_bucket"]
-                key = message_dict["s3_key_input_file"]
-                job_id = message_dict["job_id"]
-                file_name = message_dict["input_file_name"]
-                user_id = message_dict["user_id"]
-            except Exception as e:
+        queues.setdefault(message.queue_url, []).append(message)
+    return [(url, batch[i:i + 10]) for url, batch in queues.items()
+            for i in range(0, len(batch), 10)]
+
+
+def delete_messages(sqs, messages):
+    """
+    Deletes messages from their queues, up to 10 per request.
+
+    Inputs:
+        sqs (`Client`): SQS client.
+        messages (`list`): SQS messages of the jobs whose results are uploaded.
+    """
+
+    for url, batch in message_batches(messages):
+        entries = [{"Id": str(n), "ReceiptHandle": m.receipt_handle}
+                   for n, m in enumerate(batch)]
+        try:
+            response = sqs.delete_message_batch(QueueUrl=url, Entries=entries)
+            for failed in response.get("Failed", []):
                 print({"code": 500,
-                "error": f"Error converting message to dictionary and/or extracting keys.",
-                "message": str(e)})
+                       "error": "Error deleting message from queue.",
+                       "message": str(failed)})
+        except Exception as e:
+            print({"code": 500,
+                   "error": "Error deleting messages from queue.",
+                   "message": str(e)})
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keeps the messages of running jobs invisible on the queue: every
+    HEARTBEAT_SECONDS their visibility timeout is set back to
+    VISIBILITY_TIMEOUT. If the instance or a worker dies, the heartbeat
+    stops and SQS hands the job to another consumer.
+    """
 
-            # Create "job_id" directory if it doesn't exist
-            if "job_id" not in os.listdir(CURRENT_DIR):
+    def __init__(self, sqs, running, lock):
+        threading.Thread.__init__(self, daemon=True)
+        self.sqs = sqs
+        self.running = running
+        self.lock = lock
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(heartbeat_seconds):
+            with self.lock:
+                messages = list(self.running.values())
+            for url, batch in message_batches(messages):
+                entries = [{"Id": str(n), "ReceiptHandle": m.receipt_handle,
+                            "VisibilityTimeout": visibility_timeout}
+                           for n, m in enumerate(batch)]
                 try:
-                    os.mkdir(JOB_ID_DIR)
+                    self.sqs.change_message_visibility_batch(QueueUrl=url,
+                        Entries=entries)
                 except Exception as e:
                     print({"code": 500,
-                            "error":
-                            f"Error trying to create 'job_id' directory with path \
-                                '{JOB_ID_DIR}'.",
-                            "message": str(e)})         
-            
-            # We create a directory for the job_id inside the "job_id" directory
-            job_id_path = os.path.join(JOB_ID_DIR, user_id, job_id)
-            try:
-                os.makedirs(job_id_path)
-            except Exception as e:
-                print({"code": 500,
-                            "error":
-                            f"Error trying to create '{job_id}' directory with path \
-                                '{job_id_path}'.",
-                            "message": str(e)})
-
-            # Download s3 file object to instance's directory
-            file_path = os.path.join(job_id_path, file_name)
-            try:
-                with open(file_path, 'wb') as f:
-                    S3_CLIENT.download_fileobj(bucket, key, f)
-            except Exception as e:
-                print({"code": 500,
-                            "error":
-                            f"Error downloading file to local instance's path \
-                                '{file_path}'.",
-                            "message": str(e)})
-                
-            # Run subprocess to run annotation
-            try:
-                run_file = "run.py"
-                job = subprocess.Popen(["python", run_file, file_path], cwd = CURRENT_DIR)
-                print(f"Launched annotation job '{job_id}'.")
-                message.delete()
-                print("Deleted message.")
-            except Exception as e:
-                code = 500
-                result = {"code": code, "error": "Error running subprocess with Popen.",
-                          "run_file": run_file,
-                          "file_path": file_path,
-                          "message": str(e)}
-                print(result, code, {"Status code": code})
-
-            # Update job status to 'RUNNING' only if it was 'PENDING' before
-            try:
-                dynamo = boto3.resource('dynamodb')
-                table_name = "josemaria_annotations"
-                table = dynamo.Table(table_name)
-            except Exception as e:
-                print({"code": 500,
-                       "error": f"Error trying to create dynamo table '{table_name}'.",
-                       "message": str(e)})
-            
-            job_status = "RUNNING"
-            update_expression = 'SET job_status = :new_status'
-            condition_expression = 'job_status = :pending'
-            expression_attribute_values = {':new_status': job_status, ':pending': 'PENDING'}
-            key = {"job_id": job_id}
-
-            try:
-                response = table.update_item(
-                    Key=key,
-                    UpdateExpression=update_expression,
-                    ConditionExpression=condition_expression,
-                    ExpressionAttributeValues=expression_attribute_values
-                    )
-            except Exception as e:
-                print(f"Error when trying to update Dynamo DB object. Message: {e}")
-    
-    print("Done with loop\n")
\ No newline at end of file
+                           "error": "Error extending message visibility.",
+                           "message": str(e)})
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Lane(object):
+    """
+    A queue of job requests and the share of worker slots it gets.
+    """
+
+    def __init__(self, name, url, weight):
+        self.name = name
+        self.url = url
+        self.weight = max(1, weight)
+        self.credit = 0
+        self.queue = boto3.resource("sqs", region_name = REGION).Queue(url)
+
+
+def create_lanes():
+    """
+    Lanes jobs are taken from, premium first.
+
+    Returns (`list`): the premium and free lanes, or a single lane for
+        SQS_URL when there is no premium queue.
+    """
+
+    if not sqs_premium_url:
+        return [Lane("all", sqs_url, 1)]
+    return [Lane("premium", sqs_premium_url, premium_weight),
+            Lane("free", sqs_url, free_weight)]
+
+
+def share_slots(lanes, slots):
+    """
+    Shares free worker slots among lanes by smooth weighted round robin:
+    with weights 3:1 a run of slots goes premium, premium, free, premium,
+    and so on. Credits carry over between calls, so over time every lane
+    gets its share even when only one slot frees up at a time.
+
+    Inputs:
+        lanes (`list`): lanes to share the slots among.
+        slots (`int`): free worker slots.
+
+    Returns (`list`): number of slots of each lane.
+    """
+
+    total = sum([lane.weight for lane in lanes])
+    shares = [0 for lane in lanes]
+    for i in range(slots):
+        for lane in lanes:
+            lane.credit += lane.weight
+        n = max(range(len(lanes)), key=lambda n: lanes[n].credit)
+        lanes[n].credit -= total
+        shares[n] += 1
+    return shares
+
+
+class WorkerGroup(object):
+    """
+    Worker slots and the lanes that feed them. Every group has its own
+    pool, so its jobs never wait for slots taken by another group's.
+    """
+
+    def __init__(self, name, size, lanes):
+        self.name = name
+        self.size = size
+        self.lanes = lanes
+        self.jobs = set()
+        self.pool = None
+        if worker_mode == "pool":
+            self.pool = self.new_pool()
+
+    def new_pool(self):
+        # Workers are started fresh rather than forked, so they do not
+        # share the parent's AWS connections
+        return ProcessPoolExecutor(max_workers=self.size,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_worker)
+
+    def restart_pool(self):
+        """
+        Replaces a pool that broke when one of its workers died. The jobs
+        it was running have failed with it, so their messages come back
+        once their visibility times out.
+        """
+
+        print(f"Restarting the {self.name} worker pool.")
+        self.pool.shutdown(wait=False)
+        self.pool = self.new_pool()
+
+
+def create_groups():
+    """
+    Worker groups of the annotator: the fast lane of small inputs, when it
+    has a queue, and the premium and free lanes of everything else.
+
+    Returns (`list`): worker groups, fast lane first.
+    """
+
+    size = pool_size if pool_size > 0 else default_pool_size()
+    groups = [WorkerGroup("batch", size, create_lanes())]
+    if sqs_fast_url:
+        groups.insert(0, WorkerGroup("fast", fast_pool_size,
+            [Lane("fast", sqs_fast_url, 1)]))
+    return groups
+
+
+def receive_messages(lanes, free, wait_time=10):
+    """
+    Receives up to free job requests, shared among lanes by weight. Slots
+    a lane leaves unused go to the others, so a lane with nothing waiting
+    does not hold back the rest; when every lane is empty the first one
+    is long polled.
+
+    Inputs:
+        lanes (`list`): lanes to receive from.
+        free (`int`): free worker slots.
+        wait_time (`int`): seconds to long poll for.
+
+    Returns (`list`): SQS messages received.
+    """
+
+    def receive(lane, count, wait_time):
+        return lane.queue.receive_messages(MaxNumberOfMessages=min(10, count),
+            WaitTimeSeconds=wait_time, VisibilityTimeout=visibility_timeout)
+
+    # Lanes that may have more waiting: those that got no slots, or
+    # filled all of theirs
+    messages = []
+    busy = []
+    for lane, share in zip(lanes, share_slots(lanes, free)):
+        if (share == 0):
+            busy.append(lane)
+            continue
+        received = receive(lane, share, 0)
+        messages += received
+        if (len(received) == min(10, share)):
+            busy.append(lane)
+
+    for lane in busy:
+        if (len(messages) < free):
+            messages += receive(lane, free - len(messages), 0)
+
+    if (len(messages) == 0):
+        messages = receive(lanes[0], free, wait_time)
+    return messages
+
+
+def start_job(bucket, key, user_id, job_id, file_name, pool=None):
+    """
+    Downloads the input of a job to its job directory and starts its
+    annotation.
+
+    Returns: the running job, a `Future` or a `Popen`, or None if it could
+        not be started.
+
+    Raises `BrokenProcessPool` when pool can no longer run jobs; the job
+    directory is removed first.
+    """
+
+    # Create "job_id" directory if it doesn't exist
+    if "job_id" not in os.listdir(CURRENT_DIR):
+        try:
+            os.mkdir(JOB_ID_DIR)
+        except Exception as e:
+            print({"code": 500,
+                    "error":
+                    f"Error trying to create 'job_id' directory with path \
+                        '{JOB_ID_DIR}'.",
+                    "message": str(e)})         
+
+    # We create a directory for the job_id inside the "job_id" directory
+    job_id_path = os.path.join(JOB_ID_DIR, user_id, job_id)
+    try:
+        os.makedirs(job_id_path)
+    except Exception as e:
+        print({"code": 500,
+                    "error":
+                    f"Error trying to create '{job_id}' directory with path \
+                        '{job_id_path}'.",
+                    "message": str(e)})
+
+    # Download s3 file object to instance's directory
+    file_path = os.path.join(job_id_path, file_name)
+    try:
+        s3_transfer.download_file(S3_CLIENT, bucket, key, file_path)
+    except Exception as e:
+        print({"code": 500,
+                    "error":
+                    f"Error downloading file to local instance's path \
+                        '{file_path}'.",
+                    "message": str(e)})
+        # Left on the queue, to be received again after its visibility
+        # timeout
+        shutil.rmtree(job_id_path, ignore_errors=True)
+        return None
+
+    # Run the annotation in a pool worker, or in a subprocess
+    run_file = "run.py"
+    try:
+        if pool is not None:
+            job = pool.submit(annotate_job, file_path)
+            job.add_done_callback(report_job(job_id))
+        else:
+            job = subprocess.Popen(["python", run_file, file_path], cwd = CURRENT_DIR)
+        print(f"Launched annotation job '{job_id}'.")
+    except BrokenProcessPool:
+        shutil.rmtree(job_id_path, ignore_errors=True)
+        raise
+    except Exception as e:
+        code = 500
+        result = {"code": code, "error": "Error launching annotation job.",
+                  "run_file": run_file,
+                  "file_path": file_path,
+                  "message": str(e)}
+        print(result, code, {"Status code": code})
+        shutil.rmtree(job_id_path, ignore_errors=True)
+        return None
+
+    return job
+
+
+def start_stream_job(bucket, key, user_id, job_id, file_name, pool=None):
+    """
+    Starts the annotation of an input that is read straight from S3, with
+    its results written back without local files.
+
+    Returns: the running job, a `Future` or a `Popen`, or None if it could
+        not be started.
+
+    Raises `BrokenProcessPool` when pool can no longer run jobs.
+    """
+
+    try:
+        if pool is not None:
+            job = pool.submit(annotate_stream_job, bucket, key, user_id,
+                job_id, file_name)
+            job.add_done_callback(report_job(job_id))
+        else:
+            job = subprocess.Popen(["python", "run.py", "--stream", bucket,
+                key, user_id, job_id, file_name], cwd = CURRENT_DIR)
+        print(f"Launched annotation job '{job_id}'.")
+    except BrokenProcessPool:
+        raise
+    except Exception as e:
+        print({"code": 500, "error": "Error launching annotation job.",
+               "s3_key_input_file": key,
+               "message": str(e)})
+        return None
+
+    return job
+
+
+def handle_message(message, pool=None):
+    """
+    Downloads the input of a job request and starts its annotation. The
+    message is not deleted here: that happens once the job's results are
+    uploaded. Requests that can never be run are deleted right away.
+
+    Inputs:
+        message (`Message`): SQS message with the job request.
+        pool (`ProcessPoolExecutor`): worker pool to run the job in; when
+            None the job runs in a run.py subprocess.
+
+    Returns: the running job, a `Future` or a `Popen`, or None if no job
+        was started.
+
+    Raises `BrokenProcessPool` when pool can no longer run jobs.
+    """
+
+    try:
+        body = json.loads(message.body)
+        message_str = body["Message"]
+    except Exception as e:
+        message_str = None
+    print("Message: ", message_str)
+
+    if not message_str:
+        print("Deleting message without a job request.")
+        message.delete()
+        return None
+
+    if message_str:
+        # Convert single quotes in message string to double quotes
+        # so we can transform to a dict
+        message_str = message_str.replace("'", "\"")
+        try:
+            message_dict = json.loads(message_str)
+            bucket = message_dict["s3_inputs_bucket"]
+            key = message_dict["s3_key_input_file"]
+            job_id = message_dict["job_id"]
+            file_name = message_dict["input_file_name"]
+            user_id = message_dict["user_id"]
+        except Exception as e:
+            print({"code": 500,
+            "error": f"Error converting message to dictionary and/or extracting keys.",
+            "message": str(e)})
+            message.delete()
+            return None
+
+        # In streaming mode the input is read straight from S3
+        if streaming:
+            job = start_stream_job(bucket, key, user_id, job_id, file_name, pool)
+        else:
+            job = start_job(bucket, key, user_id, job_id, file_name, pool)
+        if job is None:
+            return None
+
+        # Update job status to 'RUNNING' only if it was 'PENDING' before
+        try:
+            dynamo = boto3.resource('dynamodb')
+            table_name = "josemaria_annotations"
+            table = dynamo.Table(table_name)
+        except Exception as e:
+            print({"code": 500,
+                   "error": f"Error trying to create dynamo table '{table_name}'.",
+                   "message": str(e)})
+        
+        job_status = "RUNNING"
+        update_expression = 'SET job_status = :new_status'
+        condition_expression = 'job_status = :pending'
+        expression_attribute_values = {':new_status': job_status, ':pending': 'PENDING'}
+        key = {"job_id": job_id}
+
+        try:
+            response = table.update_item(
+                Key=key,
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues=expression_attribute_values
+                )
+        except Exception as e:
+            print(f"Error when trying to update Dynamo DB object. Message: {e}")
+
+        return job
+
+
+def run_message(group, message):
+    """
+    Starts the job of a message in the workers of a group. A pool that
+    broke is replaced, and the job started once more in the new one.
+
+    Inputs:
+        group (`WorkerGroup`): group to run the job in.
+        message (`Message`): SQS message with the job request.
+
+    Returns: the running job, or None if no job was started.
+    """
+
+    try:
+        return handle_message(message, group.pool)
+    except BrokenProcessPool as e:
+        print({"code": 500,
+               "error": f"The {group.name} worker pool is broken.",
+               "message": str(e)})
+        group.restart_pool()
+
+    try:
+        return handle_message(message, group.pool)
+    except BrokenProcessPool as e:
+        # Left on the queue, to be received again after its visibility
+        # timeout
+        print({"code": 500,
+               "error": f"The {group.name} worker pool broke again.",
+               "message": str(e)})
+        return None
+
+
+def main():
+    # Create the SQS Queue objects of the fast, premium and free lanes
+    # sqs_url = "https://sqs.us-east-1.amazonaws.com/659248683008/josemaria_job_requests"
+    groups = create_groups()
+    sqs = create_client(service_type="sqs", region=REGION)
+
+    for group in groups:
+        print(f"Running up to {group.size} {group.name} annotation jobs at a time.")
+
+    # Long polls are kept short when several groups take turns to receive
+    wait_time = 10 if (len(groups) == 1) else 2
+
+    # Running jobs and the messages they came from
+    running = {}
+    lock = threading.Lock()
+    heartbeat = Heartbeat(sqs, running, lock)
+    heartbeat.start()
+
+    while True:
+        # Messages are only deleted once their job's results are uploaded;
+        # those of failed jobs come back when their visibility times out
+        with lock:
+            finished = [job for job in running if job_done(job)]
+            messages = [running.pop(job) for job in finished]
+        for group in groups:
+            group.jobs.difference_update(finished)
+        delete_messages(sqs, [m for job, m in zip(finished, messages)
+                              if job_succeeded(job)])
+
+        # Only take as many messages as each group has free workers, shared
+        # among its lanes by weight
+        full = True
+        for group in groups:
+            free = group.size - len(group.jobs)
+            if free <= 0:
+                continue
+            full = False
+
+            for message in receive_messages(group.lanes, free, wait_time):
+                job = run_message(group, message)
+                if job is not None:
+                    group.jobs.add(job)
+                    with lock:
+                        running[job] = message
+
+        if full:
+            if worker_mode == "pool":
+                wait(list(running), timeout=heartbeat_seconds,
+                     return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(1)
+
+        print("Done with loop\n")
+
+
+if __name__ == "__main__":
+    main()
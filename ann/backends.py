@@ -0,0 +1,239 @@
+# backends.py
+#
+# Reference databases the annotation stages query
+#
+##
+
+import sqlite3
+from contextlib import contextmanager
+
+import pymysql
+
+import utils as u
+import load_reference
+
+"""Interface to a copy of the annotator reference tables
+   Stages do not build SQL themselves: they call the typed queries below
+   on a cursor of a connection taken from connection(). Values are always
+   passed as query parameters; table and column names come from the
+   stages and are never user input. Subclasses only differ in how they
+   connect and in the parameter placeholder of their DB-API driver.
+   Every query returns its rows in the order of orderBy(): the order the
+   database reads them in anyway, made explicit, so the snapshots,
+   indexes and batched reads built from a table put its rows in the same
+   order as the per-variant queries.
+"""
+class ReferenceBackend(object):
+    name = None
+    placeholder = '%s'
+    # Column giving the order rows with the same index key are stored
+    # in, or None where the database has none to name
+    rowOrder = None
+
+    def __init__(self):
+        self.columns = {}
+        self.orders = {}
+
+    """Context manager yielding a DB-API connection
+    """
+    def connection(self):
+        raise NotImplementedError
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    """Cursor for reading a whole table, handing rows over as the
+       database sends them rather than once all are read
+    """
+    def scanCursor(self, conn):
+        return conn.cursor()
+
+    """Builds "column = value AND ..." for a list of (column, value) keys;
+       a list or tuple value matches any of its elements
+    """
+    def conditions(self, keys):
+        where = []
+        params = []
+        for column, value in keys:
+            if isinstance(value, (list, tuple)):
+                where.append(column + ' in (' + \
+                    ','.join([self.placeholder] * len(value)) + ')')
+                params.extend(value)
+            else:
+                where.append(column + ' = ' + self.placeholder)
+                params.append(value)
+        return ' AND '.join(where), params
+
+    """Columns of table, read once per backend on a cursor of their own,
+       so the query counts of the stages do not include it
+    """
+    def tableColumns(self, cursor, table):
+        if table not in self.columns:
+            probe = cursor.connection.cursor()
+            probe.execute('select * from ' + table + ' limit 0')
+            self.columns[table] = [d[0] for d in probe.description]
+            probe.fetchall()
+            probe.close()
+        return self.columns[table]
+
+    """ORDER BY clause of a query of table on the given columns, in the
+       order they are compared on, ranges last
+       The rows are ordered on the load_reference.py index the query can
+       use the most columns of, then rowOrder, which is how the index
+       keeps them already, so the database does not sort them. Queries
+       always read a single chromosome, by its column or from a table
+       holding one, so the chromosome column counts as compared on. A
+       query no index helps reads the table in the order it is stored
+       in, which only rowOrder can name.
+    """
+    def orderBy(self, cursor, table, keys):
+        key = (table, tuple(keys))
+        if key not in self.orders:
+            best = 0
+            order = []
+            for index in load_reference.index_columns(table,
+                self.tableColumns(cursor, table)):
+                used = 0
+                while (used < len(index)) and ((index[used] in keys) or \
+                    (index[used] in load_reference.CHROM_COLUMNS)):
+                    used = used + 1
+                if (used > best):
+                    best = used
+                    order = list(index)
+            if self.rowOrder is not None:
+                order = order + [self.rowOrder]
+            self.orders[key] = '' if (len(order) == 0) else \
+                ' order by ' + ', '.join([table + '.' + c for c in order])
+        return self.orders[key]
+
+    def fetch(self, cursor, sql, params, first=False):
+        cursor.execute(sql, params)
+        if first:
+            row = cursor.fetchone()
+            return [row] if row is not None else []
+        return list(cursor.fetchall())
+
+    """Rows of table whose key columns equal the given values
+       order names the columns of another lookup to return the rows in
+       the order of, by default those of keys.
+    """
+    def pointLookup(self, cursor, table, keys, columns='*', first=False,
+        order=None):
+
+        where, params = self.conditions(keys)
+        if order is None:
+            order = [column for column, value in keys]
+        sql = 'select ' + columns + ' from ' + table + ' where ' + where + \
+            self.orderBy(cursor, table, order)
+        return self.fetch(cursor, sql, params, first=first)
+
+    """Rows of table whose [start, end] region contains pos
+       chrom is None for tables that hold a single chromosome.
+    """
+    def overlap(self, cursor, table, chrom, pos, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns='*',
+        first=False):
+
+        keys = []
+        if chrom is not None:
+            keys.append((chromName, chrom))
+        where, params = self.conditions(keys)
+        if (where != ''):
+            where = where + ' AND '
+
+        sql = 'select ' + columns + ' from ' + table + ' where ' + where + \
+            '(' + startName + ' <= ' + self.placeholder + ' AND ' + \
+            self.placeholder + ' <= ' + endName + ')' + \
+            self.orderBy(cursor, table, [k[0] for k in keys] + [startName])
+        return self.fetch(cursor, sql, params + [pos, pos], first=first)
+
+    """Every region of one chromosome of table, as rows of
+       (start, end, <columns>...), to build an in-memory index from
+       span, a (first, last) pair, keeps only the regions overlapping it.
+    """
+    def regions(self, cursor, table, chrom, chromName='chrom',
+        startName='chromStart', endName='chromEnd', columns='*', span=None):
+
+        if (columns == '*'):
+            columns = table + '.*'
+        sql = 'select ' + startName + ', ' + endName + ', ' + columns + \
+            ' from ' + table
+        where = []
+        params = []
+        keys = []
+        if chrom is not None:
+            where, params = self.conditions([(chromName, chrom)])
+            where = [where]
+            keys.append(chromName)
+        if span is not None:
+            where.append('(' + startName + ' <= ' + self.placeholder + \
+                ' AND ' + self.placeholder + ' <= ' + endName + ')')
+            params = params + [span[1], span[0]]
+            keys.append(startName)
+        if (len(where) > 0):
+            sql = sql + ' where ' + ' AND '.join(where)
+        return self.fetch(cursor, sql + self.orderBy(cursor, table, keys),
+            params)
+
+    """Transcripts of a refGene-like table on chrom whose span, widened by
+       offset on both sides, contains pos
+    """
+    def geneModels(self, cursor, table, chrom, pos, offset=0):
+        p = self.placeholder
+        sql = 'select * from ' + table + ' where chrom = ' + p + \
+            ' AND (txStart - ' + p + ') <= ' + p + \
+            ' AND ' + p + ' <= (txEnd + ' + p + ')' + \
+            self.orderBy(cursor, table, ['chrom'])
+        return self.fetch(cursor, sql, [chrom, offset, pos, pos, offset])
+
+
+"""The annotator MySQL database on RDS, through the connection pool
+"""
+class MySQLBackend(ReferenceBackend):
+    name = 'mysql'
+    placeholder = '%s'
+
+    @contextmanager
+    def connection(self):
+        with u.db_pool().connection() as conn:
+            yield conn
+
+    # The default cursor reads the whole result into memory first
+    def scanCursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""A local SQLite copy of the reference tables, built by load_reference.py
+   Text columns are created with NOCASE collation so string comparisons
+   match those of the MySQL database.
+"""
+class SQLiteBackend(ReferenceBackend):
+    name = 'sqlite'
+    placeholder = '?'
+    rowOrder = 'rowid'
+
+    def __init__(self, path):
+        ReferenceBackend.__init__(self)
+        self.path = path
+
+    @contextmanager
+    def connection(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+"""Returns the backend configured by name: mysql or sqlite
+"""
+def getBackend(name='mysql', path=None):
+    if (name == 'mysql'):
+        return MySQLBackend()
+    elif (name == 'sqlite'):
+        if not path:
+            raise ValueError("The sqlite reference backend needs a database path")
+        return SQLiteBackend(path)
+    raise ValueError(f"Unknown reference backend '{name}'")
+
+### EOF
@@ -0,0 +1,260 @@
+# bigrefgene.py
+#
+# Precomputed index of the three BigRefGene tables
+#
+# The BigRefGene stage looks a variant up in chrom_pos_equal_base by its
+# alleles, then in chrom_pos_equal_nobase by position, then in
+# chrom_pos_unequal by region, stopping at the first table with a match.
+# All three are kept in the reference snapshot (see snapshot.py) in
+# <path>/<version>/BigRefGene/, with the RefSeq annotation of every row
+# already collapsed to the string the stage writes:
+#
+#   <n>.base.key.npy      (position << 32) | allele pair code, sorted
+#   <n>.base.pair.npy     allele pair code of each row
+#   <n>.base.order.npy    row of each key, to keep the database order
+#   <n>.base.text.npy     collapsed annotation of each row, as a value code
+#   <n>.nobase.pos.npy    positions, sorted
+#   <n>.nobase.text.npy
+#   <n>.unequal.start.npy, .end.npy, .maxend.npy, .order.npy
+#                         region index, as for the snapshot tables
+#   <n>.unequal.text.npy  in database order
+#
+# An allele pair and its complement share the key of the smaller of the
+# two, so a variant is found under one key whichever strand its row was
+# written on. Allele pairs are interned in alleles.*, annotations in
+# values.*.
+#
+##
+
+import os
+
+import numpy as np
+
+import annotate as ann
+import intervals
+import snapshot
+
+TABLES = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase', 'chrom_pos_unequal']
+
+"""Text of an allele pair, compared without case as MySQL does
+"""
+def pairText(ref, alt):
+    return str(ref).upper() + '\t' + str(alt).upper()
+
+
+"""Text of the key shared by an allele pair and its complement
+"""
+def canonicalPair(ref, alt):
+    ref = str(ref).upper()
+    alt = str(alt).upper()
+    compRef = ann.getComplementary(ref)
+    compAlt = ann.getComplementary(alt)
+    if (compRef == '') or (compAlt == ''):
+        return pairText(ref, alt)
+    return min(pairText(ref, alt), pairText(compRef, compAlt))
+
+
+"""Value codes of a chromosome, read as their values
+"""
+class TextView(object):
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[int(self.codes[i])][0]
+
+
+"""The BigRefGene index of a snapshot, opened read-only
+"""
+class BigRefGeneIndex(object):
+
+    def __init__(self, path, chroms):
+        self.path = path
+        self.chroms = chroms
+        self.values = snapshot.readValues(path)
+        alleles = snapshot.readValues(path, 'alleles')
+        self.alleles = dict([(alleles[code][0], code) for code in range(len(alleles))])
+        self.arrays = {}
+
+    def load(self, n, name):
+        return np.load(os.path.join(self.path, str(n) + '.' + name + '.npy'),
+            mmap_mode='r')
+
+    """Arrays and region index of a chromosome, or None if it has no rows
+    """
+    def chromArrays(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.arrays:
+            n = snapshot.chromNumber(self.chroms, chrom)
+            arrays = None
+            if n is not None:
+                arrays = dict([(name, self.load(n, name)) for name in [
+                    'base.key', 'base.pair', 'base.order', 'base.text',
+                    'nobase.pos', 'nobase.text']])
+                arrays['unequal'] = intervals.fromSorted(
+                    self.load(n, 'unequal.start'), self.load(n, 'unequal.end'),
+                    self.load(n, 'unequal.maxend'), self.load(n, 'unequal.order'),
+                    TextView(self.load(n, 'unequal.text'), self.values))
+            self.arrays[chrom] = arrays
+        return self.arrays[chrom]
+
+    def alleleCode(self, text):
+        return self.alleles.get(text, -1)
+
+    """Collapsed annotations of chrom for each variant, given as lists
+       of positions, REF and ALT alleles
+       Like the stage's queries, each variant only falls through to the
+       next table when it has no match in the one before.
+    """
+    def lookup(self, chrom, positions, refs, alts):
+        results = [[] for p in positions]
+        a = self.chromArrays(chrom)
+        if (a is None) or (len(positions) == 0):
+            return results
+
+        # chrom_pos_equal_base: the variant's alleles and their complements
+        owner = []
+        keys = []
+        wanted = []
+        for i, (pos, ref, alt) in enumerate(zip(positions, refs, alts)):
+            compRef = ann.getComplementary(ref)
+            compAlt = ann.getComplementary(alt)
+            pairs = [self.alleleCode(pairText(ref, alt)),
+                self.alleleCode(pairText(compRef, compAlt))]
+            for text in set([canonicalPair(ref, alt),
+                canonicalPair(compRef, compAlt)]):
+                code = self.alleleCode(text)
+                if (code >= 0) and (0 <= pos < 2 ** 32):
+                    owner.append(i)
+                    keys.append((int(pos) << 32) | code)
+                    wanted.append(pairs)
+
+        if (len(keys) > 0):
+            query = np.array(keys, dtype=np.uint64)
+            lo = np.searchsorted(a['base.key'], query, side='left')
+            hi = np.searchsorted(a['base.key'], query, side='right')
+            counts = hi - lo
+            if (int(counts.sum()) > 0):
+                probe = np.repeat(np.arange(len(keys)), counts)
+                rows = np.arange(len(probe)) - \
+                    np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+                wanted = np.array(wanted, dtype=np.int64)
+                pair = a['base.pair'][rows]
+                match = (pair == wanted[probe, 0]) | (pair == wanted[probe, 1])
+
+                found = {}
+                for j in np.nonzero(match)[0].tolist():
+                    found.setdefault(owner[int(probe[j])], []).append(
+                        (int(a['base.order'][rows[j]]), int(a['base.text'][rows[j]])))
+                for i, hits in found.items():
+                    results[i] = [self.values[code][0] for order, code in sorted(hits)]
+
+        # chrom_pos_equal_nobase, then chrom_pos_unequal, for the misses
+        missing = [i for i in range(len(positions)) if len(results[i]) == 0]
+        if (len(missing) > 0):
+            query = np.array([positions[i] for i in missing], dtype=np.int64)
+            lo = np.searchsorted(a['nobase.pos'], query, side='left')
+            hi = np.searchsorted(a['nobase.pos'], query, side='right')
+            for i, l, h in zip(missing, lo.tolist(), hi.tolist()):
+                results[i] = [self.values[int(code)][0] \
+                    for code in a['nobase.text'][l:h]]
+
+        missing = [i for i in missing if len(results[i]) == 0]
+        if (len(missing) > 0):
+            hits = a['unequal'].query([positions[i] for i in missing])
+            for i, rows in zip(missing, hits):
+                results[i] = rows
+
+        return results
+
+
+"""Rows of one chromosome of table, in database order, as (start, end,
+   row); rows without a start can never match and are left out
+"""
+def chromRows(backend, cursor, table, chrom):
+    rows = backend.pointLookup(cursor, table, [('CHR', chrom)])
+    columns = [d[0] for d in cursor.description]
+    startCol = columns.index('start')
+    endCol = columns.index('end')
+    return [(int(row[startCol]), row[endCol], row) for row in rows \
+        if row[startCol] is not None]
+
+
+"""Writes the arrays of one chromosome
+"""
+def writeChrom(path, n, base, nobase, unequal, values, alleles):
+    def save(name, array):
+        np.save(os.path.join(path, str(n) + '.' + name + '.npy'), array)
+
+    unequal = [(start, int(end), row) for start, end, row in unequal \
+        if end is not None]
+    for start, end, row in base + nobase:
+        if not (0 <= start < 2 ** 32):
+            raise ValueError('BigRefGene positions do not fit in 32 bits')
+
+    # Column 4 and 5 are haplotypeReference and haplotypeAlternate
+    keys = np.array([(start << 32) | alleles.code(canonicalPair(row[4], row[5])) \
+        for start, end, row in base], dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    save('base.key', keys[order])
+    save('base.pair', np.array([alleles.code(pairText(row[4], row[5])) \
+        for start, end, row in base], dtype=np.uint32)[order])
+    save('base.order', order.astype(np.int64))
+    save('base.text', np.array([values.code(ann.collapseRefSeqRow(row)) \
+        for start, end, row in base], dtype=np.uint32)[order])
+
+    positions = np.array([start for start, end, row in nobase], dtype=np.int64)
+    order = np.argsort(positions, kind='stable')
+    save('nobase.pos', positions[order].astype(np.uint32))
+    save('nobase.text', np.array([values.code(ann.collapseRefSeqRow(row)) \
+        for start, end, row in nobase], dtype=np.uint32)[order])
+
+    starts = np.array([start for start, end, row in unequal], dtype=np.int64)
+    ends = np.array([end for start, end, row in unequal], dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    save('unequal.start', starts[order])
+    save('unequal.end', ends[order])
+    save('unequal.maxend', np.maximum.accumulate(ends[order]))
+    save('unequal.order', order)
+    save('unequal.text', np.array([values.code(ann.collapseRefSeqRow(row)) \
+        for start, end, row in unequal], dtype=np.uint32))
+
+
+"""Dumps the three tables from the reference database into
+   path/BigRefGene, one chromosome at a time
+   Returns the manifest entry of the index.
+"""
+def dumpBigRefGene(backend, conn, path, table='BigRefGene'):
+    path = os.path.join(path, table)
+    os.makedirs(path, exist_ok=True)
+
+    cursor = backend.cursor(conn)
+    chroms = set([])
+    for name in TABLES:
+        cursor.execute('select distinct CHR from ' + name)
+        chroms.update([str(row[0]) for row in cursor.fetchall()])
+
+    values = snapshot.ValueTable()
+    alleles = snapshot.ValueTable()
+    files = {}
+    count = 0
+    for n, chrom in enumerate(sorted(chroms)):
+        base, nobase, unequal = [chromRows(backend, cursor, name, chrom) \
+            for name in TABLES]
+        writeChrom(path, n, base, nobase, unequal, values, alleles)
+        files[chrom] = n
+        count = count + len(base) + len(nobase) + len(unequal)
+    cursor.close()
+    values.write(path)
+    alleles.write(path, 'alleles')
+
+    print(f"{table}: {count} rows in {len(files)} chromosomes, " + \
+        f"{len(values.values)} distinct annotations")
+    return {'kind': 'bigrefgene', 'chroms': files}
+
+### EOF
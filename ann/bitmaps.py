@@ -0,0 +1,166 @@
+# bitmaps.py
+#
+# Coverage bitmaps of the region tables
+#
+# Each chromosome of a table is cut into bins of a fixed size, and the
+# bins any of its regions touch are kept as runs of consecutive bins.
+# A variant in a bin outside every run cannot overlap a region of the
+# table, so the stage skips its lookup; a chunk with no variant in a
+# covered bin makes no query at all. The bitmaps of a reference release
+# are kept in <path>/<version>/:
+#
+#   coverage.json           bin size, and the file number of each
+#                           chromosome of each table
+#   <table>/<n>.runs.npy    first and last bin of each run, sorted
+#
+# Tables without a chromosome column hold a single chromosome, ''.
+# Built from the configured reference database with:
+#
+#   python bitmaps.py <bitmap dir> [table ...]
+#
+##
+
+import os
+import sys
+import json
+
+import numpy as np
+
+import snapshot
+
+"""Merges bin ranges [first, last] into sorted, disjoint runs, joining
+   ranges that touch
+"""
+def mergeRuns(firsts, lasts):
+    if (len(firsts) == 0):
+        return np.zeros((2, 0), dtype=np.int64)
+    order = np.argsort(firsts, kind='stable')
+    firsts = np.asarray(firsts, dtype=np.int64)[order]
+    lasts = np.maximum.accumulate(np.asarray(lasts, dtype=np.int64)[order])
+    starts = np.concatenate([[True], firsts[1:] > lasts[:-1] + 1])
+    ends = np.concatenate([starts[1:], [True]])
+    return np.array([firsts[starts], lasts[ends]], dtype=np.int64)
+
+
+"""The coverage bitmaps of one reference release, mapped read-only
+"""
+class CoverageBitmaps(object):
+
+    def __init__(self, path):
+        self.path = path
+        fh = open(os.path.join(path, 'coverage.json'))
+        self.manifest = json.load(fh)
+        fh.close()
+        self.bin_size = self.manifest['binSize']
+        self.tables = self.manifest['tables']
+        self.runs = {}
+
+    def has(self, table):
+        return table in self.tables
+
+    def chromRuns(self, table, chrom):
+        key = (table, chrom)
+        if key not in self.runs:
+            n = snapshot.chromNumber(self.tables[table], chrom)
+            runs = np.zeros((2, 0), dtype=np.int64)
+            if n is not None:
+                runs = np.load(os.path.join(self.path, table, str(n) + '.runs.npy'),
+                    mmap_mode='r')
+            self.runs[key] = runs
+        return self.runs[key]
+
+    """For each position of chrom, whether its bin has a region of table;
+       chrom is None for tables without a chromosome column
+    """
+    def covers(self, table, chrom, positions):
+        runs = self.chromRuns(table, chrom)
+        bins = np.asarray(positions, dtype=np.int64) // self.bin_size
+        i = np.searchsorted(runs[0], bins, side='right') - 1
+        return (i >= 0) & (bins <= runs[1][np.maximum(i, 0)]) if runs.shape[1] > 0 \
+            else np.zeros(len(bins), dtype=bool)
+
+
+"""Opens the bitmaps of a release under path, or returns None if they
+   were never built
+"""
+def openBitmaps(path, version):
+    path = os.path.join(path, version)
+    if not os.path.exists(os.path.join(path, 'coverage.json')):
+        print(f"No coverage bitmaps of '{version}' in '{path}'.")
+        return None
+    return CoverageBitmaps(path)
+
+
+"""Builds the bitmap of one table into path/table
+   Returns the file number of each chromosome.
+"""
+def buildTable(backend, conn, path, table, bin_size):
+    chromName, startName, endName = snapshot.TABLES[table]
+    columns = [c for c in [chromName, startName, endName] if c is not None]
+    cursor = backend.scanCursor(conn)
+    cursor.execute('select ' + ', '.join(columns) + ' from ' + table)
+
+    byChrom = {}
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        for row in rows:
+            # Bins from the start to the end, and the end alone when there
+            # is no start, so point lookups on chromEnd are covered too
+            if row[-1] is None:
+                continue
+            end = int(row[-1])
+            start = end if row[-2] is None else int(row[-2])
+            chrom = str(row[0]) if chromName is not None else ''
+            firsts, lasts = byChrom.setdefault(chrom, ([], []))
+            firsts.append(min(start, end) // bin_size)
+            lasts.append(max(start, end) // bin_size)
+    cursor.close()
+
+    os.makedirs(os.path.join(path, table), exist_ok=True)
+    chroms = {}
+    bins = 0
+    for n, chrom in enumerate(sorted(byChrom)):
+        runs = mergeRuns(*byChrom[chrom])
+        np.save(os.path.join(path, table, str(n) + '.runs.npy'), runs)
+        chroms[chrom] = n
+        bins = bins + int((runs[1] - runs[0] + 1).sum())
+    print(f"{table}: {bins} bins of {bin_size} covered in {len(chroms)} chromosomes")
+    return chroms
+
+
+"""Builds the bitmaps of the given tables, all the region tables of
+   snapshot.TABLES by default, from the configured reference database
+   The manifest is written last, so bitmaps being built are never opened.
+"""
+def buildBitmaps(path, version, bin_size, tables=None):
+    import driver
+
+    if tables is None:
+        tables = sorted(snapshot.TABLES)
+    path = os.path.join(path, version)
+    os.makedirs(path, exist_ok=True)
+
+    backend = driver.reference()
+    manifest = {'version': version, 'binSize': bin_size, 'tables': {}}
+    with backend.connection() as conn:
+        for table in tables:
+            manifest['tables'][table] = buildTable(backend, conn, path, table,
+                bin_size)
+
+    fh = open(os.path.join(path, 'coverage.json'), 'w')
+    json.dump(manifest, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import driver
+        buildBitmaps(sys.argv[1], driver.REFERENCE_VERSION,
+            driver.COVERAGE_BIN_SIZE, tables=sys.argv[2:] or None)
+    else:
+        print("Usage: python bitmaps.py <bitmap dir> [table ...]")
+
+### EOF
@@ -0,0 +1,165 @@
+# bloom.py
+#
+# Bloom filter of the (chrom, pos) keys of dbSNP
+#
+# The dbSNP stage checks every variant against the filter before looking
+# it up: a variant whose position the filter has never seen cannot be in
+# dbSNP and gets no query. Positions that are in dbSNP always pass, along
+# with a share of the others set by the false-positive rate the filter
+# is built for.
+#
+# One filter is kept per reference release, in
+# <path>/<version>/dbSNP.bloom.npy with its parameters in
+# <path>/<version>/dbSNP.bloom.json. Chromosome names are taken without
+# case, as MySQL compares them. Built from the configured reference
+# database with:
+#
+#   python bloom.py <filter dir> [false positive rate]
+#
+##
+
+import os
+import sys
+import json
+import math
+import hashlib
+
+import numpy as np
+
+"""Seed of a chromosome name, the same in every process
+"""
+def chromSeed(chrom):
+    digest = hashlib.blake2b(str(chrom).lower().encode('utf-8'),
+        digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+"""splitmix64 finalizer over an array of uint64
+"""
+def mix(x):
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+"""The two base hashes of each (chrom, pos) key; the k bits of a key are
+   h1 + i * h2 for i in 0..k-1, modulo the size of the filter
+"""
+def hashes(chrom, positions):
+    keys = np.asarray(positions, dtype=np.int64).astype(np.uint64) ^ \
+        np.uint64(chromSeed(chrom))
+    h1 = mix(keys)
+    h2 = mix(h1 ^ np.uint64(0x9e3779b97f4a7c15)) | np.uint64(1)
+    return h1, h2
+
+
+"""Number of bits and of hashes for n keys at a false-positive rate
+"""
+def sizeFor(n, fp_rate):
+    n = max(1, int(n))
+    bits = int(math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2)))
+    bits = max(64, 8 * int(math.ceil(bits / 8.0)))
+    k = max(1, int(round(bits / float(n) * math.log(2))))
+    return bits, k
+
+
+"""Bit positions of each key, one row per hash
+"""
+def bitPositions(chrom, positions, bits, k):
+    h1, h2 = hashes(chrom, positions)
+    with np.errstate(over='ignore'):
+        return np.array([(h1 + np.uint64(i) * h2) % np.uint64(bits)
+            for i in range(k)], dtype=np.uint64).reshape(k, -1)
+
+
+"""A filter built by buildFilter(), mapped read-only
+"""
+class BloomFilter(object):
+
+    def __init__(self, path):
+        fh = open(path + '.json')
+        self.params = json.load(fh)
+        fh.close()
+        self.bits = self.params['bits']
+        self.k = self.params['hashes']
+        self.array = np.load(path + '.npy', mmap_mode='r')
+
+    """For each position of chrom, False if it is certainly not in the
+       table, True if it may be
+    """
+    def mightContain(self, chrom, positions):
+        if (len(positions) == 0):
+            return np.zeros(0, dtype=bool)
+        where = bitPositions(chrom, positions, self.bits, self.k)
+        found = (self.array[where >> np.uint64(3)] >> \
+            (where & np.uint64(7)).astype(np.uint8)) & 1
+        return found.astype(bool).all(axis=0)
+
+
+"""Opens the filter of a release under path, or returns None if it was
+   never built
+"""
+def openFilter(path, version):
+    path = os.path.join(path, version, 'dbSNP.bloom')
+    if not os.path.exists(path + '.json'):
+        print(f"No dbSNP filter in '{path}'.")
+        return None
+    return BloomFilter(path)
+
+
+"""Builds the filter of the (CHR, POS) keys of dbSNP from the configured
+   reference database, sized for fp_rate
+   The parameters are written last, so a filter being built is never
+   opened.
+"""
+def buildFilter(path, version, fp_rate):
+    import driver
+
+    path = os.path.join(path, version)
+    os.makedirs(path, exist_ok=True)
+
+    backend = driver.reference()
+    with backend.connection() as conn:
+        cursor = backend.cursor(conn)
+        cursor.execute('select count(*) from dbSNP')
+        n = int(cursor.fetchone()[0])
+        cursor.close()
+        bits, k = sizeFor(n, fp_rate)
+        array = np.zeros(bits // 8, dtype=np.uint8)
+
+        cursor = backend.scanCursor(conn)
+        cursor.execute('select CHR, POS from dbSNP')
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            byChrom = {}
+            for row in rows:
+                if row[1] is not None:
+                    byChrom.setdefault(str(row[0]).lower(), []).append(int(row[1]))
+            for chrom, positions in byChrom.items():
+                where = bitPositions(chrom, positions, bits, k).ravel()
+                np.bitwise_or.at(array, where >> np.uint64(3),
+                    np.left_shift(1, (where & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+        cursor.close()
+
+    np.save(os.path.join(path, 'dbSNP.bloom.npy'), array)
+    fh = open(os.path.join(path, 'dbSNP.bloom.json'), 'w')
+    json.dump({'version': version, 'keys': n, 'bits': bits, 'hashes': k,
+        'fp_rate': fp_rate}, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+    print(f"dbSNP filter: {n} keys, {bits} bits, {k} hashes")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import driver
+        fp_rate = float(sys.argv[2]) if len(sys.argv) > 2 else \
+            driver.DBSNP_FILTER_FP_RATE
+        buildFilter(sys.argv[1], driver.REFERENCE_VERSION, fp_rate)
+    else:
+        print("Usage: python bloom.py <filter dir> [false positive rate]")
+
+### EOF
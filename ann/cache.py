@@ -0,0 +1,182 @@
+# cache.py
+#
+# Variant annotation cache shared by the jobs run on an annotator node
+#
+##
+
+import os
+import time
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+# Format of the cached entries, part of every key so entries written by
+# a build whose stages stored their lookups differently are never read.
+# Bump it whenever the lookup results a stage caches change shape.
+#   2  BigRefGene lookups hold the collapsed RefSeq annotation
+#   3  gene location lookups hold the located transcripts and their
+#      CpG islands
+FORMAT = 3
+
+"""Cache key of a record: the variant, the reference release its
+   lookups were made against and the format of the entry
+"""
+def variantKey(record, version):
+    return ':'.join([str(record.chrom), str(record.pos), str(record.ref),
+        str(record.alt), str(version), str(FORMAT)])
+
+
+"""Two-level cache of the reference lookups made for a variant
+   An entry is a dict of the lookup results of every stage, by stage
+   label, so a hit skips all the queries for the variant while the stages
+   still annotate the record and count it. Entries are kept in an
+   in-process LRU of max_entries and, when path is set, in an SQLite
+   file on local disk that outlives the process. The file is kept under
+   max_bytes by dropping the least recently used entries.
+"""
+class VariantCache(object):
+    counters = ['hits', 'memory_hits', 'disk_hits', 'misses', 'evictions']
+
+    def __init__(self, path=None, max_entries=100000, max_bytes=1073741824,
+        version=''):
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.memory = OrderedDict()
+        self.db = None
+        self.db_pid = None
+        self.db_size = 0
+        for name in self.counters:
+            setattr(self, name, 0)
+
+    def getCounts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
+
+    """Connection to the disk store, opened once per process
+    """
+    def store(self):
+        if self.path is None:
+            return None
+        if (self.db is None) or (self.db_pid != os.getpid()):
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute('pragma journal_mode=wal')
+            self.db.execute('create table if not exists variants ' + \
+                '(key text primary key, value blob, size integer, ' + \
+                'used real)')
+            self.db.execute('create index if not exists variants_used ' + \
+                'on variants (used)')
+            self.db.commit()
+            self.db_pid = os.getpid()
+            self.db_size = self.db.execute('select coalesce(sum(size), 0) ' + \
+                'from variants').fetchone()[0]
+        return self.db
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while (len(self.memory) > self.max_entries):
+            self.memory.popitem(last=False)
+
+    """Returns, for every record, a copy of its cached entry, or an empty
+       dict on a miss
+    """
+    def getMany(self, records):
+        keys = [variantKey(record, self.version) for record in records]
+        found = {}
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+        fromDisk = set()
+
+        db = self.store()
+        missing = list(set([key for key in keys if key not in found]))
+        if (db is not None) and (len(missing) > 0):
+            now = time.time()
+            for i in range(0, len(missing), 500):
+                block = missing[i:i + 500]
+                rows = db.execute('select key, value from variants ' + \
+                    'where key in (' + ','.join(['?'] * len(block)) + ')',
+                    block).fetchall()
+                for key, value in rows:
+                    found[key] = pickle.loads(value)
+                    self.remember(key, found[key])
+                    fromDisk.add(key)
+                db.executemany('update variants set used = ? where key = ?',
+                    [(now, key) for key, value in rows])
+            db.commit()
+
+        entries = []
+        for key in keys:
+            if key in found:
+                self.hits = self.hits + 1
+                if key in fromDisk:
+                    self.disk_hits = self.disk_hits + 1
+                else:
+                    self.memory_hits = self.memory_hits + 1
+                entries.append(dict(found[key]))
+            else:
+                self.misses = self.misses + 1
+                entries.append({})
+        return entries
+
+    """Stores the entries of a chunk of records once every stage has
+       added its lookups to them
+    """
+    def putMany(self, records, entries):
+        new = []
+        for record, entry in zip(records, entries):
+            key = variantKey(record, self.version)
+            # Entries are stored again when a stage added its lookups
+            if (key not in self.memory) or (len(self.memory[key]) < len(entry)):
+                new.append((key, entry))
+            self.remember(key, entry)
+
+        db = self.store()
+        if (db is not None) and (len(new) > 0):
+            now = time.time()
+            values = []
+            for key, entry in new:
+                value = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+                values.append((key, value, len(value), now))
+            db.executemany('insert or replace into variants ' + \
+                '(key, value, size, used) values (?, ?, ?, ?)', values)
+            db.commit()
+            self.db_size = self.db_size + sum([v[2] for v in values])
+            if (self.db_size > self.max_bytes):
+                self.evict()
+
+    """Drops the least recently used entries of the disk store until it
+       is back under max_bytes
+       The size kept in db_size is only an estimate, as other processes
+       write to the same file, so it is taken again from the store first.
+    """
+    def evict(self):
+        db = self.store()
+        size = db.execute('select coalesce(sum(size), 0) from variants').fetchone()[0]
+        self.db_size = size
+        if (size <= self.max_bytes):
+            return
+
+        # Make room for a while rather than evicting on every insert
+        target = int(self.max_bytes * 0.9)
+        rows = db.execute('select key, size from variants order by used').fetchall()
+        drop = []
+        for key, length in rows:
+            if (size <= target):
+                break
+            drop.append((key,))
+            size = size - length
+        db.executemany('delete from variants where key = ?', drop)
+        db.commit()
+        self.db_size = size
+        self.evictions = self.evictions + len(drop)
+
+    def close(self):
+        if (self.db is not None) and (self.db_pid == os.getpid()):
+            self.db.close()
+        self.db = None
+
+### EOF
@@ -0,0 +1,218 @@
+# dbsnp.py
+#
+# Packed, memory-mapped index of the dbSNP table
+#
+# dbSNP is kept in the reference snapshot (see snapshot.py) as one set of
+# arrays per chromosome, in <path>/<version>/dbSNP/:
+#
+#   <n>.pos.npy       positions, sorted, uint32
+#   <n>.ref.npy       REF bases packed 2 bits per row (A, C, G, T)
+#   <n>.varclass.npy  INFO (variant class) of each row, as a value code
+#   <n>.rsid.npy      number of the rsID of each row, uint32
+#   <n>.gmaf.npy      GMAF of each row, as a value code
+#   <n>.xrow.npy      rows whose REF is not a single base or whose ID is
+#   <n>.xref.npy      not rs<number>, with the value codes of their REF
+#   <n>.xid.npy       and ID
+#
+# Value codes point into values.offsets.npy, values.kinds.npy and
+# values.blob, where every distinct variant class, GMAF and exception
+# REF and ID is stored once.
+#
+# Built with the rest of the snapshot by snapshot.py.
+#
+##
+
+import os
+import re
+
+import numpy as np
+
+import snapshot
+
+BASES = 'ACGT'
+BASE_CODES = dict([(base, n) for n, base in enumerate(BASES)])
+RSID = re.compile(r'^rs([1-9][0-9]{0,9})$')
+MAX_RSID = 2 ** 32 - 1
+
+"""The dbSNP index of a snapshot, opened read-only
+   Rows are rebuilt as (CHR, POS, END, ID, REF, ALT, INFO, GMAF) tuples,
+   like those of the table; END and ALT are not kept and are None.
+"""
+class DbSnpIndex(object):
+
+    def __init__(self, path, chroms):
+        self.path = path
+        self.chroms = chroms
+        self.values = snapshot.readValues(path)
+        self.arrays = {}
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, name), mmap_mode='r')
+
+    def value(self, code):
+        return self.values[int(code)][0]
+
+    """Value codes whose value equals text without case, as MySQL
+       compares them
+    """
+    def codesOf(self, text):
+        text = str(text).upper()
+        return np.array([code for code in range(len(self.values))
+            if str(self.value(code)).upper() == text], dtype=np.int64)
+
+    """Arrays of a chromosome, or None if it has no rows
+       Chromosome names compare without case, like in MySQL.
+    """
+    def chromArrays(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.arrays:
+            arrays = None
+            for name, n in self.chroms.items():
+                if (name == chrom) or ((arrays is None) and \
+                    (name.lower() == chrom.lower())):
+                    arrays = dict([(array, self.load(str(n) + '.' + array + '.npy'))
+                        for array in ['pos', 'ref', 'varclass', 'rsid', 'gmaf',
+                        'xrow', 'xref', 'xid']])
+                    arrays['chrom'] = name
+            self.arrays[chrom] = arrays
+        return self.arrays[chrom]
+
+    """Rows of chrom at each of positions whose REF is one of the pair in
+       refs and whose variant class is varclass
+       refs holds, for every position, the REF of the variant and its
+       complement. Candidates of the whole chunk are found with two
+       binary searches and filtered with vector operations; only rows
+       with an exception REF are compared one by one.
+    """
+    def lookup(self, chrom, positions, refs, varclass):
+        results = [[] for p in positions]
+        a = self.chromArrays(chrom)
+        if (a is None) or (len(positions) == 0):
+            return results
+
+        query = np.asarray(positions, dtype=np.int64)
+        lo = np.searchsorted(a['pos'], query, side='left')
+        hi = np.searchsorted(a['pos'], query, side='right')
+        counts = hi - lo
+        total = int(counts.sum())
+        if (total == 0):
+            return results
+
+        # Every candidate row, and the position it was found for
+        owner = np.repeat(np.arange(len(positions)), counts)
+        rows = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(lo, counts)
+
+        keep = np.isin(a['varclass'][rows], self.codesOf(varclass))
+
+        codes = (a['ref'][rows >> 2] >> ((rows & 3) * 2)) & 3
+        wanted = np.array([[BASE_CODES.get(ref.upper(), -1) for ref in pair]
+            for pair in refs], dtype=np.int64).reshape(-1, 2)
+        baseMatch = (codes == wanted[owner, 0]) | (codes == wanted[owner, 1])
+
+        xat = np.searchsorted(a['xrow'], rows)
+        if (len(a['xrow']) > 0):
+            isException = (xat < len(a['xrow'])) & \
+                (a['xrow'][np.minimum(xat, len(a['xrow']) - 1)] == rows)
+        else:
+            isException = np.zeros(len(rows), dtype=bool)
+
+        for i in np.nonzero(keep & (baseMatch | isException))[0].tolist():
+            row = int(rows[i])
+            ref = BASES[int(codes[i])]
+            rsid = 'rs' + str(int(a['rsid'][row]))
+            if isException[i]:
+                x = int(xat[i])
+                ref = self.value(a['xref'][x])
+                rsid = self.value(a['xid'][x])
+                pair = [r.upper() for r in refs[int(owner[i])]]
+                if (str(ref).upper() not in pair):
+                    continue
+            results[int(owner[i])].append((a['chrom'], int(a['pos'][row]), None,
+                rsid, ref, None, self.value(a['varclass'][row]),
+                self.value(a['gmaf'][row])))
+        return results
+
+
+"""Writes the arrays of one chromosome
+   rows are (POS, ID, REF, INFO, GMAF) in database order.
+"""
+def writeChrom(path, n, rows, values):
+    positions = np.array([row[0] for row in rows], dtype=np.int64)
+    if (len(rows) > 0) and ((positions.min() < 0) or (positions.max() >= 2 ** 32)):
+        raise ValueError('dbSNP positions do not fit in 32 bits')
+    order = np.argsort(positions, kind='stable')
+
+    refs = np.zeros(len(rows), dtype=np.uint8)
+    rsids = np.zeros(len(rows), dtype=np.uint32)
+    varclass = np.zeros(len(rows), dtype=np.uint32)
+    gmaf = np.zeros(len(rows), dtype=np.uint32)
+    xrow = []
+    xref = []
+    xid = []
+    for i, j in enumerate(order.tolist()):
+        pos, rsid, ref, info, maf = rows[j]
+        varclass[i] = values.code(info)
+        gmaf[i] = values.code(maf)
+
+        match = RSID.match(rsid) if isinstance(rsid, str) else None
+        if (ref in BASE_CODES) and (match is not None) and \
+            (int(match.group(1)) <= MAX_RSID):
+            refs[i] = BASE_CODES[ref]
+            rsids[i] = int(match.group(1))
+        else:
+            xrow.append(i)
+            xref.append(values.code(ref))
+            xid.append(values.code(rsid))
+
+    # Four REF codes to a byte, the first row in the lowest bits
+    padded = np.zeros(4 * ((len(rows) + 3) // 4), dtype=np.uint8)
+    padded[:len(rows)] = refs
+    packed = padded.reshape(-1, 4)
+    packed = packed[:, 0] | (packed[:, 1] << 2) | (packed[:, 2] << 4) | \
+        (packed[:, 3] << 6)
+
+    if (len(values.values) > 2 ** 32):
+        raise ValueError('Too many distinct dbSNP values')
+    np.save(os.path.join(path, str(n) + '.pos.npy'),
+        positions[order].astype(np.uint32))
+    np.save(os.path.join(path, str(n) + '.ref.npy'), packed.astype(np.uint8))
+    np.save(os.path.join(path, str(n) + '.varclass.npy'), varclass)
+    np.save(os.path.join(path, str(n) + '.rsid.npy'), rsids)
+    np.save(os.path.join(path, str(n) + '.gmaf.npy'), gmaf)
+    np.save(os.path.join(path, str(n) + '.xrow.npy'), np.array(xrow, dtype=np.int64))
+    np.save(os.path.join(path, str(n) + '.xref.npy'), np.array(xref, dtype=np.uint32))
+    np.save(os.path.join(path, str(n) + '.xid.npy'), np.array(xid, dtype=np.uint32))
+
+
+"""Dumps dbSNP from the reference database into path/dbSNP, one
+   chromosome at a time so only one is ever held in memory
+   Returns the manifest entry of the table.
+"""
+def dumpDbSnp(backend, conn, path, table='dbSNP'):
+    path = os.path.join(path, table)
+    os.makedirs(path, exist_ok=True)
+
+    cursor = backend.cursor(conn)
+    cursor.execute('select distinct CHR from ' + table)
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+    values = snapshot.ValueTable()
+    files = {}
+    count = 0
+    for n, chrom in enumerate(chroms):
+        rows = backend.pointLookup(cursor, table, [('CHR', chrom)],
+            columns='POS, ID, REF, INFO, GMAF')
+        rows = [(int(row[0]), row[1], row[2], row[3], row[4]) for row in rows
+            if row[0] is not None]
+        writeChrom(path, n, rows, values)
+        files[chrom] = n
+        count = count + len(rows)
+    cursor.close()
+    values.write(path)
+
+    print(f"{table}: {count} rows in {len(files)} chromosomes, " + \
+        f"{len(values.values)} distinct values")
+    return {'kind': 'dbsnp', 'chroms': files}
+
+### EOF
@@ -12,110 +12,346 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import configparser
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
 import annotate as ann
+import metrics
+import backends
+import cache
+import snapshot
 
-def run(infile, format):
+# Pipeline settings live next to the AWS settings in ann_config.ini
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+CHUNK_SIZE = config.getint('pipeline', 'CHUNK_SIZE', fallback=1000)
+DBSNP_BATCH_SIZE = config.getint('pipeline', 'DBSNP_BATCH_SIZE', fallback=500)
+LOOKUP_BATCH_SIZE = config.getint('pipeline', 'LOOKUP_BATCH_SIZE', fallback=500)
+INTERVAL_INDEX = config.getboolean('pipeline', 'INTERVAL_INDEX', fallback=False)
+WORKERS = config.getint('pipeline', 'WORKERS', fallback=1)
+SHARD_WINDOW = config.getint('pipeline', 'SHARD_WINDOW', fallback=50000000)
+SHARD_MIN_BYTES = config.getint('pipeline', 'SHARD_MIN_BYTES', fallback=10000000)
+REFERENCE_BACKEND = config.get('pipeline', 'REFERENCE_BACKEND', fallback='mysql')
+REFERENCE_SQLITE_PATH = config.get('pipeline', 'REFERENCE_SQLITE_PATH',
+    fallback='')
+REFERENCE_VERSION = config.get('pipeline', 'REFERENCE_VERSION', fallback='')
+VARIANT_CACHE = config.getboolean('pipeline', 'VARIANT_CACHE', fallback=False)
+VARIANT_CACHE_ENTRIES = config.getint('pipeline', 'VARIANT_CACHE_ENTRIES',
+    fallback=100000)
+VARIANT_CACHE_PATH = config.get('pipeline', 'VARIANT_CACHE_PATH', fallback='')
+VARIANT_CACHE_MAX_BYTES = config.getint('pipeline', 'VARIANT_CACHE_MAX_BYTES',
+    fallback=1073741824)
+REFERENCE_SNAPSHOT_PATH = config.get('pipeline', 'REFERENCE_SNAPSHOT_PATH',
+    fallback='')
+DBSNP_FILTER_PATH = config.get('pipeline', 'DBSNP_FILTER_PATH', fallback='')
+DBSNP_FILTER_FP_RATE = config.getfloat('pipeline', 'DBSNP_FILTER_FP_RATE',
+    fallback=0.01)
+COVERAGE_PATH = config.get('pipeline', 'COVERAGE_PATH', fallback='')
+COVERAGE_BIN_SIZE = config.getint('pipeline', 'COVERAGE_BIN_SIZE',
+    fallback=1000)
+
+_variant_cache = None
+_snapshot = None
+_dbsnp_filter = None
+_coverage = None
+
+"""The reference database the stages query, as configured
+   A relative SQLite path is taken from the directory of this file.
+"""
+def reference():
+    path = REFERENCE_SQLITE_PATH
+    if path:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return backends.getBackend(REFERENCE_BACKEND, path=path)
+
+
+"""The variant cache of this process, or None when it is turned off
+   The in-memory level lives as long as the process, so it carries over
+   from one job to the next; the disk level is shared by every process
+   on the node.
+"""
+def variantCache():
+    global _variant_cache
+    if not VARIANT_CACHE:
+        return None
+    if _variant_cache is None:
+        path = None
+        if VARIANT_CACHE_PATH:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                VARIANT_CACHE_PATH)
+        _variant_cache = cache.VariantCache(path=path,
+            max_entries=VARIANT_CACHE_ENTRIES,
+            max_bytes=VARIANT_CACHE_MAX_BYTES, version=REFERENCE_VERSION)
+    return _variant_cache
+
+
+"""The snapshot of the region tables for REFERENCE_VERSION, or None when
+   there is none
+   It is opened once per process; its files are mapped read-only, so all
+   the processes of a node share them.
+"""
+def referenceSnapshot():
+    global _snapshot
+    if not REFERENCE_SNAPSHOT_PATH:
+        return None
+    if _snapshot is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            REFERENCE_SNAPSHOT_PATH)
+        _snapshot = snapshot.openSnapshot(path, REFERENCE_VERSION)
+    return _snapshot
+
+
+"""The Bloom filter of the dbSNP positions for REFERENCE_VERSION, or None
+   when there is none
+   It is loaded once per process and mapped read-only.
+"""
+def dbSnpFilter():
+    global _dbsnp_filter
+    if not DBSNP_FILTER_PATH:
+        return None
+    if _dbsnp_filter is None:
+        import bloom
+
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            DBSNP_FILTER_PATH)
+        _dbsnp_filter = bloom.openFilter(path, REFERENCE_VERSION)
+    return _dbsnp_filter
+
+
+"""The coverage bitmaps of the region tables for REFERENCE_VERSION, or
+   None when there are none
+   They are loaded once per process and mapped read-only.
+"""
+def coverageBitmaps():
+    global _coverage
+    if not COVERAGE_PATH:
+        return None
+    if _coverage is None:
+        import bitmaps
+
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            COVERAGE_PATH)
+        _coverage = bitmaps.openBitmaps(path, REFERENCE_VERSION)
+    return _coverage
+
+
+"""Cache counts of a run: the difference between two getCounts()
+"""
+def cacheCounts(before, after):
+    return dict([(name, after[name] - before[name]) for name in after])
+
+
+"""The annotation stages, in the order they are applied to each record
+"""
+def stages(format='vcf'):
+    index = INTERVAL_INDEX
+    coverage = coverageBitmaps()
+    batch = LOOKUP_BATCH_SIZE
+    return [
+        ann.DbSnpStage(format=format, batch_size=DBSNP_BATCH_SIZE,
+            prefilter=dbSnpFilter()),
+        ann.BigRefGeneStage(format=format, batch_size=batch),
+        ann.GenesStage(format=format, table='refGene', promoter_offset=500,
+            use_index=index),
+        ann.CytobandStage(format=format, table='cytoBand', use_index=index,
+            coverage=coverage, batch_size=batch),
+        ann.GadAllStage(format=format, table='gadAll', use_index=index,
+            coverage=coverage, batch_size=batch),
+        ann.GwasCatalogStage(format=format, table='gwasCatalog',
+            coverage=coverage, batch_size=batch),
+        ann.MiRNAStage(format=format, table='targetScanS', use_index=index,
+            coverage=coverage, batch_size=batch),
+        ann.HugoStage(format=format, table='hugo', use_index=index,
+            coverage=coverage, batch_size=batch),
+        ann.CnvDatabaseStage(format=format, table='dgv_Cnv', use_index=index,
+            coverage=coverage, batch_size=batch),
+        ann.CnvDatabaseStage(format=format, table='abParts_IG_T_CelReceptors',
+            use_index=index, coverage=coverage, batch_size=batch),
+        ann.CnvDatabaseStage(format=format, table='mcCarroll_Cnv',
+            use_index=index, coverage=coverage, batch_size=batch),
+        ann.CnvDatabaseStage(format=format, table='conrad_Cnv',
+            use_index=index, coverage=coverage, batch_size=batch),
+        ann.GenomicSuperDupsStage(format=format, table='genomicSuperDups',
+            use_index=index, coverage=coverage, batch_size=batch),
+        ann.TfbsConsSitesStage(format=format, table='tfbsConsSites',
+            use_index=index, coverage=coverage, batch_size=batch),
+    ]
+
+
+"""Shard a record belongs to: its chromosome, and the SHARD_WINDOW sized
+   window of that chromosome its position falls in
+"""
+def shardKey(line, inds, sep='\t'):
+    fields = line.split(sep)
+    try:
+        window = int(fields[inds[1]].strip()) // SHARD_WINDOW
+    except ValueError:
+        window = 0
+    return (fields[inds[0]].strip(), window)
+
+
+"""Annotates one shard in a worker process
+   Returns the stage counts and metrics, and the variant cache counts, so
+   the parent can write the merged log and metrics file.
+"""
+def annotateShard(shardin, shardout, format):
+    pipeline = stages(format=format)
+    variants = variantCache()
+    before = variants.getCounts() if variants is not None else None
+    ann.annotateFile(shardin, shardout, pipeline, format=format,
+        chunk_size=CHUNK_SIZE, backend=reference(), cache=variants,
+        snapshot=referenceSnapshot())
+
+    counts = None
+    if variants is not None:
+        counts = cacheCounts(before, variants.getCounts())
+    return [(stage.getCounts(), stage.metrics.toDict()) for stage in pipeline], \
+        counts
+
+
+"""Splits the input into per-window shards, annotates them in parallel
+   and merges the results back in input order
+   The merge re-reads the input and, for each record, takes the next line
+   of its shard's output: shards keep their records in input order, so
+   this restores the original order without holding anything in memory.
+"""
+def runSharded(infile, annotated, format, workers):
+    inds = ann.getFormatSpecificIndices(format=format)
+    shards = {}
+    fh_shards = []
+
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if not line.startswith("#"):
+            key = shardKey(line, inds)
+            if key not in shards:
+                shards[key] = len(fh_shards)
+                fh_shards.append(open(infile + '.shard.' + str(shards[key]), 'w'))
+            fh_shards[shards[key]].write(line + '\n')
+    fh.close()
+    for fh_shard in fh_shards:
+        fh_shard.close()
+
+    shardfiles = [infile + '.shard.' + str(n) for n in range(0, len(fh_shards))]
+    pipeline = stages(format=format)
+    cacheTotals = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(annotateShard, shardfile,
+            shardfile + '.annot', format) for shardfile in shardfiles]
+        # Results are collected in submission order; any worker failure
+        # is raised here
+        for future in futures:
+            results, cached = future.result()
+            for stage, (counts, figures) in zip(pipeline, results):
+                stage.addCounts(counts)
+                stage.metrics.add(figures)
+            if cached is not None:
+                if cacheTotals is None:
+                    cacheTotals = dict([(name, 0) for name in cached])
+                for name in cached:
+                    cacheTotals[name] = cacheTotals[name] + cached[name]
+
+    fh_annotated = [open(shardfile + '.annot') for shardfile in shardfiles]
+    fh = open(infile)
+    fh_out = open(annotated, 'w')
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            fh_out.write(line + '\n')
+        else:
+            fh_out.write(fh_annotated[shards[shardKey(line, inds)]].readline())
+    fh.close()
+    fh_out.close()
+
+    for fh_shard in fh_annotated:
+        fh_shard.close()
+    for shardfile in shardfiles:
+        fu.delete(shardfile)
+        fu.delete(shardfile + '.annot')
+
+    fh_log = open(infile + '.count.log', 'w')
+    for stage in pipeline:
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+    return pipeline, cacheTotals
+
+
+def run(infile, format, workers=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    annotated = infile + '.annot'
+    if workers is None:
+        workers = WORKERS
+
+    sharded = (workers > 1) and (fu.fileSize(infile) >= SHARD_MIN_BYTES)
+    with metrics.Stopwatch() as watch:
+        # Large inputs are split by genomic window and annotated by a pool of
+        # worker processes; small ones are not worth the split and merge
+        if sharded:
+            pipeline, cached = runSharded(infile, annotated, format, workers)
+        else:
+            # Every record is read once, passes through all stages in memory
+            # and is written once; the count log is written when the file
+            # is done
+            pipeline = stages(format=format)
+            variants = variantCache()
+            before = variants.getCounts() if variants is not None else None
+            ann.annotateFile(infile, annotated, pipeline,
+                logcountfile=infile + '.count.log', logmode='w',
+                format=format, chunk_size=CHUNK_SIZE, backend=reference(),
+                cache=variants, snapshot=referenceSnapshot())
+            cached = None
+            if variants is not None:
+                cached = cacheCounts(before, variants.getCounts())
+
+    for stage in pipeline:
+        print(f"{stage.label} - done.")
+
+    # Per-stage timings and work done go next to the count log; in sharded
+    # runs the stage figures are summed over the workers
+    metrics.writeMetrics(infile + '.metrics.json', infile, annotated,
+        pipeline, watch.wall, watch.cpu, workers=workers if sharded else 1,
+        cache=cached)
+
+    finalout = annotated.replace('.vcf.annot', '.annot.vcf')
+    os.rename(annotated, finalout)
+
+
+"""Annotates the lines read from fh and writes them to fh_out chunk by
+   chunk, for jobs streamed from and to S3; the count log and metrics go
+   to fh_log and fh_metrics once the input is done
+   Streams are annotated in this process: sharding needs the whole input
+   on local disk. name is the input file name reported in the metrics;
+   bytes read and written are taken from the bytes attribute of fh and
+   fh_out, when they have one.
+"""
+def runStream(fh, fh_out, fh_log, fh_metrics, name, format):
+
+    print("Running . . .")
+
+    pipeline = stages(format=format)
+    variants = variantCache()
+    before = variants.getCounts() if variants is not None else None
+    with metrics.Stopwatch() as watch:
+        ann.annotateStream(fh, fh_out, pipeline, format=format,
+            chunk_size=CHUNK_SIZE, backend=reference(), cache=variants,
+            snapshot=referenceSnapshot())
+    cached = None
+    if variants is not None:
+        cached = cacheCounts(before, variants.getCounts())
+
+    for stage in pipeline:
+        stage.writeLog(fh_log)
+    for stage in pipeline:
+        print(f"{stage.label} - done.")
+
+    metrics.dumpMetrics(fh_metrics, name, getattr(fh, 'bytes', None),
+        getattr(fh_out, 'bytes', None), pipeline, watch.wall, watch.cpu,
+        cache=cached)
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,111 @@
+# genefetch.py
+#
+# Reads of refGene and cpgIslandExt shared by the stages of a job
+#
+# The gene location stages and the refGene overlap stage look the same
+# variants up in refGene, each with its own window around the
+# transcripts, and the promoter test asks cpgIslandExt about neighbouring
+# positions again and again. annotateStream() makes one GeneFetch per
+# job and hands it to every stage. For a chunk of one chromosome it reads
+# the rows around its positions with one query per stretch of
+# intervals.MAX_SPAN bases they fall in, widened by the largest window
+# any stage of the job uses, and answers every stage and window from
+# them until a chunk falls outside. Whole chromosomes, for the stages
+# that index them in memory, are read once per job.
+#
+##
+
+import intervals
+
+"""Rows of refGene-like tables and of cpgIslandExt read for a job
+   margin is the widest window, on each side of a position, the stages
+   of the job look for transcripts in.
+"""
+class GeneFetch(object):
+
+    def __init__(self, margin=0):
+        self.margin = margin
+        self.spans = {}
+        self.chroms = {}
+
+    """Rows of table around positions of chrom, as (start, end, row),
+       read again only when a window of offset around them is not
+       covered by the rows already held
+    """
+    def span(self, backend, cursor, table, chrom, positions, offset,
+        startName, endName, columns):
+
+        key = (table, str(chrom))
+        first = min(positions)
+        last = max(positions)
+        held = self.spans.get(key)
+        if (held is None) or (first - offset < held['first']) or \
+            (last + offset > held['last']):
+            margin = max(offset, self.margin)
+            rows = backend.regions(cursor, table, chrom, startName=startName,
+                endName=endName, columns=columns,
+                span=(first - margin, last + margin))
+            held = {'first': first - margin, 'last': last + margin,
+                'rows': [(int(row[0]), int(row[1]), row[2:]) for row in rows \
+                    if (row[0] is not None) and (row[1] is not None)],
+                'indexes': {}}
+            self.spans[key] = held
+        return held
+
+    """For each position of chrom, the transcripts of table whose span,
+       widened by offset on both sides, contains it, in database order,
+       as backend.geneModels() returns them
+    """
+    def transcripts(self, backend, cursor, table, chrom, positions, offset=0):
+        found = {}
+        for block in intervals.spanBlocks(sorted(set(positions)),
+            len(positions)):
+            held = self.span(backend, cursor, table, chrom, block, offset,
+                'txStart', 'txEnd', '*')
+            if offset not in held['indexes']:
+                rows = held['rows']
+                held['indexes'][offset] = intervals.IntervalIndex(
+                    [start - offset for start, end, row in rows],
+                    [end + offset for start, end, row in rows],
+                    [row for start, end, row in rows])
+            found.update(zip(block, held['indexes'][offset].query(block)))
+        return [found[pos] for pos in positions]
+
+    """For each position of chrom, the cpgIslandExt rows (chrom,
+       chromStart, chromEnd, name) overlapping it, in database order
+    """
+    def cpgIslands(self, backend, cursor, chrom, positions):
+        found = {}
+        for block in intervals.spanBlocks(sorted(set(positions)),
+            len(positions)):
+            held = self.span(backend, cursor, 'cpgIslandExt', chrom, block, 0,
+                'chromStart', 'chromEnd', 'chrom, chromStart, chromEnd, name')
+            if 0 not in held['indexes']:
+                rows = held['rows']
+                held['indexes'][0] = intervals.IntervalIndex(
+                    [start for start, end, row in rows],
+                    [end for start, end, row in rows],
+                    [row for start, end, row in rows])
+            found.update(zip(block, held['indexes'][0].query(block)))
+        return [found[pos] for pos in positions]
+
+    """Every row of one chromosome of table, read once per job
+    """
+    def chromRows(self, backend, cursor, table, chrom):
+        key = (table, str(chrom))
+        if key not in self.chroms:
+            self.chroms[key] = backend.pointLookup(cursor, table,
+                [('chrom', chrom)])
+        return self.chroms[key]
+
+    """Every CpG island of one chromosome, as an intervals.IntervalIndex,
+       read once per job
+    """
+    def chromIslands(self, backend, cursor, chrom):
+        key = ('cpgIslandExt', str(chrom))
+        if key not in self.chroms:
+            self.chroms[key] = intervals.fromRows(backend.regions(cursor,
+                'cpgIslandExt', chrom, columns='chrom, chromStart, chromEnd, name'))
+        return self.chroms[key]
+
+### EOF
@@ -0,0 +1,250 @@
+# genemap.py
+#
+# Gene segmentation map of refGene, for the gene location stages
+#
+# Every chromosome is cut at each point where some transcript's promoter
+# region, span, CDS, UTRs or exons, or a CpG island, starts or ends. In
+# each segment between two cuts, a position falls in the same parts of
+# the same transcripts. The map stores, for each segment, the location
+# (see annotate.locateTranscript) in every transcript the gene models
+# query returns there, and the CpG island the promoter lookup returns.
+# Locating a variant then takes one binary search. The map is kept in
+# the reference snapshot (see snapshot.py), in <path>/<version>/geneMap/:
+#
+#   <n>.bounds.npy     where each segment starts, sorted
+#   <n>.first.npy      first entry of each segment, and the end of the last
+#   <n>.tx.npy         transcript of each entry, in database order
+#   <n>.flags.npy      location flags of each entry
+#   <n>.exons.npy      exon numbers of each entry, as an exons.* code
+#   <n>.cpg.npy        CpG island name of each segment, as a values.* code
+#   <n>.names.npy      gene names prefix of each transcript, as a values.* code
+#   <n>.strand.npy     strand of each transcript, as a values.* code
+#   <n>.exonCount.npy  exon count of each transcript
+#
+# The map is built for one promoter offset; stages with another offset
+# keep querying the database.
+#
+##
+
+import os
+
+import numpy as np
+
+import annotate as ann
+import intervals
+import snapshot
+
+TABLE = 'refGene'
+PROMOTER_OFFSET = 500
+
+"""The gene map of a snapshot, opened read-only
+"""
+class GeneMapIndex(object):
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.chroms = entry['chroms']
+        self.table = entry['table']
+        self.promoter_offset = entry['promoterOffset']
+        self.values = snapshot.readValues(path)
+        self.exons = snapshot.readValues(path, 'exons')
+        self.decoded = {}
+        self.arrays = {}
+
+    def matches(self, table, promoter_offset):
+        return (table == self.table) and \
+            (int(promoter_offset) == self.promoter_offset)
+
+    def load(self, n, name):
+        return np.load(os.path.join(self.path, str(n) + '.' + name + '.npy'),
+            mmap_mode='r')
+
+    def chromArrays(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.arrays:
+            n = snapshot.chromNumber(self.chroms, chrom)
+            arrays = None
+            if n is not None:
+                arrays = dict([(name, self.load(n, name)) for name in [
+                    'bounds', 'first', 'tx', 'flags', 'exons', 'cpg', 'names',
+                    'strand', 'exonCount']])
+            self.arrays[chrom] = arrays
+        return self.arrays[chrom]
+
+    def value(self, code):
+        return self.values[int(code)][0]
+
+    def exonNumbers(self, code):
+        code = int(code)
+        if code not in self.decoded:
+            text = self.exons[code][0]
+            self.decoded[code] = tuple([int(x) for x in text.split(',')]) \
+                if text else ()
+        return self.decoded[code]
+
+    """For each position of chrom, the list of its transcript locations
+       and the CpG island at the position, or None
+    """
+    def lookup(self, chrom, positions):
+        a = self.chromArrays(chrom)
+        if (a is None) or (len(positions) == 0):
+            return [([], None) for p in positions]
+
+        segments = np.searchsorted(a['bounds'], np.asarray(positions,
+            dtype=np.int64), side='right') - 1
+        results = []
+        for k in segments.tolist():
+            if (k < 0):
+                results.append(([], None))
+                continue
+            transcripts = []
+            for i in range(int(a['first'][k]), int(a['first'][k + 1])):
+                tx = int(a['tx'][i])
+                transcripts.append((self.value(a['names'][tx]),
+                    self.value(a['strand'][tx]), int(a['exonCount'][tx]),
+                    int(a['flags'][i]), self.exonNumbers(a['exons'][i])))
+            results.append((transcripts, self.value(a['cpg'][k])))
+        return results
+
+
+"""Inclusive [start, end] parts of a transcript that decide its location
+   flags, and its exons
+"""
+def transcriptParts(row, promoter_offset):
+    txStart = int(row[4])
+    txEnd = int(row[5])
+    cdsStart = int(row[6])
+    cdsEnd = int(row[7])
+    strand = str(row[3])
+    parts = [(cdsStart, cdsEnd, ann.IN_CDS), (txStart, cdsStart, ann.BEFORE_CDS),
+        (cdsEnd, txEnd, ann.AFTER_CDS)]
+    if (strand == '+'):
+        parts.append((txStart - promoter_offset, txStart, ann.IN_PROMOTER))
+    elif (strand == '-'):
+        parts.append((txEnd, txEnd + promoter_offset, ann.IN_PROMOTER))
+
+    exonCount = int(row[8])
+    starts = str(row[9].decode("utf-8")).split(',')
+    ends = str(row[10].decode("utf-8")).split(',')
+    exons = [(int(starts[e]), int(ends[e])) for e in range(0, exonCount)]
+    return parts, exons
+
+
+"""Writes the map of one chromosome
+   rows are the refGene rows of the chromosome and islands its
+   cpgIslandExt rows, both in database order.
+"""
+def writeChrom(path, n, rows, islands, promoter_offset, values, exonValues):
+    def save(name, array):
+        np.save(os.path.join(path, str(n) + '.' + name + '.npy'), array)
+
+    rows = [row for row in rows if (row[4] is not None) and (row[5] is not None)]
+    islands = [row for row in islands if (row[1] is not None) and (row[2] is not None)]
+
+    cuts = set([])
+    transcripts = []
+    for row in rows:
+        parts, exons = transcriptParts(row, promoter_offset)
+        span = (int(row[4]) - promoter_offset, int(row[5]) + promoter_offset)
+        for start, end in [span] + [p[:2] for p in parts] + exons:
+            if (start <= end):
+                cuts.update([start, end + 1])
+        transcripts.append((span, parts, exons))
+    for row in islands:
+        if (int(row[1]) <= int(row[2])):
+            cuts.update([int(row[1]), int(row[2]) + 1])
+    bounds = np.array(sorted(cuts), dtype=np.int64)
+
+    # Entries of every transcript over the segments its span covers
+    segs = []
+    txs = []
+    flags = []
+    exonCodes = []
+    for tx, (row, (span, parts, exons)) in enumerate(zip(rows, transcripts)):
+        if (span[0] > span[1]):
+            continue
+        k0 = int(np.searchsorted(bounds, span[0]))
+        k1 = int(np.searchsorted(bounds, span[1] + 1))
+        starts = bounds[k0:k1]
+
+        f = np.zeros(len(starts), dtype=np.uint8)
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        if (cdsStart == cdsEnd):
+            f = f | ann.NON_CODING
+        if (cdsStart < cdsEnd):
+            f = f | ann.CODING
+        for start, end, flag in parts:
+            f = f | np.where((starts >= start) & (starts <= end), flag, 0).astype(np.uint8)
+
+        exonCount = len(exons)
+        hits = [[] for s in starts]
+        for e, (start, end) in enumerate(exons):
+            exnum = exonCount - e if (str(row[3]) == '-') else e + 1
+            for k in np.nonzero((starts >= start) & (starts <= end))[0].tolist():
+                hits[k].append(str(exnum))
+
+        segs.extend(range(k0, k1))
+        txs.extend([tx] * len(starts))
+        flags.extend(f.tolist())
+        exonCodes.extend([exonValues.code(','.join(h)) for h in hits])
+
+    segs = np.array(segs, dtype=np.int64)
+    txs = np.array(txs, dtype=np.int64)
+    order = np.lexsort((txs, segs))
+    save('bounds', bounds)
+    save('first', np.searchsorted(segs[order], np.arange(len(bounds) + 1)))
+    save('tx', txs[order])
+    save('flags', np.array(flags, dtype=np.uint8)[order])
+    save('exons', np.array(exonCodes, dtype=np.uint32)[order])
+
+    # First island of each segment, in database order, as the promoter
+    # lookup returns it
+    index = intervals.IntervalIndex([int(row[1]) for row in islands],
+        [int(row[2]) for row in islands], islands)
+    cpg = [values.code("".join(str(found[0][3]).split()) if found else None)
+        for found in index.query(bounds)] if len(islands) > 0 else \
+        [values.code(None)] * len(bounds)
+    save('cpg', np.array(cpg, dtype=np.uint32))
+
+    save('names', np.array([values.code(ann.geneNamesPrefix(row)) for row in rows],
+        dtype=np.uint32))
+    save('strand', np.array([values.code(str(row[3])) for row in rows],
+        dtype=np.uint32))
+    save('exonCount', np.array([int(row[8]) for row in rows], dtype=np.int64))
+
+
+"""Builds the gene map of refGene from the reference database into
+   path/geneMap, one chromosome at a time
+   Returns the manifest entry of the map.
+"""
+def dumpGeneMap(backend, conn, path, table='geneMap',
+    promoter_offset=PROMOTER_OFFSET):
+
+    path = os.path.join(path, table)
+    os.makedirs(path, exist_ok=True)
+
+    cursor = backend.cursor(conn)
+    cursor.execute('select distinct chrom from ' + TABLE)
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+    values = snapshot.ValueTable()
+    exonValues = snapshot.ValueTable()
+    files = {}
+    count = 0
+    for n, chrom in enumerate(chroms):
+        rows = backend.pointLookup(cursor, TABLE, [('chrom', chrom)])
+        islands = backend.pointLookup(cursor, 'cpgIslandExt', [('chrom', chrom)],
+            columns='chrom, chromStart, chromEnd, name')
+        writeChrom(path, n, rows, islands, promoter_offset, values, exonValues)
+        files[chrom] = n
+        count = count + len(rows)
+    cursor.close()
+    values.write(path)
+    exonValues.write(path, 'exons')
+
+    print(f"{table}: {count} transcripts of {TABLE} in {len(files)} chromosomes")
+    return {'kind': 'genemap', 'table': TABLE,
+        'promoterOffset': promoter_offset, 'chroms': files}
+
+### EOF
@@ -0,0 +1,140 @@
+# genemodels.py
+#
+# Vectorized location of variant chunks in the gene models of refGene
+#
+# The transcripts of one chromosome are loaded once into arrays: spans,
+# CDS bounds, strands and the exons of all of them laid end to end. A
+# whole chunk of positions is then located at once, with searchsorted
+# for the transcripts whose span contains each position and array
+# comparisons for the CDS, UTRs, promoter and exons, giving the same
+# transcript locations as annotate.locateTranscript().
+#
+##
+
+import numpy as np
+
+import annotate as ann
+
+"""Transcripts of one chromosome of a refGene-like table
+   rows are in database order, which the locations keep.
+"""
+class GeneModels(object):
+
+    def __init__(self, rows, promoter_offset):
+        rows = [row for row in rows if (row[4] is not None) and (row[5] is not None)]
+        offset = int(promoter_offset)
+
+        self.names = [ann.geneNamesPrefix(row) for row in rows]
+        self.strands = [str(row[3]) for row in rows]
+        self.txStart = np.array([int(row[4]) for row in rows], dtype=np.int64)
+        self.txEnd = np.array([int(row[5]) for row in rows], dtype=np.int64)
+        self.cdsStart = np.array([int(row[6]) for row in rows], dtype=np.int64)
+        self.cdsEnd = np.array([int(row[7]) for row in rows], dtype=np.int64)
+        self.exonCount = np.array([int(row[8]) for row in rows], dtype=np.int64)
+
+        plus = np.array([strand == '+' for strand in self.strands], dtype=bool)
+        minus = np.array([strand == '-' for strand in self.strands], dtype=bool)
+        self.kind = np.where(self.cdsStart == self.cdsEnd, ann.NON_CODING, 0) | \
+            np.where(self.cdsStart < self.cdsEnd, ann.CODING, 0)
+        # Promoter regions; empty for transcripts without a strand
+        self.promoterStart = np.where(plus, self.txStart - offset,
+            np.where(minus, self.txEnd, 1))
+        self.promoterEnd = np.where(plus, self.txStart,
+            np.where(minus, self.txEnd + offset, 0))
+
+        # Exons of every transcript, one after the other, with their
+        # numbers counted along the strand
+        starts = []
+        ends = []
+        numbers = []
+        for row, strand in zip(rows, self.strands):
+            exonCount = int(row[8])
+            exonsSt = str(row[9].decode("utf-8")).split(',')
+            exonsEn = str(row[10].decode("utf-8")).split(',')
+            for e in range(0, exonCount):
+                starts.append(int(exonsSt[e]))
+                ends.append(int(exonsEn[e]))
+                numbers.append(exonCount - e if (strand == '-') else e + 1)
+        self.exonStart = np.array(starts, dtype=np.int64)
+        self.exonEnd = np.array(ends, dtype=np.int64)
+        self.exonNumber = np.array(numbers, dtype=np.int64)
+        self.exonFirst = np.cumsum(self.exonCount) - self.exonCount
+
+        # Spans widened by the promoter offset, as the gene models query
+        # matches them, sorted by start with a running maximum of the ends
+        spanStart = self.txStart - offset
+        spanEnd = self.txEnd + offset
+        self.order = np.argsort(spanStart, kind='stable')
+        self.spanStart = spanStart[self.order]
+        self.spanEnd = spanEnd[self.order]
+        self.maxEnds = np.maximum.accumulate(self.spanEnd) if len(rows) > 0 \
+            else self.spanEnd
+
+    def __len__(self):
+        return len(self.names)
+
+    """Candidate (position, transcript) pairs: every transcript whose
+       widened span contains each position
+    """
+    def pairs(self, positions):
+        lo = np.searchsorted(self.maxEnds, positions, side='left')
+        hi = np.searchsorted(self.spanStart, positions, side='right')
+        counts = np.maximum(hi - lo, 0)
+        owner = np.repeat(np.arange(len(positions)), counts)
+        slots = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(lo, counts)
+        keep = self.spanEnd[slots] >= positions[owner]
+        owner = owner[keep]
+        tx = self.order[slots[keep]]
+
+        # By position, then in database order
+        order = np.lexsort((tx, owner))
+        return owner[order], tx[order]
+
+    """Location flags of each (position, transcript) pair, as in
+       annotate.locateTranscript()
+    """
+    def flags(self, pos, tx):
+        def between(start, end, flag):
+            return np.where((start[tx] <= pos) & (pos <= end[tx]), flag, 0)
+
+        return self.kind[tx] | between(self.cdsStart, self.cdsEnd, ann.IN_CDS) | \
+            between(self.txStart, self.cdsStart, ann.BEFORE_CDS) | \
+            between(self.cdsEnd, self.txEnd, ann.AFTER_CDS) | \
+            between(self.promoterStart, self.promoterEnd, ann.IN_PROMOTER)
+
+    """Numbers of the exons containing the position of each pair, as
+       lists by pair, in exon order
+    """
+    def exonHits(self, pos, tx):
+        counts = self.exonCount[tx]
+        pair = np.repeat(np.arange(len(tx)), counts)
+        exon = np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(self.exonFirst[tx], counts)
+        hit = (self.exonStart[exon] <= pos[pair]) & (pos[pair] <= self.exonEnd[exon])
+
+        hits = [[] for t in tx]
+        for p, number in zip(pair[hit].tolist(), self.exonNumber[exon[hit]].tolist()):
+            hits[p].append(number)
+        return hits
+
+    """Transcript locations of each position, see
+       annotate.locateTranscript(), for the whole chunk at once
+    """
+    def locate(self, positions):
+        results = [[] for p in positions]
+        if (len(self) == 0) or (len(positions) == 0):
+            return results
+
+        positions = np.asarray(positions, dtype=np.int64)
+        owner, tx = self.pairs(positions)
+        pos = positions[owner]
+        flags = self.flags(pos, tx)
+        hits = self.exonHits(pos, tx)
+
+        for i, t, f, exons in zip(owner.tolist(), tx.tolist(), flags.tolist(), hits):
+            results[i].append((self.names[t], self.strands[t],
+                int(self.exonCount[t]), f, tuple(exons)))
+        return results
+
+### EOF
@@ -0,0 +1,134 @@
+# gwascatalog.py
+#
+# Exact-position index of gwasCatalog
+#
+# The gwasCatalog stage matches a variant on chromEnd = pos and writes
+# the pubMedID and trait of every row it finds. The index keeps, for
+# each chromosome, the distinct chromEnd values and the fragments their
+# rows render to, so a lookup is one dictionary access. It is kept in
+# the reference snapshot (see snapshot.py), in <path>/<version>/gwasIndex/:
+#
+#   <n>.end.npy    distinct chromEnd values, sorted
+#   <n>.first.npy  first fragment of each value, and the end of the last
+#   <n>.text.npy   fragment of each row, as a values.* code, in database
+#                  order within each value
+#
+# Fragments are rendered for the table name the index is built from;
+# stages reading another table keep querying the database.
+#
+##
+
+import os
+
+import numpy as np
+
+import annotate as ann
+import snapshot
+
+TABLE = 'gwasCatalog'
+
+"""The gwasCatalog index of a snapshot, opened read-only
+"""
+class GwasCatalogIndex(object):
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.chroms = entry['chroms']
+        self.table = entry['table']
+        self.values = snapshot.readValues(path)
+        self.keys = {}
+
+    def matches(self, table):
+        return (table == self.table)
+
+    def load(self, n, name):
+        return np.load(os.path.join(self.path, str(n) + '.' + name + '.npy'),
+            mmap_mode='r')
+
+    """Slots of a chromosome, position -> (first, last) fragment, and
+       its fragment codes, loaded the first time it is needed, or None if
+       it has no rows
+    """
+    def chromKeys(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.keys:
+            n = snapshot.chromNumber(self.chroms, chrom)
+            keys = None
+            if n is not None:
+                first = self.load(n, 'first').tolist()
+                slots = dict([(end, (first[k], first[k + 1])) for k, end in \
+                    enumerate(self.load(n, 'end').tolist())])
+                keys = (slots, self.load(n, 'text'))
+            self.keys[chrom] = keys
+        return self.keys[chrom]
+
+    """For each position of chrom, the fragments of the rows whose
+       chromEnd is the position
+    """
+    def lookup(self, chrom, positions):
+        keys = self.chromKeys(chrom)
+        if keys is None:
+            return [[] for p in positions]
+
+        slots, text = keys
+        results = []
+        for pos in positions:
+            found = slots.get(int(pos))
+            if found is None:
+                results.append([])
+            else:
+                results.append([self.values[int(code)][0] for code in \
+                    text[found[0]:found[1]]])
+        return results
+
+
+"""Writes the index of one chromosome
+   rows are (chromEnd, row) in database order.
+"""
+def writeChrom(path, n, rows, table, values):
+    def save(name, array):
+        np.save(os.path.join(path, str(n) + '.' + name + '.npy'), array)
+
+    ends = np.array([end for end, row in rows], dtype=np.int64)
+    order = np.argsort(ends, kind='stable')
+    distinct, first = np.unique(ends[order], return_index=True)
+    save('end', distinct)
+    save('first', np.append(first, len(rows)).astype(np.int64))
+    save('text', np.array([values.code(ann.gwasCatalogFragment(table, row)) \
+        for end, row in rows], dtype=np.uint32)[order])
+
+
+"""Builds the index of gwasCatalog from the reference database into
+   path/gwasIndex, one chromosome at a time
+   Returns the manifest entry of the index.
+"""
+def dumpGwasCatalog(backend, conn, path, table='gwasIndex'):
+    path = os.path.join(path, table)
+    os.makedirs(path, exist_ok=True)
+
+    cursor = backend.cursor(conn)
+    cursor.execute('select distinct chrom from ' + TABLE)
+    chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+    values = snapshot.ValueTable()
+    files = {}
+    count = 0
+    for n, chrom in enumerate(chroms):
+        # In the order of the lookups on chromEnd the stage makes
+        rows = backend.pointLookup(cursor, TABLE, [('chrom', chrom)],
+            order=['chrom', 'chromEnd'])
+        columns = [d[0] for d in cursor.description]
+        endCol = columns.index('chromEnd')
+        rows = [(int(row[endCol]), row) for row in rows \
+            if row[endCol] is not None]
+        writeChrom(path, n, rows, TABLE, values)
+        files[chrom] = n
+        count = count + len(rows)
+    cursor.close()
+    values.write(path)
+
+    print(f"{table}: {count} rows of {TABLE} in {len(files)} chromosomes, " + \
+        f"{len(values.values)} distinct fragments")
+    return {'kind': 'gwascatalog', 'table': TABLE, 'chroms': files}
+
+### EOF
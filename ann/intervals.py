@@ -0,0 +1,96 @@
+# intervals.py
+#
+# In-memory interval index for the region-overlap annotation tables
+#
+##
+
+import numpy as np
+
+# Widest stretch of a chromosome, in bases, one batched read of a region
+# table covers; positions further apart are read separately
+MAX_SPAN = 100000
+
+"""Point-in-interval index over the rows of one chromosome of a table
+   Intervals are sorted by start; a running maximum of the ends lets a
+   query skip every interval that finishes before the position, so only
+   the intervals between that point and the last start <= position are
+   checked. Both bounds are inclusive, as in the SQL queries:
+   start <= pos AND pos <= end.
+"""
+class IntervalIndex(object):
+
+    def __init__(self, starts, ends, rows):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.maxEnds = np.maximum.accumulate(self.ends) if len(order) > 0 \
+            else self.ends
+        # Position of each interval in the table as loaded, used to hand
+        # back matches in the same order the database returned them
+        self.order = order
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    """Returns, for every position, the list of rows overlapping it
+    """
+    def query(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        lo = np.searchsorted(self.maxEnds, positions, side='left')
+        hi = np.searchsorted(self.starts, positions, side='right')
+
+        results = []
+        for pos, l, h in zip(positions, lo, hi):
+            if (l >= h):
+                results.append([])
+                continue
+            hits = l + np.nonzero(self.ends[l:h] >= pos)[0]
+            results.append([self.rows[i] for i in np.sort(self.order[hits])])
+        return results
+
+
+"""Splits sorted positions into blocks of at most size positions, each
+   spanning at most max_span bases, so reading the regions between the
+   first and last position of a block stays cheap however sparse the
+   positions are. A position far from the others is a block of its own.
+"""
+def spanBlocks(positions, size, max_span=None):
+    if max_span is None:
+        max_span = MAX_SPAN
+    blocks = []
+    for pos in positions:
+        if (len(blocks) > 0) and (len(blocks[-1]) < size) and \
+            (pos - blocks[-1][0] <= max_span):
+            blocks[-1].append(pos)
+        else:
+            blocks.append([pos])
+    return blocks
+
+
+"""Builds an index from rows of the form (start, end, <table columns>...)
+   Only the table columns are kept for the caller.
+"""
+def fromRows(rows):
+    starts = [int(row[0]) for row in rows]
+    ends = [int(row[1]) for row in rows]
+    return IntervalIndex(starts, ends, [row[2:] for row in rows])
+
+
+"""Wraps arrays that are already sorted by start, like those of a
+   snapshot.Snapshot, without copying them
+   order gives the position in rows of each interval.
+"""
+def fromSorted(starts, ends, maxEnds, order, rows):
+    index = IntervalIndex.__new__(IntervalIndex)
+    index.starts = starts
+    index.ends = ends
+    index.maxEnds = maxEnds
+    index.order = order
+    index.rows = rows
+    return index
+
+### EOF
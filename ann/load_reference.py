@@ -0,0 +1,139 @@
+# load_reference.py
+#
+# Builds the local SQLite copy of the annotator reference tables
+#
+# Each table is read from a tab-separated dump with a header row, as
+# written by the mysql client in batch mode:
+#
+#   mysql --batch -e 'select * from dbSNP' annotator > dbSNP.tsv
+#
+# and loaded into a table named after the file:
+#
+#   python load_reference.py reference.sqlite dumps/*.tsv
+#
+##
+
+import os
+import re
+import sys
+import sqlite3
+
+BATCH_SIZE = 10000
+
+# Columns the stages filter on, first match of each list is indexed
+CHROM_COLUMNS = ['CHR', 'chrom', 'chromosome']
+START_COLUMNS = ['POS', 'start', 'txStart', 'chromStart']
+
+# longblob columns of the UCSC gene tables, which MySQL hands back as bytes
+BLOB_COLUMNS = ['exonStarts', 'exonEnds', 'exonFrames']
+
+# Lookups that do not go through the chromosome and start columns
+EXTRA_INDEXES = {'gwasCatalog': ['chrom', 'chromEnd']}
+
+INTEGER = re.compile(r'^-?(0|[1-9][0-9]*)$')
+ESCAPES = {'\\t': '\t', '\\n': '\n', '\\0': '\0', '\\\\': '\\'}
+
+"""Converts one dump field of the given column type: NULL becomes None
+   and batch mode escapes are undone
+"""
+def parse_value(value, type='text'):
+    if (value == 'NULL'):
+        return None
+    if (type == 'integer'):
+        return int(value)
+    if ('\\' in value):
+        value = re.sub(r'\\[tn0\\]', lambda m: ESCAPES[m.group(0)], value)
+    if (type == 'blob'):
+        return value.encode('utf-8')
+    return value
+
+
+"""Returns the type of every column of the dump: integer when all its
+   values are, so range conditions compare numerically, blob for
+   BLOB_COLUMNS, and text otherwise
+"""
+def column_types(path):
+    fh = open(path)
+    columns = fh.readline().rstrip('\n').split('\t')
+    integers = [True for c in columns]
+    for line in fh:
+        for i, value in enumerate(line.rstrip('\n').split('\t')):
+            if integers[i] and (value != 'NULL') and not INTEGER.match(value):
+                integers[i] = False
+    fh.close()
+
+    types = []
+    for i, column in enumerate(columns):
+        if column in BLOB_COLUMNS:
+            types.append('blob')
+        elif integers[i]:
+            types.append('integer')
+        else:
+            types.append('text')
+    return types
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def index_columns(table, columns):
+    indexes = []
+    chrom = [c for c in CHROM_COLUMNS if c in columns]
+    start = [c for c in START_COLUMNS if c in columns]
+    if (len(start) > 0):
+        indexes.append(chrom[:1] + start[:1])
+    if table in EXTRA_INDEXES:
+        indexes.append(EXTRA_INDEXES[table])
+    return indexes
+
+
+"""Loads one dump file into table, replacing any previous copy
+   Text columns compare without case, like in MySQL.
+"""
+def load_table(db, table, path):
+    types = column_types(path)
+    fh = open(path)
+    columns = fh.readline().rstrip('\n').split('\t')
+
+    declared = [(t + ' collate nocase' if t == 'text' else t) for t in types]
+    db.execute('drop table if exists ' + quote(table))
+    db.execute('create table ' + quote(table) + ' (' + \
+        ', '.join([quote(c) + ' ' + t for c, t in zip(columns, declared)]) + ')')
+
+    sql = 'insert into ' + quote(table) + ' values (' + \
+        ','.join(['?'] * len(columns)) + ')'
+    count = 0
+    batch = []
+    for line in fh:
+        values = line.rstrip('\n').split('\t')
+        batch.append([parse_value(v, types[i]) for i, v in enumerate(values)])
+        if (len(batch) >= BATCH_SIZE):
+            db.executemany(sql, batch)
+            count = count + len(batch)
+            batch = []
+    db.executemany(sql, batch)
+    count = count + len(batch)
+    fh.close()
+
+    for n, index in enumerate(index_columns(table, columns)):
+        db.execute('create index ' + quote(table + '_idx' + str(n)) + \
+            ' on ' + quote(table) + ' (' + ', '.join([quote(c) for c in index]) + ')')
+
+    db.commit()
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        db = sqlite3.connect(sys.argv[1])
+        for path in sys.argv[2:]:
+            table = os.path.splitext(os.path.basename(path))[0]
+            count = load_table(db, table, path)
+            print(f"{table}: {count} rows")
+        db.execute('analyze')
+        db.close()
+    else:
+        print("Usage: python load_reference.py <sqlite file> <table dump> [...]")
+
+### EOF
@@ -0,0 +1,122 @@
+# metrics.py
+#
+# Per-stage performance figures for the annotation pipeline
+#
+##
+
+import os
+import json
+import time
+
+"""Wall time, CPU time and work done by one annotation stage
+   bytes_written is what the stage added to the output lines.
+"""
+class StageMetrics(object):
+    fields = ['wall_time', 'cpu_time', 'variants', 'queries', 'rows',
+        'bytes_written']
+
+    def __init__(self):
+        for name in self.fields:
+            setattr(self, name, 0)
+
+    def toDict(self):
+        return dict([(name, getattr(self, name)) for name in self.fields])
+
+    """Adds the figures of another run of the same stage, e.g. a shard
+    """
+    def add(self, other):
+        for name in self.fields:
+            setattr(self, name, getattr(self, name) + other[name])
+
+
+"""Metrics of a stage that checks a prefilter before its lookups:
+   prefilter_hits variants may be in the table and were looked up,
+   prefilter_skips certainly are not and were not
+"""
+class PrefilterMetrics(StageMetrics):
+    fields = StageMetrics.fields + ['prefilter_hits', 'prefilter_skips']
+
+
+"""Database cursor that counts the queries run and rows fetched through it
+"""
+class CountingCursor(object):
+
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def execute(self, *args, **kwargs):
+        self.metrics.queries = self.metrics.queries + 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.metrics.rows = self.metrics.rows + 1
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.metrics.rows = self.metrics.rows + len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Times a block of work, in wall clock and process CPU seconds
+"""
+class Stopwatch(object):
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+
+"""Writes the JSON sidecar of an annotation run
+   Stages are listed in the order they were applied; cache holds the
+   variant cache counts of the run, if it used one.
+"""
+def writeMetrics(path, infile, outfile, stages, wall_time, cpu_time,
+    workers=1, cache=None):
+
+    fh = open(path, 'w')
+    dumpMetrics(fh, os.path.basename(infile), os.path.getsize(infile),
+        os.path.getsize(outfile), stages, wall_time, cpu_time,
+        workers=workers, cache=cache)
+    fh.close()
+
+
+"""Writes the JSON sidecar to the open stream fh, for runs whose input
+   and output are not local files
+"""
+def dumpMetrics(fh, name, bytes_read, bytes_written, stages, wall_time,
+    cpu_time, workers=1, cache=None):
+
+    summary = {
+        'file': name,
+        'workers': workers,
+        'wall_time': round(wall_time, 6),
+        'cpu_time': round(cpu_time, 6),
+        'bytes_read': bytes_read,
+        'bytes_written': bytes_written,
+        'stages': []
+    }
+    if cache is not None:
+        summary['cache'] = cache
+    for stage in stages:
+        figures = {'stage': stage.label}
+        figures.update(stage.metrics.toDict())
+        figures['wall_time'] = round(figures['wall_time'], 6)
+        figures['cpu_time'] = round(figures['cpu_time'], 6)
+        summary['stages'].append(figures)
+
+    json.dump(summary, fh, indent=2)
+    fh.write('\n')
+
+### EOF
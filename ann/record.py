@@ -0,0 +1,89 @@
+# record.py
+#
+# In-memory variant record passed between the annotation stages
+#
+##
+
+"""One data line of a VCF (or pileup) file
+   CHROM, POS, REF and ALT are parsed once when the line is read. chrom is
+   the chromosome without a "chr" prefix and chr the one with it, since
+   reference tables use either. INFO is kept as the list of its ';'
+   separated fragments, so stages append to it without rebuilding the
+   string, and the line is only put back together by toLine().
+"""
+class VariantRecord(object):
+    __slots__ = ['columns', 'chrom', 'chr', 'pos', 'ref', 'alt', 'id',
+        'info', 'sep']
+
+    def __init__(self, line, inds, sep='\t'):
+        columns = line.split(sep)
+        self.columns = columns
+
+        chrom = columns[inds[0]].strip()
+        if chrom.startswith("chr"):
+            self.chr = chrom
+            self.chrom = chrom.replace('chr', '')
+        else:
+            self.chr = "chr" + chrom
+            self.chrom = chrom
+
+        self.pos = int(columns[inds[1]].strip())
+        # Quotes are dropped, as they would break the SQL lookups
+        self.ref = cleanAllele(columns[inds[2]])
+        self.alt = cleanAllele(columns[inds[3]])
+        self.id = columns[2]
+        self.info = columns[7].split(';')
+        self.sep = '\t'
+
+    def getInfo(self):
+        return ';'.join(self.info)
+
+    def setInfo(self, text):
+        self.info = text.split(';')
+
+    """Appends to INFO as INFO + ';' + text
+    """
+    def appendInfo(self, text):
+        self.info.extend(text.split(';'))
+
+    """Appends to INFO, without a second ';' if INFO already ends in one
+    """
+    def addInfo(self, text):
+        if (len(self.info) > 1) and (self.info[-1] == ''):
+            self.info.pop()
+        self.info.extend(text.split(';'))
+
+    """Value of the first INFO key containing 'key', as utils.parse_field
+       would return it for the quote-stripped INFO string
+    """
+    def findInfo(self, key):
+        last = len(self.info) - 1
+        for i, fragment in enumerate(self.info):
+            fragment = fragment.replace("\"", "").replace("\'", "")
+            if (i == 0):
+                fragment = fragment.lstrip()
+            if (i == last):
+                fragment = fragment.rstrip()
+            pairs = fragment.split('=')
+            if (pairs[0].find(str(key)) > -1):
+                return pairs[1]
+        return '.'
+
+    """Length of the parts of the line the stages change: ID, INFO and
+       the column separators
+    """
+    def annotatedLength(self):
+        return len(self.id) + sum([len(f) for f in self.info]) + \
+            len(self.info) + len(self.sep) * len(self.columns)
+
+    def toLine(self):
+        columns = list(self.columns)
+        columns[2] = self.id
+        columns[7] = ';'.join(self.info)
+        return self.sep.join(columns)
+
+
+def cleanAllele(allele):
+    return allele.replace("\"", "").replace("\'", "").strip()
+
+### EOF
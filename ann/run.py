@@ -12,16 +12,23 @@ __edited__ = 'Josemaria Macedo <josemaria@uchicago.edu'
 import sys
 import time
 import driver
+import s3_transfer
 import boto3
 import shutil
+import os
+import io
 import configparser
 
+# Clients are created once per process and reused by every job it runs
 S3_CLIENT = boto3.client("s3", region_name="us-east-1")
+SNS_CLIENT = boto3.client("sns", region_name="us-east-1")
+DYNAMO = boto3.resource("dynamodb", region_name="us-east-1")
 
 # Load the .ini file
 try:
     config = configparser.ConfigParser()
-    config.read('ann_config.ini')
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'ann_config.ini'))
 except Exception as e:
    print(f"Error when trying to load 'ann_config.ini' file. Message: {e}")
 
@@ -57,139 +64,214 @@ class Timer(object):
 # - Code from Lecture 4 "dynamo_writer.py" by Lionel Barrow
 # - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html#
 
-if __name__ == '__main__':
-   # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        file_path = sys.argv[1]
-        with Timer():
-            driver.run(file_path, 'vcf')
-        
-        file_path_split = file_path.split("/")
-        file = file_path_split[-1]
-        job_id = file_path_split[-2]
-        user_id = file_path_split[-3]
+"""Runs the AnnTools pipeline on a downloaded job input and publishes the
+   results: uploads the result, log and metrics files to S3, marks the job
+   COMPLETED in DynamoDB, deletes the local job files and notifies SNS
+   file_path is <job dir>/<user_id>/<job_id>/<input file>.
+   Returns True once the result and log files are uploaded; if either
+   upload fails the job is left as it was, so it can be run again.
+"""
+def run_job(file_path):
+    with Timer():
+        driver.run(file_path, 'vcf')
 
-        # Upload the annotation results file
-        file_annot = file.replace(".vcf", ".annot.vcf")
+    file_path_split = file_path.split("/")
+    file = file_path_split[-1]
+    job_id = file_path_split[-2]
+    user_id = file_path_split[-3]
 
-        # Get the AWS key prefix from the .ini file
-        key_prefix = aws_s3_key_prefix + user_id + "/"
-        key_annot = key_prefix + job_id + "~" + file_annot
-        path_annot = file_path.replace(file, file_annot)
+    # Upload the annotation results, log and metrics files at the same time
+    file_annot = file.replace(".vcf", ".annot.vcf")
 
-        try:
-          response = S3_CLIENT.put_object(
-             Body=open(path_annot, "rb"),
-             Bucket=s3_results_bucket,
-             Key=key_annot,
-             )
+    # Get the AWS key prefix from the .ini file
+    key_prefix = aws_s3_key_prefix + user_id + "/"
+    key_annot = key_prefix + job_id + "~" + file_annot
+    path_annot = file_path.replace(file, file_annot)
 
-        except Exception as e:
-           print(f"Error when trying to put ANNOTATION file in s3 bucket. Message: {e}")
-          
-        # Upload the log file
-        file_log = file + ".count.log"
-        key_log = key_prefix + job_id + "~" + file_log
-        path_log = file_path.replace(file, file_log)
+    file_log = file + ".count.log"
+    key_log = key_prefix + job_id + "~" + file_log
+    path_log = file_path.replace(file, file_log)
 
-        try:
-          response = S3_CLIENT.put_object(
-             Body=open(path_log, "rb"),
-             Bucket=s3_results_bucket,
-             Key=key_log,
-             )
-        except Exception as e:
-           print(f"Error when trying to put LOG file in s3 bucket. Message: {e}")
-
-        # Update database status to "COMPLETED"
-        complete_time = int(time.time())
-        job_status = "COMPLETED"
-        update_expression = 'SET job_status = :new_status, s3_results_bucket = :results_bucket,\
-                              s3_key_result_file = :result_file, s3_key_log_file = :log_file,\
-                                complete_time = :complete_time'
-        expression_attribute_values = {':new_status': 'COMPLETED',
-                                       ':results_bucket': s3_results_bucket,
-                                       ':result_file': key_annot, ':log_file': key_log,
-                                       ':complete_time': complete_time}
-        key = {"job_id": job_id}
+    # Per-stage metrics file written by the pipeline
+    file_metrics = file + ".metrics.json"
+    key_metrics = key_prefix + job_id + "~" + file_metrics
+    path_metrics = file_path.replace(file, file_metrics)
 
-        try:
-          dynamo = boto3.resource('dynamodb')
-          table = dynamo.Table(my_table)
-        except Exception as e:
-           print(f"Error when trying to create Dynamo DB object. Message: {e}")
+    errors = s3_transfer.upload_files(S3_CLIENT, s3_results_bucket,
+       [(path_annot, key_annot), (path_log, key_log), (path_metrics, key_metrics)])
 
-        try:
-          response = table.update_item(
-            Key=key,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_attribute_values
-            )
-        except Exception as e:
-           print(f"Error when trying to update Dynamo DB object. Message: {e}")
-        
-        # Delete local job files 
-        job_id_path = file_path.replace(file, "")
+    for name, e in zip(["ANNOTATION", "LOG", "METRICS"], errors):
+       if e is not None:
+          print(f"Error when trying to put {name} file in s3 bucket. Message: {e}")
+    # The metrics file is not part of the job's results
+    uploaded = (errors[0] is None) and (errors[1] is None)
+
+    # Without its results the job is not complete
+    if not uploaded:
+        shutil.rmtree(file_path.replace(file, ""), ignore_errors=True)
+        return False
+
+    # Delete local job files 
+    job_id_path = file_path.replace(file, "")
   
-        try:
-           shutil.rmtree(job_id_path)
-           print(f"Directory '{job_id_path}' and its file were deleted successfully.")
-        except Exception as e:
-           print(f"Error deleting directory {job_id_path}. Message: {e}")
+    try:
+       shutil.rmtree(job_id_path)
+       print(f"Directory '{job_id_path}' and its file were deleted successfully.")
+    except Exception as e:
+       print(f"Error deleting directory {job_id_path}. Message: {e}")
+
+    complete_job(job_id, user_id, file, key_annot, key_log)
+    return True
+
+
+"""Runs a job without local files: the input is streamed from S3 through
+   the pipeline and the results are uploaded in parts while it runs; the
+   count log and metrics are uploaded from memory at the end
+   Returns True once the result and log files are uploaded, like run_job;
+   if anything fails the partial upload is aborted.
+"""
+def run_stream_job(bucket, key, user_id, job_id, file):
+    file_annot = file.replace(".vcf", ".annot.vcf")
+    key_prefix = aws_s3_key_prefix + user_id + "/"
+    key_annot = key_prefix + job_id + "~" + file_annot
+    key_log = key_prefix + job_id + "~" + file + ".count.log"
+    key_metrics = key_prefix + job_id + "~" + file + ".metrics.json"
+
+    fh_log = io.StringIO()
+    fh_metrics = io.StringIO()
+    writer = s3_transfer.S3MultipartWriter(S3_CLIENT, s3_results_bucket, key_annot)
+    try:
+       reader = s3_transfer.S3LineReader(S3_CLIENT, bucket, key)
+       try:
+          with Timer():
+             driver.runStream(reader, writer, fh_log, fh_metrics, file, 'vcf')
+          reader.verify()
+       finally:
+          reader.close()
+       writer.close()
+       S3_CLIENT.put_object(Body=fh_log.getvalue().encode("utf-8"),
+          Bucket=s3_results_bucket, Key=key_log)
+    except Exception as e:
+       writer.abort()
+       print(f"Error when trying to stream job '{job_id}' through the pipeline. Message: {e}")
+       return False
+
+    try:
+       S3_CLIENT.put_object(Body=fh_metrics.getvalue().encode("utf-8"),
+          Bucket=s3_results_bucket, Key=key_metrics)
+    except Exception as e:
+       print(f"Error when trying to put METRICS file in s3 bucket. Message: {e}")
+
+    complete_job(job_id, user_id, file, key_annot, key_log)
+    return True
+
+
+"""Marks a job whose results are uploaded COMPLETED in DynamoDB and
+   notifies SNS, and the glacier topic for free users
+"""
+def complete_job(job_id, user_id, file, key_annot, key_log):
+    file_annot = file.replace(".vcf", ".annot.vcf")
+
+    # Update database status to "COMPLETED"
+    complete_time = int(time.time())
+    job_status = "COMPLETED"
+    update_expression = 'SET job_status = :new_status, s3_results_bucket = :results_bucket,\
+                          s3_key_result_file = :result_file, s3_key_log_file = :log_file,\
+                            complete_time = :complete_time'
+    expression_attribute_values = {':new_status': 'COMPLETED',
+                                   ':results_bucket': s3_results_bucket,
+                                   ':result_file': key_annot, ':log_file': key_log,
+                                   ':complete_time': complete_time}
+    key = {"job_id": job_id}
+
+    try:
+      table = DYNAMO.Table(my_table)
+    except Exception as e:
+       print(f"Error when trying to create Dynamo DB object. Message: {e}")
+
+    try:
+      response = table.update_item(
+        Key=key,
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attribute_values
+        )
+    except Exception as e:
+       print(f"Error when trying to update Dynamo DB object. Message: {e}")
         
-        # Send notificaton to SNS results topic 
-        try:
-           client = boto3.client('sns')
-        except Exception as e:
-             print({"code": 500,
-                    "error": "Error trying to create SNS client.",
-                    "message": str(e)})
-         
-        try:
-           item_key = {"job_id": job_id}
-           response = table.get_item(Key=item_key)
-           email = response["Item"]["email"]
-           user_role = response["Item"]["user_role"]
-        except Exception as e:
-           print(f"Email or user role wasn't extracted correctly for Dynamo table. Error: {e}")
+    # Send notificaton to SNS results topic 
+    client = SNS_CLIENT
+
+    try:
+       item_key = {"job_id": job_id}
+       response = table.get_item(Key=item_key)
+       email = response["Item"]["email"]
+       user_role = response["Item"]["user_role"]
+    except Exception as e:
+       print(f"Email or user role wasn't extracted correctly for Dynamo table. Error: {e}")
 
         
-        message_dict = {"job_id": job_id, "user_id": user_id, "file": file, "email": email}
-        message = str(message_dict)
+    message_dict = {"job_id": job_id, "user_id": user_id, "file": file, "email": email}
+    message = str(message_dict)
     
+    try:
+        response = client.publish(
+        TopicArn=topic_arn,
+        Message=message
+        )
+        message_id = response["MessageId"]
+    except Exception as e:
+       print({"code": 500,
+              "error": "Error trying to publish message to SNS client.",
+              "message": str(e),
+              "topic_arn": topic_arn,
+              "sns_message": message})
+
+    # Send message to glacier SNS topic so we can archive results annotation file
+    if user_role == "free_user":
+        message_dict_glacier = {"job_id": job_id, "user_id": user_id, "user_role": user_role,
+                                "complete_time": complete_time, "file_annot": file_annot,
+                                "s3_results_bucket": s3_results_bucket, "key_annot": key_annot}
+        message_glacier = str(message_dict_glacier)
+            
         try:
-            response = client.publish(
-            TopicArn=topic_arn,
-            Message=message
-            )
-            message_id = response["MessageId"]
+           response = client.publish(
+              TopicArn=glacier_sns_topic,
+              Message=message_glacier
+              )
+           message_id = response["MessageId"]
         except Exception as e:
            print({"code": 500,
-                  "error": "Error trying to publish message to SNS client.",
-                  "message": str(e),
-                  "topic_arn": topic_arn,
-                  "sns_message": message})
-
-        # Send message to glacier SNS topic so we can archive results annotation file
-        if user_role == "free_user":
-            message_dict_glacier = {"job_id": job_id, "user_id": user_id, "user_role": user_role,
-                                    "complete_time": complete_time, "file_annot": file_annot,
-                                    "s3_results_bucket": s3_results_bucket, "key_annot": key_annot}
-            message_glacier = str(message_dict_glacier)
-            
-            try:
-               response = client.publish(
-                  TopicArn=glacier_sns_topic,
-                  Message=message_glacier
-                  )
-               message_id = response["MessageId"]
-            except Exception as e:
-               print({"code": 500,
-                        "error": "Error trying to publish message to SNS client.",
-                        "message": str(e),
-                        "glacier_sns_topic": glacier_sns_topic,
-                        "sns_message": message_glacier})
+                    "error": "Error trying to publish message to SNS client.",
+                    "message": str(e),
+                    "glacier_sns_topic": glacier_sns_topic,
+                    "sns_message": message_glacier})
+
 
+"""Prepares a worker process of the annotator pool before its first job:
+   imports and clients are already set up by loading this module, so
+   this opens the reference database connection, the variant cache and
+   the reference snapshot
+"""
+def warm():
+    try:
+        with driver.reference().connection():
+            pass
+        driver.variantCache()
+        driver.referenceSnapshot()
+        driver.dbSnpFilter()
+        driver.coverageBitmaps()
+    except Exception as e:
+        print(f"Error when trying to warm up the annotation worker. Message: {e}")
+
+
+if __name__ == '__main__':
+   # Call the AnnTools pipeline
+    if (len(sys.argv) == 7) and (sys.argv[1] == "--stream"):
+        # run.py --stream <bucket> <key> <user_id> <job_id> <file name>
+        sys.exit(0 if run_stream_job(*sys.argv[2:]) else 1)
+    elif len(sys.argv) > 1:
+        # The exit status tells annotator.py whether the results were uploaded
+        sys.exit(0 if run_job(sys.argv[1]) else 1)
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
@@ -0,0 +1,342 @@
+# s3_transfer.py
+#
+# S3 transfers of job inputs and results
+#
+# Files are moved in parts sent over several connections at the same
+# time: downloads with the managed transfers of boto3, uploads with the
+# multipart writer below. Part size, threshold and concurrency are read
+# from the [transfer] section of ann_config.ini. Each uploaded part is
+# sent with its MD5, computed as the file is read, which S3 checks as
+# the part arrives. Downloads are read back once and their MD5 compared
+# with the ETag of the object, except for objects encrypted with KMS
+# keys, whose ETags are not MD5s. Neither relies on the flexible
+# checksum arguments of newer boto3 releases.
+#
+# Jobs run in streaming mode never write their files to local disk: the
+# input is read line by line from the body of its object and the results
+# are sent back in parts while the rest is still being annotated.
+#
+##
+
+import os
+import math
+import base64
+import hashlib
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+MULTIPART_THRESHOLD = config.getint('transfer', 'MULTIPART_THRESHOLD_MB', fallback=16) * MB
+PART_SIZE = config.getint('transfer', 'PART_SIZE_MB', fallback=16) * MB
+MAX_CONCURRENCY = config.getint('transfer', 'MAX_CONCURRENCY', fallback=10)
+VERIFY_CHECKSUMS = config.getboolean('transfer', 'VERIFY_CHECKSUMS', fallback=True)
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=PART_SIZE, max_concurrency=MAX_CONCURRENCY,
+    use_threads=True)
+
+# Server-side encryption of objects whose ETag is not the MD5 of their
+# contents
+KMS_ENCRYPTION = ['aws:kms', 'aws:kms:dsse']
+
+
+"""Raised when a transferred file does not match its object
+"""
+class ChecksumError(Exception):
+    pass
+
+
+"""Whether the ETag of an object, as head_object() or get_object()
+   describe it, is the MD5 of its contents
+"""
+def has_md5_etag(response):
+    return response.get('ServerSideEncryption') not in KMS_ENCRYPTION
+
+
+"""MD5s of bytes fed in order, of all of them and of each part of
+   part_size, to compute the ETag S3 gives an object with those contents
+"""
+class ETagHasher(object):
+
+    def __init__(self, part_size=PART_SIZE):
+        self.part_size = part_size
+        self.md5 = hashlib.md5()
+        self.part_md5 = hashlib.md5()
+        self.part_bytes = 0
+        self.digests = []
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        while chunk:
+            take = self.part_size - self.part_bytes
+            self.part_md5.update(chunk[:take])
+            self.part_bytes = self.part_bytes + len(chunk[:take])
+            chunk = chunk[take:]
+            if (self.part_bytes == self.part_size):
+                self.digests.append(self.part_md5.digest())
+                self.part_md5 = hashlib.md5()
+                self.part_bytes = 0
+
+    """ETag of the bytes uploaded in a single part: their MD5
+    """
+    def single(self):
+        return self.md5.hexdigest()
+
+    """ETag of the bytes uploaded in parts: the MD5 of the MD5s of the
+       parts followed by the number of parts
+    """
+    def multipart(self):
+        digests = list(self.digests)
+        if (self.part_bytes > 0):
+            digests.append(self.part_md5.digest())
+        return hashlib.md5(b''.join(digests)).hexdigest() + '-' + str(len(digests))
+
+
+"""ETags S3 gives an object with the contents of the file at path when it
+   is uploaded in parts of each of part_sizes, or in a single part when
+   part_sizes is empty, all from one read of the file
+"""
+def file_etags(path, part_sizes=[]):
+    hashers = [ETagHasher(part_size) for part_size in part_sizes] or \
+        [ETagHasher(os.path.getsize(path) + 1)]
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            for hasher in hashers:
+                hasher.update(block)
+    if (len(part_sizes) == 0):
+        return [hashers[0].single()]
+    return [hasher.multipart() for hasher in hashers]
+
+
+"""Checks that the file at path holds the same bytes as the object
+   A multipart ETag depends on the part size the object was uploaded
+   with, so for objects uploaded by other clients the sizes that give
+   its number of parts are tried; if none does the check is skipped.
+   Objects encrypted with KMS keys do not have MD5 ETags and are not
+   checked. The file is read once, whatever the number of part sizes.
+"""
+def verify(client, path, bucket, key):
+    head = client.head_object(Bucket=bucket, Key=key)
+    if not has_md5_etag(head):
+        print(f"'s3://{bucket}/{key}' is encrypted with a KMS key, checksum not verified.")
+        return
+    etag = head['ETag'].strip('"')
+    size = os.path.getsize(path)
+
+    if ('-' not in etag):
+        etags = file_etags(path)
+    else:
+        parts = int(etag.split('-')[1])
+        sizes = set([PART_SIZE, int(math.ceil(size / parts / MB)) * MB])
+        sizes = [part_size for part_size in sorted(sizes)
+                 if (part_size > 0) and (int(math.ceil(size / part_size)) == parts)]
+        if (len(sizes) == 0):
+            print(f"Part size of 's3://{bucket}/{key}' unknown, checksum not verified.")
+            return
+        etags = file_etags(path, sizes)
+
+    if (etag not in etags):
+        raise ChecksumError(f"Checksum of '{path}' does not match 's3://{bucket}/{key}'.")
+
+
+"""Downloads an object to path in parallel parts
+"""
+def download_file(client, bucket, key, path):
+    client.download_file(bucket, key, path, Config=TRANSFER_CONFIG)
+    if VERIFY_CHECKSUMS:
+        verify(client, path, bucket, key)
+
+
+"""Uploads the file at path in parallel parts of PART_SIZE
+   Every part goes with its MD5, which S3 checks, so the file is read
+   once and never read back; see S3MultipartWriter.
+"""
+def upload_file(client, path, bucket, key):
+    writer = S3MultipartWriter(client, bucket, key)
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(PART_SIZE), b''):
+                writer.write_bytes(block)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+
+"""Uploads several files at the same time
+   files is a list of (path, key) pairs. Returns, for every file, None
+   once it is uploaded or the exception its upload failed with.
+"""
+def upload_files(client, bucket, files):
+    def upload(file):
+        try:
+            upload_file(client, file[0], bucket, file[1])
+            return None
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, len(files))) as executor:
+        return list(executor.map(upload, files))
+
+"""Lines of an S3 object, decoded, as they arrive from its body
+   bytes counts what has been read so far. While reading, the MD5 of the
+   whole object and of each PART_SIZE part are kept, so verify() can
+   check the stream against the ETag once it is done.
+"""
+class S3LineReader(object):
+
+    def __init__(self, client, bucket, key, chunk_size=MB):
+        response = client.get_object(Bucket=bucket, Key=key)
+        self.body = response['Body']
+        self.etag = response.get('ETag', '').strip('"')
+        self.md5_etag = has_md5_etag(response)
+        self.name = f"s3://{bucket}/{key}"
+        self.chunk_size = chunk_size
+        self.bytes = 0
+        self.hasher = ETagHasher(PART_SIZE)
+
+    def __iter__(self):
+        pending = b''
+        for chunk in self.body.iter_chunks(self.chunk_size):
+            self.checksum(chunk)
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8')
+        if pending:
+            yield pending.decode('utf-8')
+
+    def checksum(self, chunk):
+        self.bytes = self.bytes + len(chunk)
+        self.hasher.update(chunk)
+
+    """Raises ChecksumError if what was read does not match the ETag
+       Multipart objects can only be checked when they were uploaded in
+       parts of PART_SIZE, and objects encrypted with KMS keys, whose
+       ETags are not MD5s, not at all.
+    """
+    def verify(self):
+        if (not self.etag) or (not VERIFY_CHECKSUMS):
+            return
+        if not self.md5_etag:
+            print(f"'{self.name}' is encrypted with a KMS key, checksum not verified.")
+            return
+        if ('-' not in self.etag):
+            if (self.hasher.single() != self.etag):
+                raise ChecksumError(f"Checksum of '{self.name}' does not match its ETag.")
+            return
+
+        etag = self.hasher.multipart()
+        if (etag.split('-')[1] != self.etag.split('-')[1]):
+            print(f"Part size of '{self.name}' unknown, checksum not verified.")
+        elif (etag != self.etag):
+            raise ChecksumError(f"Checksum of '{self.name}' does not match its ETag.")
+
+    def close(self):
+        self.body.close()
+
+
+"""Text, or bytes with write_bytes(), written to an S3 object in parts,
+   uploaded in the background as soon as part_size bytes are buffered
+   At most concurrency parts are in flight at a time, which bounds the
+   memory used. Each part is sent with its MD5, which S3 checks. Outputs
+   smaller than a part are sent with a single put_object. Nothing is
+   visible in the bucket until close(); abort() drops the parts sent.
+"""
+class S3MultipartWriter(object):
+
+    def __init__(self, client, bucket, key, part_size=PART_SIZE,
+        concurrency=MAX_CONCURRENCY):
+
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.buffer = []
+        self.buffered = 0
+        self.bytes = 0
+        self.upload_id = None
+        self.parts = []
+        self.digests = []
+        self.executor = None
+
+    def write(self, text):
+        self.write_bytes(text.encode('utf-8'))
+
+    def write_bytes(self, data):
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        self.bytes = self.bytes + len(data)
+        if (self.buffered >= self.part_size):
+            self.send_part()
+
+    def take_buffer(self):
+        body = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return body
+
+    def send_part(self):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket,
+                Key=self.key)
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        body = self.take_buffer()
+        digest = hashlib.md5(body).digest()
+        self.digests.append(digest)
+        self.parts.append(self.executor.submit(self.client.upload_part,
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1, Body=body,
+            ContentMD5=base64.b64encode(digest).decode('ascii')))
+
+        # Wait for the oldest part in flight rather than buffering more
+        pending = [part for part in self.parts if not part.done()]
+        if (len(pending) > self.concurrency):
+            pending[0].result()
+
+    def close(self):
+        if self.upload_id is None:
+            body = self.take_buffer()
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                ContentMD5=base64.b64encode(hashlib.md5(body).digest()).decode('ascii'))
+            return
+
+        if (self.buffered > 0):
+            self.send_part()
+        parts = [{'ETag': part.result()['ETag'], 'PartNumber': n + 1}
+                 for n, part in enumerate(self.parts)]
+        self.executor.shutdown()
+        response = self.client.complete_multipart_upload(Bucket=self.bucket,
+            Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts})
+
+        # S3 checked the MD5 of every part as it arrived; the ETag of the
+        # whole object only adds up to them when it is not KMS encrypted
+        etag = response.get('ETag', '').strip('"') if has_md5_etag(response) \
+            else ''
+        expected = hashlib.md5(b''.join(self.digests)).hexdigest() + '-' + \
+            str(len(self.digests))
+        if VERIFY_CHECKSUMS and etag and (etag != expected):
+            raise ChecksumError(f"Checksum of 's3://{self.bucket}/{self.key}' does not match what was written.")
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Error aborting upload of 's3://{self.bucket}/{self.key}'. Message: {e}")
+
+### EOF
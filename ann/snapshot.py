@@ -0,0 +1,415 @@
+# snapshot.py
+#
+# Memory-mapped snapshot of the region tables of the reference database
+#
+# A snapshot is a directory per reference release holding, for every
+# table and chromosome, columnar files the annotator maps into memory:
+#
+#   <path>/<version>/manifest.json
+#   <path>/<version>/<table>/<n>.start.npy    region starts, sorted
+#   <path>/<version>/<table>/<n>.end.npy      region ends, in start order
+#   <path>/<version>/<table>/<n>.maxend.npy   running maximum of the ends
+#   <path>/<version>/<table>/<n>.order.npy    row of each region
+#   <path>/<version>/<table>/<n>.offsets.npy  where each cell starts in
+#                                             the blob, row by row
+#   <path>/<version>/<table>/<n>.kinds.npy    type of each cell
+#   <path>/<version>/<table>/<n>.blob         cell values, one after another
+#
+# dbSNP and the BigRefGene tables, which are read by position and alleles,
+# are packed in layouts of their own instead (see dbsnp.py and
+# bigrefgene.py), refGene is also flattened into the gene map of the
+# gene location stages (see genemap.py), and gwasCatalog is also kept
+# by exact position (see gwascatalog.py).
+#
+# The manifest lists the columns of each table and the file number of
+# each of its chromosomes. Rows are dumped in the order the queries of
+# the stages read them in (see backends.ReferenceBackend.orderBy), so
+# lookups return them in the same order as the queries.
+# Files are opened read-only, so every process on a node shares their
+# pages through the OS cache.
+#
+# Built from the configured reference database with:
+#
+#   python snapshot.py <snapshot dir> [table ...]
+#
+##
+
+import os
+import sys
+import json
+import mmap
+import decimal
+
+import numpy as np
+
+import intervals
+
+# Region tables the stages query, with their chromosome, start and end
+# columns; tables without a chromosome column hold a single chromosome
+TABLES = dict([(table, ('chrom', 'chromStart', 'chromEnd')) for table in [
+    'cytoBand', 'gwasCatalog', 'hugo', 'dgv_Cnv', 'conrad_Cnv',
+    'mcCarroll_Cnv', 'abParts_IG_T_CelReceptors', 'genomicSuperDups',
+    'targetScanS', 'cpgIslandExt']])
+TABLES['gadAll'] = ('chromosome', 'chromStart', 'chromEnd')
+TABLES['refGene'] = ('chrom', 'txStart', 'txEnd')
+for chrom in [str(n) for n in range(1, 23)] + ['X', 'Y']:
+    TABLES['tfbsConsSites' + chrom] = (None, 'chromStart', 'chromEnd')
+
+# Tables kept in a packed layout of their own: dbSNP, the three tables
+# of the BigRefGene stage under that name, the gene map of refGene and
+# the exact-position index of gwasCatalog
+PACKED = ['dbSNP', 'BigRefGene', 'geneMap', 'gwasIndex']
+
+# Types of the cell values, as stored in kinds
+NULL, TEXT, INTEGER, FLOAT, BYTES, DECIMAL = range(6)
+DECODERS = {
+    TEXT: lambda b: b.decode('utf-8'),
+    INTEGER: lambda b: int(b),
+    FLOAT: lambda b: float(b),
+    BYTES: lambda b: b,
+    DECIMAL: lambda b: decimal.Decimal(b.decode('ascii')),
+}
+
+"""Type code and stored bytes of a cell value
+"""
+def encodeValue(value):
+    if value is None:
+        return NULL, b''
+    if isinstance(value, (bytes, bytearray)):
+        return BYTES, bytes(value)
+    if isinstance(value, bool):
+        return INTEGER, str(int(value)).encode('ascii')
+    if isinstance(value, int):
+        return INTEGER, str(value).encode('ascii')
+    if isinstance(value, float):
+        return FLOAT, repr(value).encode('ascii')
+    if isinstance(value, decimal.Decimal):
+        return DECIMAL, str(value).encode('ascii')
+    return TEXT, str(value).encode('utf-8')
+
+
+"""Rows of one chromosome of a table, decoded from the blob when read
+   Row i is the i-th row of the chromosome as the database returned it.
+"""
+class RowView(object):
+
+    def __init__(self, offsets, kinds, blob, width, select=None):
+        self.offsets = offsets
+        self.kinds = kinds
+        self.blob = blob
+        self.width = width
+        self.select = select if select is not None else range(width)
+
+    def __len__(self):
+        return len(self.kinds) // self.width
+
+    def __getitem__(self, i):
+        first = i * self.width
+        bounds = self.offsets[first:first + self.width + 1].tolist()
+        kinds = self.kinds[first:first + self.width].tolist()
+        row = []
+        for n in self.select:
+            if (kinds[n] == NULL):
+                row.append(None)
+            else:
+                row.append(DECODERS[kinds[n]](self.blob[bounds[n]:bounds[n + 1]]))
+        return tuple(row)
+
+
+"""File number of chrom in chroms, the chromosome map of a manifest
+   entry, or None if it has no rows
+   Chromosome names compare without case, like in MySQL.
+"""
+def chromNumber(chroms, chrom):
+    if chrom is None:
+        chrom = ''
+    if chrom in chroms:
+        return chroms[chrom]
+    for name, n in chroms.items():
+        if (name.lower() == str(chrom).lower()):
+            return n
+    return None
+
+
+"""Maps a blob file read-only; empty files, which cannot be mapped, give
+   empty bytes
+"""
+def mapBlob(path):
+    fh = open(path, 'rb')
+    if (os.fstat(fh.fileno()).st_size > 0):
+        blob = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        blob = b''
+    fh.close()
+    return blob
+
+
+"""Interns cell values: each distinct value gets a code, in order of
+   first appearance
+   The values are written as a table of single-cell rows, read back with
+   readValues().
+"""
+class ValueTable(object):
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        key = (type(value).__name__, value)
+        if key not in self.codes:
+            self.codes[key] = len(self.values)
+            self.values.append(value)
+        return self.codes[key]
+
+    def write(self, path, name='values'):
+        offsets = np.zeros(len(self.values) + 1, dtype=np.int64)
+        kinds = np.zeros(len(self.values), dtype=np.uint8)
+        fh = open(os.path.join(path, name + '.blob'), 'wb')
+        for n, value in enumerate(self.values):
+            kind, data = encodeValue(value)
+            fh.write(data)
+            kinds[n] = kind
+            offsets[n + 1] = offsets[n] + len(data)
+        fh.close()
+        np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+        np.save(os.path.join(path, name + '.kinds.npy'), kinds)
+
+
+"""The values a ValueTable wrote to path, as a RowView of one-cell rows
+"""
+def readValues(path, name='values'):
+    return RowView(np.load(os.path.join(path, name + '.offsets.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, name + '.kinds.npy'), mmap_mode='r'),
+        mapBlob(os.path.join(path, name + '.blob')), 1)
+
+
+"""A snapshot of one reference release, opened read-only
+   Indexes are built on first use, from the mapped files, and kept for
+   the life of the process.
+"""
+class Snapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        fh = open(os.path.join(path, 'manifest.json'))
+        self.manifest = json.load(fh)
+        fh.close()
+        self.version = self.manifest['version']
+        self.tables = self.manifest['tables']
+        self.indexes = {}
+        self.packed = {}
+
+    def has(self, table):
+        return table in self.tables
+
+    def columns(self, table):
+        return self.tables[table]['columns']
+
+    """File number of a chromosome of table, or None if it has no rows
+       Chromosome names compare without case, like in MySQL.
+    """
+    def chromFile(self, table, chrom):
+        return chromNumber(self.tables[table]['chroms'], chrom)
+
+    def load(self, table, n, name):
+        return np.load(os.path.join(self.path, table, str(n) + '.' + name),
+            mmap_mode='r')
+
+    """The intervals.IntervalIndex of a chromosome of table; chrom is None
+       for tables without a chromosome column
+       Its rows hold the given columns, a comma-separated list as in a
+       select, or every column of the table for '*'.
+    """
+    def index(self, table, chrom, columns='*'):
+        key = (table, chrom, columns)
+        if key in self.indexes:
+            return self.indexes[key]
+
+        n = self.chromFile(table, chrom)
+        if n is None:
+            index = intervals.IntervalIndex([], [], [])
+        else:
+            blob = mapBlob(os.path.join(self.path, table, str(n) + '.blob'))
+            names = self.columns(table)
+            select = None
+            if (columns != '*'):
+                select = [names.index(c.strip()) for c in columns.split(',')]
+            rows = RowView(self.load(table, n, 'offsets.npy'),
+                self.load(table, n, 'kinds.npy'), blob, len(names), select)
+            index = intervals.fromSorted(self.load(table, n, 'start.npy'),
+                self.load(table, n, 'end.npy'), self.load(table, n, 'maxend.npy'),
+                self.load(table, n, 'order.npy'), rows)
+        self.indexes[key] = index
+        return index
+
+    """The dbsnp.DbSnpIndex of table
+    """
+    def dbSnp(self, table='dbSNP'):
+        import dbsnp
+
+        if table not in self.packed:
+            self.packed[table] = dbsnp.DbSnpIndex(os.path.join(self.path, table),
+                self.tables[table]['chroms'])
+        return self.packed[table]
+
+    """The genemap.GeneMapIndex of the snapshot
+    """
+    def geneMap(self, table='geneMap'):
+        import genemap
+
+        if table not in self.packed:
+            self.packed[table] = genemap.GeneMapIndex(
+                os.path.join(self.path, table), self.tables[table])
+        return self.packed[table]
+
+    """The gwascatalog.GwasCatalogIndex of the snapshot
+    """
+    def gwasCatalog(self, table='gwasIndex'):
+        import gwascatalog
+
+        if table not in self.packed:
+            self.packed[table] = gwascatalog.GwasCatalogIndex(
+                os.path.join(self.path, table), self.tables[table])
+        return self.packed[table]
+
+    """The bigrefgene.BigRefGeneIndex of the snapshot
+    """
+    def bigRefGene(self, table='BigRefGene'):
+        import bigrefgene
+
+        if table not in self.packed:
+            self.packed[table] = bigrefgene.BigRefGeneIndex(
+                os.path.join(self.path, table), self.tables[table]['chroms'])
+        return self.packed[table]
+
+
+"""Opens the snapshot of a release under path, or returns None if it was
+   never built
+"""
+def openSnapshot(path, version):
+    path = os.path.join(path, version)
+    if not os.path.exists(os.path.join(path, 'manifest.json')):
+        print(f"No reference snapshot of '{version}' in '{path}'.")
+        return None
+    return Snapshot(path)
+
+
+"""Writes the files of one chromosome of a table
+   rows are (start, end, row) in database order.
+"""
+def writeChrom(path, n, rows, width):
+    starts = np.array([row[0] for row in rows], dtype=np.int64)
+    ends = np.array([row[1] for row in rows], dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    maxEnds = np.maximum.accumulate(ends[order])
+
+    offsets = np.zeros(len(rows) * width + 1, dtype=np.int64)
+    kinds = np.zeros(len(rows) * width, dtype=np.uint8)
+    fh = open(os.path.join(path, str(n) + '.blob'), 'wb')
+    position = 0
+    cell = 0
+    for start, end, row in rows:
+        for value in row:
+            kind, data = encodeValue(value)
+            fh.write(data)
+            kinds[cell] = kind
+            position = position + len(data)
+            cell = cell + 1
+            offsets[cell] = position
+    fh.close()
+
+    np.save(os.path.join(path, str(n) + '.start.npy'), starts[order])
+    np.save(os.path.join(path, str(n) + '.end.npy'), ends[order])
+    np.save(os.path.join(path, str(n) + '.maxend.npy'), maxEnds)
+    np.save(os.path.join(path, str(n) + '.order.npy'), order)
+    np.save(os.path.join(path, str(n) + '.offsets.npy'), offsets)
+    np.save(os.path.join(path, str(n) + '.kinds.npy'), kinds)
+
+
+"""Dumps one table from the reference database into path/table
+   Rows without a start or an end can never overlap a position and are
+   left out. Returns the manifest entry of the table.
+"""
+def dumpTable(backend, conn, path, table):
+    chromName, startName, endName = TABLES[table]
+    cursor = backend.scanCursor(conn)
+    cursor.execute('select * from ' + table + backend.orderBy(cursor, table,
+        [chromName] if chromName is not None else []))
+    columns = [d[0] for d in cursor.description]
+    chromCol = columns.index(chromName) if chromName is not None else None
+    startCol = columns.index(startName)
+    endCol = columns.index(endName)
+
+    byChrom = {}
+    count = 0
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            if (row[startCol] is None) or (row[endCol] is None):
+                continue
+            chrom = str(row[chromCol]) if chromCol is not None else ''
+            byChrom.setdefault(chrom, []).append((int(row[startCol]),
+                int(row[endCol]), tuple(row)))
+            count = count + 1
+    cursor.close()
+
+    os.makedirs(os.path.join(path, table), exist_ok=True)
+    chroms = {}
+    for n, chrom in enumerate(sorted(byChrom)):
+        writeChrom(os.path.join(path, table), n, byChrom[chrom], len(columns))
+        chroms[chrom] = n
+
+    print(f"{table}: {count} rows in {len(chroms)} chromosomes")
+    return {'chromName': chromName, 'startName': startName,
+        'endName': endName, 'columns': columns, 'chroms': chroms}
+
+
+"""Builds the snapshot of the given tables, all of TABLES and PACKED by
+   default, from backend, the configured reference database by default
+   The manifest is written last, so a snapshot being built is never
+   opened.
+"""
+def buildSnapshot(path, version, tables=None, backend=None):
+    import driver
+    import dbsnp
+    import bigrefgene
+    import genemap
+    import gwascatalog
+
+    dumpers = {'dbSNP': dbsnp.dumpDbSnp,
+        'BigRefGene': bigrefgene.dumpBigRefGene, 'geneMap': genemap.dumpGeneMap,
+        'gwasIndex': gwascatalog.dumpGwasCatalog}
+    if tables is None:
+        tables = sorted(TABLES) + PACKED
+    path = os.path.join(path, version)
+    os.makedirs(path, exist_ok=True)
+
+    if backend is None:
+        backend = driver.reference()
+    manifest = {'version': version, 'tables': {}}
+    with backend.connection() as conn:
+        for table in tables:
+            if table in PACKED:
+                manifest['tables'][table] = dumpers[table](backend, conn,
+                    path, table)
+            else:
+                manifest['tables'][table] = dumpTable(backend, conn, path, table)
+
+    fh = open(os.path.join(path, 'manifest.json'), 'w')
+    json.dump(manifest, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import driver
+        buildSnapshot(sys.argv[1], driver.REFERENCE_VERSION,
+            tables=sys.argv[2:] or None)
+    else:
+        print("Usage: python snapshot.py <snapshot dir> [table ...]")
+
+### EOF
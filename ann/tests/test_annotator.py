@@ -0,0 +1,154 @@
+# test_annotator.py
+#
+# How the annotator shares worker slots among its lanes: the smooth
+# weighted round robin of share_slots, and receive_messages over SQS
+# queues stubbed in memory.
+#
+#   python -m unittest discover -s tests
+#
+##
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotator
+
+
+"""SQS queue that hands out the messages it holds and records every
+   receive_messages call
+"""
+class StubQueue(object):
+
+    def __init__(self, url, messages=0):
+        self.url = url
+        self.messages = ['%s/%d' % (url, n) for n in range(messages)]
+        self.calls = []
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+        VisibilityTimeout=30):
+        self.calls.append((MaxNumberOfMessages, WaitTimeSeconds))
+        received = self.messages[:MaxNumberOfMessages]
+        self.messages = self.messages[MaxNumberOfMessages:]
+        return received
+
+
+"""Stands in for boto3 in annotator: its SQS resource makes StubQueues
+"""
+class StubBoto3(object):
+
+    def __init__(self):
+        self.queues = {}
+
+    def resource(self, service, region_name=None):
+        return self
+
+    def Queue(self, url):
+        self.queues[url] = StubQueue(url)
+        return self.queues[url]
+
+
+class AnnotatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict([(name, getattr(annotator, name)) for name in
+            ['boto3', 'sqs_url', 'sqs_premium_url', 'sqs_fast_url',
+            'premium_weight', 'free_weight', 'worker_mode', 'pool_size',
+            'fast_pool_size']])
+        annotator.boto3 = StubBoto3()
+        annotator.sqs_url = 'free'
+        annotator.sqs_premium_url = 'premium'
+        annotator.sqs_fast_url = ''
+        annotator.premium_weight = 3
+        annotator.free_weight = 1
+        annotator.worker_mode = 'subprocess'
+        annotator.pool_size = 4
+        annotator.fast_pool_size = 2
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(annotator, name, value)
+
+    def lanes(self, premium=0, free=0):
+        lanes = annotator.create_lanes()
+        lanes[0].queue.messages = StubQueue('premium', premium).messages
+        lanes[1].queue.messages = StubQueue('free', free).messages
+        return lanes
+
+    def testSlotsFollowWeights(self):
+        lanes = self.lanes()
+        self.assertEqual([lane.name for lane in lanes], ['premium', 'free'])
+        self.assertEqual(annotator.share_slots(lanes, 8), [6, 2])
+        self.assertEqual(annotator.share_slots(lanes, 0), [0, 0])
+
+    def testCreditsCarryOver(self):
+        lanes = self.lanes()
+        # One slot at a time still goes premium, premium, free, premium
+        shares = [annotator.share_slots(lanes, 1) for n in range(8)]
+        self.assertEqual(shares, [[1, 0], [1, 0], [0, 1], [1, 0]] * 2)
+
+    def testWeightsAreAtLeastOne(self):
+        annotator.free_weight = 0
+        lanes = self.lanes()
+        self.assertEqual(annotator.share_slots(lanes, 4), [3, 1])
+
+    def testMessagesAreSharedByWeight(self):
+        lanes = self.lanes(premium=10, free=10)
+        messages = annotator.receive_messages(lanes, 4, wait_time=10)
+        self.assertEqual(messages,
+            ['premium/0', 'premium/1', 'premium/2', 'free/0'])
+        # Nobody waits for messages while both lanes have some
+        self.assertEqual(lanes[0].queue.calls, [(3, 0)])
+        self.assertEqual(lanes[1].queue.calls, [(1, 0)])
+
+    def testUnusedSlotsGoToOtherLanes(self):
+        lanes = self.lanes(premium=1, free=10)
+        messages = annotator.receive_messages(lanes, 4, wait_time=10)
+        self.assertEqual(messages, ['premium/0', 'free/0', 'free/1', 'free/2'])
+
+        lanes = self.lanes(premium=10, free=0)
+        messages = annotator.receive_messages(lanes, 4, wait_time=10)
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(all([m.startswith('premium/') for m in messages]))
+
+    def testEmptyLanesLongPollTheFirst(self):
+        lanes = self.lanes()
+        self.assertEqual(annotator.receive_messages(lanes, 4, wait_time=10), [])
+        self.assertEqual(lanes[0].queue.calls[-1], (4, 10))
+        self.assertTrue(all([wait == 0 for count, wait in lanes[1].queue.calls]))
+
+    def testFastLaneHasWorkersOfItsOwn(self):
+        annotator.sqs_fast_url = 'fast'
+        groups = annotator.create_groups()
+        self.assertEqual([group.name for group in groups], ['fast', 'batch'])
+        self.assertEqual([group.size for group in groups], [2, 4])
+        self.assertEqual([lane.name for lane in groups[0].lanes], ['fast'])
+        self.assertEqual([lane.name for lane in groups[1].lanes],
+            ['premium', 'free'])
+
+        # The main loop receives for the fast group first, and each group
+        # only reads the queues of its own lanes
+        fast = groups[0].lanes[0].queue
+        fast.messages = StubQueue('fast', 5).messages
+        groups[1].lanes[0].queue.messages = StubQueue('premium', 10).messages
+        self.assertEqual(annotator.receive_messages(groups[0].lanes, 2),
+            ['fast/0', 'fast/1'])
+        self.assertEqual(groups[1].lanes[0].queue.calls, [])
+
+        annotator.receive_messages(groups[1].lanes, 4)
+        self.assertEqual(fast.calls, [(2, 0)])
+
+    def testSingleLaneWithoutPremiumQueue(self):
+        annotator.sqs_premium_url = ''
+        lanes = annotator.create_lanes()
+        self.assertEqual([(lane.name, lane.url) for lane in lanes],
+            [('all', 'free')])
+        self.assertEqual(annotator.share_slots(lanes, 3), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
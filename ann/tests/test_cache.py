@@ -0,0 +1,124 @@
+# test_cache.py
+#
+# cache.VariantCache: the in-process LRU, the SQLite file shared across
+# processes, and keys that change with the reference release and the
+# format of the entries.
+#
+#   python -m unittest discover -s tests
+#
+##
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+
+Record = namedtuple('Record', ['chrom', 'pos', 'ref', 'alt'])
+
+RECORDS = [Record('1', 100 + n, 'A', 'G') for n in range(4)]
+
+
+def entry(n):
+    return {'dbSNP': [('rs%d' % n, '0.1')], 'Cytoband': ['p%d' % n]}
+
+
+class VariantCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'variants.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        c = cache.VariantCache(max_entries=2, version='v1')
+        c.putMany(RECORDS[:2], [entry(0), entry(1)])
+        # Reading the first record makes the second the least recently used
+        self.assertEqual(c.getMany(RECORDS[:1]), [entry(0)])
+        c.putMany(RECORDS[2:3], [entry(2)])
+
+        self.assertEqual(c.getMany(RECORDS[:3]), [entry(0), {}, entry(2)])
+        self.assertEqual(len(c.memory), 2)
+        self.assertEqual(c.getCounts()['memory_hits'], 3)
+        self.assertEqual(c.getCounts()['misses'], 1)
+
+    def testEntriesAreCopies(self):
+        c = cache.VariantCache(version='v1')
+        c.putMany(RECORDS[:1], [entry(0)])
+        found = c.getMany(RECORDS[:1])[0]
+        found['Hugo'] = []
+        self.assertEqual(c.getMany(RECORDS[:1]), [entry(0)])
+
+    def testFileOutlivesTheProcess(self):
+        c = cache.VariantCache(path=self.path, version='v1')
+        c.putMany(RECORDS, [entry(n) for n in range(4)])
+        c.close()
+
+        c = cache.VariantCache(path=self.path, version='v1')
+        self.assertEqual(c.getMany(RECORDS), [entry(n) for n in range(4)])
+        self.assertEqual(c.getCounts()['disk_hits'], 4)
+        # Read once from the file, then from memory
+        self.assertEqual(c.getMany(RECORDS[:1]), [entry(0)])
+        self.assertEqual(c.getCounts()['memory_hits'], 1)
+        c.close()
+
+    def testGrownEntriesAreStoredAgain(self):
+        c = cache.VariantCache(path=self.path, version='v1')
+        c.putMany(RECORDS[:1], [{'dbSNP': []}])
+        c.putMany(RECORDS[:1], [entry(0)])
+        c.close()
+
+        c = cache.VariantCache(path=self.path, version='v1')
+        self.assertEqual(c.getMany(RECORDS[:1]), [entry(0)])
+        c.close()
+
+    def testOtherReleaseMisses(self):
+        c = cache.VariantCache(path=self.path, version='v1')
+        c.putMany(RECORDS, [entry(n) for n in range(4)])
+        c.close()
+
+        c = cache.VariantCache(path=self.path, version='v2')
+        self.assertEqual(c.getMany(RECORDS), [{} for record in RECORDS])
+        c.close()
+
+    def testOtherFormatMisses(self):
+        c = cache.VariantCache(path=self.path, version='v1')
+        c.putMany(RECORDS, [entry(n) for n in range(4)])
+        c.close()
+
+        format = cache.FORMAT
+        cache.FORMAT = format + 1
+        try:
+            c = cache.VariantCache(path=self.path, version='v1')
+            self.assertEqual(c.getMany(RECORDS), [{} for record in RECORDS])
+            self.assertEqual(c.getCounts()['misses'], len(RECORDS))
+            c.close()
+        finally:
+            cache.FORMAT = format
+
+        c = cache.VariantCache(path=self.path, version='v1')
+        self.assertEqual(c.getMany(RECORDS), [entry(n) for n in range(4)])
+        c.close()
+
+    def testFileIsKeptUnderMaxBytes(self):
+        c = cache.VariantCache(path=self.path, max_bytes=1, version='v1')
+        c.putMany(RECORDS, [entry(n) for n in range(4)])
+        self.assertEqual(c.getCounts()['evictions'], 4)
+        c.close()
+
+        c = cache.VariantCache(path=self.path, version='v1')
+        self.assertEqual(c.getMany(RECORDS), [{} for record in RECORDS])
+        c.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
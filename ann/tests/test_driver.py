@@ -0,0 +1,117 @@
+# test_driver.py
+#
+# driver.runSharded must write the same annotated file, count log and
+# stage counts as a run in a single process. Both runs read the SQLite
+# reference built by test_reference_order.py.
+#
+#   python -m unittest discover -s tests
+#
+##
+
+import io
+import os
+import contextlib
+import json
+import multiprocessing
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import driver
+from test_reference_order import makeTables, loadReference, makeVcf, makeStages
+
+# Figures of a stage that depend neither on timing nor on how the input
+# was split into batches
+COUNTED = ['variants', 'bytes_written']
+
+
+# The workers inherit the settings patched into driver below only when
+# they are forked
+@unittest.skipUnless(multiprocessing.get_start_method() == 'fork',
+    'workers are not forked')
+class RunShardedTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(7)
+        cls.dir = tempfile.mkdtemp()
+        cls.reference = os.path.join(cls.dir, 'reference.sqlite')
+        loadReference(cls.reference, makeTables(rng), rng)
+        cls.vcf = makeVcf(rng)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.settings = dict([(name, getattr(driver, name)) for name in
+            ['stages', 'REFERENCE_BACKEND', 'REFERENCE_SQLITE_PATH',
+            'SHARD_WINDOW', 'SHARD_MIN_BYTES', 'VARIANT_CACHE',
+            'REFERENCE_SNAPSHOT_PATH', 'DBSNP_FILTER_PATH', 'COVERAGE_PATH']])
+        # The reference only has the tables of these stages
+        driver.stages = lambda format='vcf': makeStages(batch_size=50)
+        driver.REFERENCE_BACKEND = 'sqlite'
+        driver.REFERENCE_SQLITE_PATH = self.reference
+        # Several windows per chromosome, and no input too small to shard
+        driver.SHARD_WINDOW = 5000
+        driver.SHARD_MIN_BYTES = 0
+        driver.VARIANT_CACHE = False
+        driver.REFERENCE_SNAPSHOT_PATH = ''
+        driver.DBSNP_FILTER_PATH = ''
+        driver.COVERAGE_PATH = ''
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(driver, name, value)
+
+    """Runs the driver on the test VCF in a directory of its own; returns
+       the annotated file, the count log and the metrics
+    """
+    def runDriver(self, name, workers):
+        os.mkdir(os.path.join(self.dir, name))
+        infile = os.path.join(self.dir, name, 'test.vcf')
+        fh = open(infile, 'w')
+        fh.write(self.vcf)
+        fh.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            driver.run(infile, 'vcf', workers=workers)
+
+        outputs = []
+        for path in [os.path.join(self.dir, name, 'test.annot.vcf'),
+                infile + '.count.log', infile + '.metrics.json']:
+            fh = open(path)
+            outputs.append(fh.read())
+            fh.close()
+        outputs[2] = json.loads(outputs[2])
+        return outputs
+
+    def testShardsMatchSingleProcess(self):
+        annotated, log, figures = self.runDriver('single', 1)
+        shardedAnnotated, shardedLog, shardedFigures = self.runDriver('sharded', 3)
+
+        self.assertEqual(shardedFigures['workers'], 3)
+        self.assertEqual(figures['workers'], 1)
+        self.assertEqual(shardedAnnotated, annotated)
+        self.assertEqual(shardedLog, log)
+        for name in ['bytes_read', 'bytes_written']:
+            self.assertEqual(shardedFigures[name], figures[name])
+        self.assertEqual(
+            [[stage['stage']] + [stage[name] for name in COUNTED]
+                for stage in shardedFigures['stages']],
+            [[stage['stage']] + [stage[name] for name in COUNTED]
+                for stage in figures['stages']])
+        # No shard files are left behind
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'sharded'))),
+            ['test.annot.vcf', 'test.vcf', 'test.vcf.count.log',
+            'test.vcf.metrics.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,207 @@
+# test_reference_order.py
+#
+# The snapshot, in-memory index and batched paths must annotate a VCF
+# byte for byte like the per-position database queries. The reference
+# is loaded with load_reference.py from dumps whose rows are shuffled,
+# so the order the tables are stored in differs from the order their
+# indexes return them in, and regions share their start so the fetchOne
+# stages have ties to break.
+#
+#   python -m unittest discover -s tests
+#
+##
+
+import io
+import os
+import contextlib
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotate as ann
+import backends
+import load_reference
+import snapshot
+
+CHROMS = ['1', '2', 'X']
+VERSION = 'test'
+TFBS = ['tfbsConsSites' + chrom for chrom in [str(n) for n in range(1, 23)] + ['X', 'Y']]
+
+"""Rows of every table, from a fixed seed
+"""
+def makeTables(rng):
+    tables = {}
+    def table(name, columns):
+        tables[name] = (columns, [])
+        return tables[name][1]
+
+    cytoBand = table('cytoBand', ['chrom', 'chromStart', 'chromEnd', 'name', 'gieStain'])
+    dups = table('genomicSuperDups', ['bin', 'chrom', 'chromStart', 'chromEnd',
+        'name', 'score', 'strand', 'otherChrom', 'otherStart', 'otherEnd'])
+    gwas = table('gwasCatalog', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'pubMedID', 'author', 'pubDate', 'journal', 'title', 'trait'])
+    refGene = table('refGene', ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd',
+        'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
+        'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames'])
+    islands = table('cpgIslandExt', ['bin', 'chrom', 'chromStart', 'chromEnd', 'name'])
+    dbSNP = table('dbSNP', ['CHR', 'POS', 'END', 'ID', 'REF', 'ALT', 'INFO', 'GMAF'])
+    for name in TFBS:
+        table(name, ['chrom', 'chromStart', 'chromEnd', 'name'])
+
+    for chrom in CHROMS:
+        chr = 'chr' + chrom
+        for start in range(0, 20000, 2000):
+            # Bands sharing their start, so order decides which comes first
+            for k in range(rng.choice([1, 2, 3])):
+                cytoBand.append([chr, start, start + rng.randint(1500, 2500),
+                    'p%d' % rng.randint(1, 30), 'gneg'])
+        for i in range(60):
+            start = rng.randrange(0, 20000, 50)
+            end = start + rng.randint(10, 1500)
+            for k in range(rng.choice([1, 2])):
+                dups.append([0, chr, start, end, 'n', 0, '+',
+                    'chr%d' % rng.randint(1, 22), rng.randint(1, 10 ** 6),
+                    rng.randint(10 ** 6, 2 * 10 ** 6)])
+            islands.append([0, chr, start, end, 'CpG: %d' % rng.randint(10, 200)])
+        for i in range(40):
+            pos = rng.randrange(0, 20000, 10)
+            for k in range(rng.choice([1, 1, 2])):
+                gwas.append([0, chr, pos - 1, pos, 'rs1', str(rng.randint(10 ** 6, 10 ** 7)),
+                    'a', 'd', 'j', 't', rng.choice(['Height', 'Body mass index'])])
+            for k in range(rng.choice([1, 1, 2])):
+                dbSNP.append([chrom, pos, pos, 'rs%d' % rng.randint(1, 10 ** 8),
+                    rng.choice('ACGT'), rng.choice('ACGT'), 'SNV',
+                    rng.choice(['.', '0.1234'])])
+        for i in range(25):
+            txStart = rng.randrange(0, 18000, 10)
+            txEnd = txStart + rng.randint(200, 3000)
+            count = rng.randint(1, 4)
+            bounds = sorted(rng.sample(range(txStart + 1, txEnd), 2 * count - 2))
+            starts = [txStart] + bounds[1::2]
+            ends = bounds[0::2] + [txEnd]
+            cdsStart = rng.randint(txStart, txEnd)
+            cdsEnd = rng.choice([cdsStart, rng.randint(cdsStart, txEnd)])
+            refGene.append([0, 'NM_%d' % rng.randint(1, 999999), chr,
+                rng.choice('+-'), txStart, txEnd, cdsStart, cdsEnd, count,
+                ','.join(map(str, starts)) + ',', ','.join(map(str, ends)) + ',',
+                0, 'GENE%d' % rng.randint(1, 50), 'cmpl', 'cmpl', '0,'])
+        if chrom in ['1', 'X']:
+            for i in range(80):
+                start = rng.randrange(0, 20000, 100)
+                tables['tfbsConsSites' + chrom][1].append([chr, start,
+                    start + rng.randint(5, 500), 'V$TF%d' % rng.randint(1, 50)])
+    return tables
+
+
+"""Writes the tables as shuffled dumps and loads them into a SQLite
+   reference with load_reference.py
+"""
+def loadReference(path, tables, rng):
+    import sqlite3
+
+    db = sqlite3.connect(path)
+    for name, (columns, rows) in sorted(tables.items()):
+        rows = list(rows)
+        rng.shuffle(rows)
+        dump = path + '.' + name + '.tsv'
+        fh = open(dump, 'w')
+        fh.write('\t'.join(columns) + '\n')
+        for row in rows:
+            fh.write('\t'.join([str(v) for v in row]) + '\n')
+        fh.close()
+        load_reference.load_table(db, name, dump)
+    db.execute('analyze')
+    db.close()
+
+
+def makeVcf(rng):
+    lines = ['##fileformat=VCFv4.1',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+    for chrom in CHROMS:
+        for pos in sorted(rng.sample(range(1, 20000), 400)):
+            lines.append('\t'.join([chrom, str(pos - pos % 10 if rng.random() < 0.3 else pos),
+                '.', rng.choice('ACGT'), rng.choice('ACGT'), '.', '.', 'AC=1;AN=1']))
+    return '\n'.join(lines) + '\n'
+
+
+def makeStages(use_index=False, batch_size=1):
+    return [
+        ann.DbSnpStage(format='vcf', batch_size=batch_size),
+        ann.GenesStage(format='vcf', table='refGene', promoter_offset=500,
+            use_index=use_index),
+        ann.CytobandStage(format='vcf', table='cytoBand', use_index=use_index,
+            batch_size=batch_size),
+        ann.GwasCatalogStage(format='vcf', table='gwasCatalog',
+            batch_size=batch_size),
+        ann.GenomicSuperDupsStage(format='vcf', table='genomicSuperDups',
+            use_index=use_index, batch_size=batch_size),
+        ann.TfbsConsSitesStage(format='vcf', table='tfbsConsSites',
+            use_index=use_index, batch_size=batch_size),
+    ]
+
+
+class ReferenceOrderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(7)
+        cls.dir = tempfile.mkdtemp()
+        cls.reference = os.path.join(cls.dir, 'reference.sqlite')
+        tables = makeTables(rng)
+        loadReference(cls.reference, tables, rng)
+        cls.vcf = makeVcf(rng)
+
+        cls.backend = backends.SQLiteBackend(cls.reference)
+        with contextlib.redirect_stdout(io.StringIO()):
+            snapshot.buildSnapshot(os.path.join(cls.dir, 'snapshot'), VERSION,
+                tables=sorted([t for t in tables if t in snapshot.TABLES]) + \
+                    ['dbSNP', 'geneMap', 'gwasIndex'], backend=cls.backend)
+        cls.snapshot = snapshot.openSnapshot(os.path.join(cls.dir, 'snapshot'),
+            VERSION)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def annotate(self, snapshot=None, use_index=False, batch_size=1):
+        stages = makeStages(use_index=use_index, batch_size=batch_size)
+        out = io.StringIO()
+        log = io.StringIO()
+        ann.annotateStream(io.StringIO(self.vcf), out, stages, format='vcf',
+            chunk_size=100, backend=self.backend, snapshot=snapshot)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for stage in stages:
+                stage.writeLog(log)
+        return out.getvalue() + log.getvalue()
+
+    def testSnapshotMatchesDatabase(self):
+        self.assertEqual(self.annotate(snapshot=self.snapshot), self.annotate())
+
+    def testIndexMatchesDatabase(self):
+        self.assertEqual(self.annotate(use_index=True), self.annotate())
+
+    def testBatchesMatchDatabase(self):
+        self.assertEqual(self.annotate(batch_size=50), self.annotate())
+
+    def testSparseBatchesMatchDatabase(self):
+        import intervals
+
+        # Blocks split between positions further apart than this, and
+        # positions on their own are looked up one by one
+        span = intervals.MAX_SPAN
+        intervals.MAX_SPAN = 40
+        try:
+            sparse = self.annotate(batch_size=50)
+        finally:
+            intervals.MAX_SPAN = span
+        self.assertEqual(sparse, self.annotate())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -13,39 +13,169 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
+import contextlib
+import configparser
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+    ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+# Database settings are read from the [pipeline] section of ann_config.ini
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ann_config.ini'))
+
+RDS_SECRET_TTL = config.getint('pipeline', 'RDS_SECRET_TTL', fallback=300)
+DB_POOL_SIZE = config.getint('pipeline', 'DB_POOL_SIZE', fallback=4)
+DB_POOL_PING_AFTER = config.getint('pipeline', 'DB_POOL_PING_AFTER', fallback=30)
+
+_rds_secret = {'value': None, 'fetched': 0}
+_rds_secret_lock = threading.Lock()
+
+"""Get the RDS secret from AWS Secrets Manager
+   The secret is cached for RDS_SECRET_TTL seconds; refresh=True forces
+   a new fetch, e.g. after the password was rotated.
+"""
+def get_rds_secret(refresh=False):
+    with _rds_secret_lock:
+        age = time.time() - _rds_secret['fetched']
+        if refresh or (_rds_secret['value'] is None) or (age > RDS_SECRET_TTL):
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _rds_secret['value'] = json.loads(asm_response['SecretString'])
+                _rds_secret['fetched'] = time.time()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+        return _rds_secret['value']
+
+
 """Get connection to reference database
+   Opens a new connection; retries once with a fresh secret if the
+   cached credentials are rejected.
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+    database_name = 'annotator'
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+    for refresh in [False, True]:
+        rds_secret = get_rds_secret(refresh=refresh)
+        try:
+            # Return a connection to the database
+            return pymysql.connect(
+                host=rds_secret['host'],
+                port=rds_secret['port'],
+                user=rds_secret['username'],
+                passwd=rds_secret['password'],
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            # 1045: access denied
+            if refresh or (e.args[0] != 1045):
+                raise e
+
+
+def close_quietly(conn):
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
+        conn.close()
+    except Exception:
+        pass
 
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+
+"""Pool of reference database connections shared by a process
+   Connections are handed out with get() and given back with put();
+   when all DB_POOL_SIZE connections are in use get() waits for one to
+   come back. A connection that has been idle a while is pinged first and
+   replaced if the server went away.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, size=DB_POOL_SIZE, ping_after=DB_POOL_PING_AFTER):
+        self.size = size
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self.idle = []
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def get(self):
+        with self.cond:
+            while (len(self.idle) == 0) and (self.in_use >= self.size):
+                self.cond.wait()
+            self.in_use = self.in_use + 1
+            entry = self.idle.pop() if len(self.idle) > 0 else None
+
+        try:
+            if entry is None:
+                return db_connect()
+
+            conn, last_used = entry
+            if (time.time() - last_used > self.ping_after):
+                try:
+                    conn.ping(reconnect=True)
+                except pymysql.err.Error:
+                    close_quietly(conn)
+                    conn = db_connect()
+            return conn
+        except Exception as e:
+            with self.cond:
+                self.in_use = self.in_use - 1
+                self.cond.notify()
+            raise e
+
+    def put(self, conn):
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.in_use = self.in_use - 1
+            self.cond.notify()
+
+    """Closes a broken connection instead of returning it to the pool
+    """
+    def discard(self, conn):
+        close_quietly(conn)
+        with self.cond:
+            self.in_use = self.in_use - 1
+            self.cond.notify()
+
+    """Borrow a connection for the duration of a with block
+       Connections are discarded if the block raised, since they may be
+       left in the middle of a result set.
+    """
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def close(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+        for conn, last_used in idle:
+            close_quietly(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Get the process-wide connection pool
+   A forked child gets a pool of its own rather than sharing its
+   parent's sockets.
+"""
+def db_pool():
+    global _pool
+    with _pool_lock:
+        if (_pool is None) or (_pool.pid != os.getpid()):
+            _pool = ConnectionPool()
+        return _pool
 
 
 """Column inices for pileup and VCF
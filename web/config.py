@@ -98,6 +98,9 @@ class Config(object):
   AWS_SNS_JOB_RESTORE_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:josemaria_restore"
 
+  # Inputs up to this size (in bytes) are run in the annotator's fast lane
+  AWS_FAST_LANE_MAX_BYTES = 10 * 1024 * 1024
+
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "josemaria_annotations"
 
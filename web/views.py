@@ -109,6 +109,21 @@ def create_annotation_job_request():
   job_id, input_file_name = job_file.split("~")
   submit_time = int(time.time())
 
+  # Get the input file size, which decides the lane the job runs in
+  try:
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    response = s3.head_object(Bucket=bucket_name, Key=s3_key)
+    input_size = response["ContentLength"]
+  except Exception as e:
+    return {"code": 500,
+            "error": f"Error trying to get size of input file '{s3_key}'.",
+            "message": str(e)}
+
+  if (input_size <= app.config['AWS_FAST_LANE_MAX_BYTES']):
+    size_class = "small"
+  else:
+    size_class = "large"
+
   # Get email
   profile = get_profile(identity_id=session.get('primary_identity'))
   email = profile.email
@@ -123,7 +138,8 @@ def create_annotation_job_request():
           "submit_time": submit_time,
           "job_status": "PENDING",
           "email": email,
-          "user_role": user_role
+          "user_role": user_role,
+          "input_size": input_size
           }
   
   try:
@@ -155,9 +171,15 @@ def create_annotation_job_request():
   message = str(data)
     
   try:
+    # The user role and size class attributes route jobs to the fast,
+    # premium and free queues through the subscriptions' filter policies
     response = client.publish(
       TopicArn=topic_arn,
-      Message=message
+      Message=message,
+      MessageAttributes={"user_role": {"DataType": "String",
+                                       "StringValue": user_role},
+                         "size_class": {"DataType": "String",
+                                        "StringValue": size_class}}
       )
     message_id = response["MessageId"]
   except Exception as e: